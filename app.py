@@ -11,7 +11,8 @@ import plotly.express as px
 import pandas as pd
 from flask import request, jsonify
 from dash.exceptions import PreventUpdate
-from config import PREFIX_NAME
+import config_defaults  # noqa: F401  (defaults for settings an older config.py lacks)
+from config import PREFIX_NAME, DATA_SOURCES
 from config import (actual_keys_in_data, 
                     DATA_FILE_NAME_, 
                     DATE_, PERSON_ID_, ENCOUNTER_ID_,
@@ -28,7 +29,9 @@ from config import (actual_keys_in_data,
                     VALUE_NUMERIC_,
                     DRUG_NAME_,
                     VALUE_NAME_)
-from data_storage import DataStorage
+from data_storage import DataStorage, BASE_DIR
+import projection
+from db_services import DataFetcher
 import os
 
 external_stylesheets = ['https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css']
@@ -45,6 +48,16 @@ app = dash.Dash(
                 )
 server = app.server
 
+@server.before_request
+def start_refresh_watcher():
+    # each gunicorn worker warms its query cache in the background after every data refresh
+    DataStorage.start_refresh_watcher()
+
+@server.teardown_request
+def release_serving(exc):
+    # the serving database a request read may be detached once no request reads it
+    DataStorage.release_serving(exc)
+
 # Define the layout
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
@@ -100,7 +113,7 @@ def update_nav_links(url_params):
     location = url_params.get('Location', [None])[0] if url_params else None
     uuid = url_params.get('uuid', [None])[0] if url_params else None
     query = f"?Location={location}&uuid={uuid}" if location and uuid else f"?Location={location}" if location else f"?uuid={uuid}" if uuid else ""
-    path = os.getcwd()
+    path = BASE_DIR
     json_path = os.path.join(path, 'data','TimeStamp.csv')
     last_updated = pd.read_csv(json_path)['saving_time'].to_list()[0]
 
@@ -158,7 +171,8 @@ def api_root():
                 "datasets": "/api/datasets",
                 "reports": "/api/reports",
                 "indicators": "/api/indicators",
-                "data_elements": "/api/dataElements"
+                "data_elements": "/api/dataElements",
+                "ingest_runs": "/api/ingest/runs"
             }
         })
     
@@ -171,7 +185,7 @@ def get_reports_list():
         return jsonify({"error": "Unauthorized, Please supply id"}), 403
 
     try:
-        path = os.getcwd()
+        path = BASE_DIR
         reports_json = os.path.join(path, 'data', 'hmis_reports.json')
         with open(reports_json, "r") as f:
             json_data = json.load(f)
@@ -227,7 +241,7 @@ def get_report_dataset():
             return jsonify({"error": "Unauthorized, Please supply id"}), 403
 
         # Load Report Specs
-        path = os.getcwd()
+        path = BASE_DIR
         reports_json = os.path.join(path, 'data', 'hmis_reports.json')
         with open(reports_json, "r") as f:
             json_data = json.load(f)
@@ -238,21 +252,14 @@ def get_report_dataset():
             return jsonify({"error": "Report Not Found"}), 404
 
         # Load Data
-        parquet_path = os.path.join(path, 'data', 'latest_data_opd.parquet')
-        if not os.path.exists(parquet_path):
+        if not DataStorage.data_exists():
             return jsonify({"error": "Data file not found"}), 500
         
-        SQL = f"""
-            SELECT *
-            FROM 'data/{DATA_FILE_NAME_}'
-            WHERE {FACILITY_CODE_} = '{facility_id}'
-            """
-        data = DataStorage.query_duckdb(SQL)
-        data[DATE_] = pd.to_datetime(data[DATE_], format='mixed')
-        data[GENDER_] = data[GENDER_].replace({"M":"Male","F":"Female"})
-        data["DateValue"] = pd.to_datetime(data[DATE_]).dt.date
-        today = dt.today().date()
-        data["months"] = data["DateValue"].apply(lambda d: (today - d).days // 30)
+        # rows after end_date are never used: the report looks back from it
+        columns = projection.hmis_report_columns(DataStorage.store_columns(), reports_json,
+                                                 os.path.join(path, 'data', 'uploads'))
+        data = DataStorage.query_facility('facility_until', facility_id, end=end_date, columns=columns)
+        # Date, Gender, DateValue and months come typed/derived from the store
 
         filtered = data[
             (pd.to_datetime(data['Date']) >= pd.to_datetime(start_date)) &
@@ -260,7 +267,7 @@ def get_report_dataset():
         ]
         
         original_data = data[data['Date'] <= pd.to_datetime(end_date)].copy()
-        original_data["days_before"] = original_data["DateValue"].apply(lambda d: (start_date - d).days)
+        original_data["days_before"] = (pd.Timestamp(start_date) - original_data["DateValue"]).dt.days
         # Build Report
         spec_path = os.path.join(path, "data", "uploads", f"{report['page_name']}.xlsx")
         if not os.path.exists(spec_path):
@@ -320,6 +327,46 @@ def get_report_dataset():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@server.route(f'/api/ingest/runs', methods=['GET'])
+# example: http://localhost:8050/api/ingest/runs?uuid=1&limit=10  or  ...&run_id=20260101T020000000000
+# with DATA_SOURCES add &source=<name> for that source's runs
+def get_ingest_runs():
+    # Read-only view of the data refresh run reports (data/run_reports.jsonl), newest first
+    uuid_param = request.args.get('uuid')
+    allowed_uuids = ["m3his@dhd"]  # Example list of allowed UUIDs
+    if uuid_param not in allowed_uuids:
+        return jsonify({"error": "Unauthorized, Please supply id"}), 403
+
+    try:
+        report_dir = os.path.join(BASE_DIR, 'data')
+        source = request.args.get('source')
+        if source:
+            if source not in [s['name'] for s in DATA_SOURCES]:
+                return jsonify({"error": "Source Not Found"}), 404
+            report_dir = os.path.join(report_dir, 'sources', source)
+        reports = DataFetcher.run_reports(os.path.join(report_dir, 'run_reports.jsonl'))
+        run_id = request.args.get('run_id')
+        if run_id:
+            report = next((r for r in reports if r['run_id'] == run_id), None)
+            if report is None:
+                return jsonify({"error": "Run Not Found"}), 404
+            return jsonify(report)
+
+        limit = int(request.args.get('limit', 20))
+        runs = []
+        for report in reversed(reports[-limit:] if limit > 0 else reports):
+            days = report.get('days', {})
+            # the per-day detail is only returned for a single run; list the slowest days instead
+            slowest = sorted(days.items(), key=lambda d: -(d[1]['sql_seconds'] + d[1]['transfer_seconds']
+                                                           + d[1]['write_seconds']))[:5]
+            summary = {k: v for k, v in report.items() if k != 'days'}
+            summary['slowest_days'] = [dict(day=day, **metrics) for day, metrics in slowest]
+            runs.append(summary)
+        return jsonify({"runs": runs})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # Run the app
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8050, debug=True,)
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+Ingest throughput benchmark for DataFetcher.fetch_data against the SQLite OpenMRS stand-in.
+
+For each size, seeds (or reuses) a stand-in database with that many obs rows between
+START_DATE and today, then runs a full fetch_data of QERY into a fresh store in a child
+process and reports rows/sec and the child's peak RSS. Each measurement gets its own
+process so peak RSS is not carried over from seeding or from the previous size.
+
+    python benchmarks/ingest_throughput.py --rows 1000000 10000000 50000000 --streaming
+    python benchmarks/ingest_throughput.py --rows 1000000 --workers 4 --partitioned
+"""
+import argparse
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import duckdb
+import config_defaults  # noqa: F401  (defaults for settings an older config.py lacks)
+from config import QERY, START_DATE, ARROW_BATCH_ROWS
+from db_services import DataFetcher
+from openmrs_standin import connect, seed
+
+
+def measure(db_path, args):
+    """Run one fetch_data into a temporary store; returns the metrics of the run"""
+    with tempfile.TemporaryDirectory() as tmp:
+        fetcher = DataFetcher(connection_factory=functools.partial(connect, db_path),
+                              streaming=args.streaming, arrow_batch_rows=ARROW_BATCH_ROWS,
+                              parallel_workers=args.workers, partitioned=args.partitioned,
+                              sorted_layout=args.sorted_layout,
+                              state_dir=os.path.join(tmp, "data"))
+        # keep batches, checkpoints, run reports and timestamps of the run out of the repository's data/
+        fetcher.path = tmp
+        store = os.path.join(tmp, "data", "store.parquet")
+
+        started = time.perf_counter()
+        fetcher.fetch_data(QERY, filename=store, date_column='Date', batch_size=50000, force_rebuild=True)
+        seconds = time.perf_counter() - started
+
+        store_path = fetcher._store_path(store)
+        source = f"{store_path}/*/*/*.parquet" if os.path.isdir(store_path) else store_path
+        rows = duckdb.sql(f"SELECT count(*) FROM read_parquet('{source}', union_by_name=true)").fetchone()[0]
+    totals = fetcher.run_report['totals']
+    return {
+        'rows': rows,
+        'sql_seconds': totals['sql_seconds'],
+        'transfer_seconds': totals['transfer_seconds'],
+        'write_seconds': totals['write_seconds'],
+        'merge_seconds': fetcher.run_report['phases'].get('merge', 0),
+        'seconds': round(seconds, 2),
+        'rows_per_sec': round(rows / seconds) if seconds else None,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000, 10_000_000, 50_000_000])
+    parser.add_argument('--work-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '.work'),
+                        help='where seeded stand-in databases are kept and reused between runs')
+    parser.add_argument('--streaming', action='store_true', help='STREAM_EXTRACTION')
+    parser.add_argument('--workers', type=int, default=1, help='EXTRACTION_WORKERS')
+    parser.add_argument('--partitioned', action='store_true', help='PARTITIONED_STORE')
+    parser.add_argument('--sorted-layout', action='store_true', help='SORTED_LAYOUT')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args)))
+        return
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    end_date = date.today().isoformat()
+    print(f"fetch_data of QERY, {START_DATE}..{end_date}, streaming={args.streaming} workers={args.workers} "
+          f"partitioned={args.partitioned} sorted_layout={args.sorted_layout}")
+    print(f"{'obs rows':>12}{'rows out':>12}{'seconds':>10}{'rows/sec':>12}{'peak RSS MB':>13}"
+          f"{'sql s':>9}{'transfer s':>12}{'write s':>9}{'merge s':>9}")
+    for obs_rows in args.rows:
+        db_path = os.path.join(args.work_dir, f"openmrs_{obs_rows}_{START_DATE}_{end_date}.sqlite")
+        if not os.path.exists(db_path):
+            seed(f"{db_path}.tmp", obs_rows, START_DATE, end_date)
+            os.replace(f"{db_path}.tmp", db_path)
+
+        child = [sys.executable, os.path.abspath(__file__), '--measure', db_path, '--workers', str(args.workers)]
+        child += [flag for flag, on in (('--streaming', args.streaming), ('--partitioned', args.partitioned),
+                                        ('--sorted-layout', args.sorted_layout)) if on]
+        result = subprocess.run(child, capture_output=True, text=True, check=True)
+        metrics = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f"{obs_rows:>12,}{metrics['rows']:>12,}{metrics['seconds']:>10}"
+              f"{metrics['rows_per_sec']:>12,}{metrics['peak_rss_mb']:>13}{metrics['sql_seconds']:>9}"
+              f"{metrics['transfer_seconds']:>12}{metrics['write_seconds']:>9}{metrics['merge_seconds']:>9}")
+
+
+if __name__ == '__main__':
+    main()
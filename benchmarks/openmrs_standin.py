@@ -0,0 +1,302 @@
+"""
+Synthetic OpenMRS database in SQLite, a local stand-in for the MaHIS MySQL server.
+
+Creates the tables QERY joins (person, patient, person_name, person_address, encounter,
+encounter_type, program, users, location, obs, concept, concept_name, drug) with realistic
+cardinalities, and registers the MySQL functions QERY uses (DATEDIFF, FLOOR), so the
+production query runs unchanged. connect() returns a DB-API connection that DataFetcher
+accepts as its connection_factory:
+
+    python benchmarks/openmrs_standin.py data/standin.sqlite --obs-rows 1000000
+
+    fetcher = DataFetcher(connection_factory=functools.partial(connect, 'data/standin.sqlite'))
+"""
+import argparse
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from pymysql.constants import FIELD_TYPE
+
+SCHEMA = """
+CREATE TABLE person (person_id INTEGER PRIMARY KEY, gender TEXT, birthdate TEXT, voided INTEGER);
+CREATE TABLE patient (patient_id INTEGER PRIMARY KEY);
+CREATE TABLE person_name (person_name_id INTEGER PRIMARY KEY, person_id INTEGER, given_name TEXT, family_name TEXT);
+CREATE TABLE person_address (person_address_id INTEGER PRIMARY KEY, person_id INTEGER, state_province TEXT,
+                             township_division TEXT, city_village TEXT);
+CREATE TABLE location (location_id INTEGER PRIMARY KEY, name TEXT, city_village TEXT);
+CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, location_id INTEGER);
+CREATE TABLE program (program_id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE encounter_type (encounter_type_id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE encounter (encounter_id INTEGER PRIMARY KEY, patient_id INTEGER, encounter_type INTEGER,
+                        program_id INTEGER, creator INTEGER, encounter_datetime TEXT, date_changed TEXT);
+CREATE TABLE concept (concept_id INTEGER PRIMARY KEY, uuid TEXT);
+CREATE TABLE concept_name (concept_name_id INTEGER PRIMARY KEY, concept_id INTEGER, name TEXT, locale TEXT,
+                           concept_name_type TEXT);
+CREATE TABLE drug (drug_id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE obs (obs_id INTEGER PRIMARY KEY, encounter_id INTEGER, concept_id INTEGER, value_coded INTEGER,
+                  value_text TEXT, value_numeric REAL, value_drug INTEGER, voided INTEGER, date_created TEXT,
+                  date_voided TEXT);
+"""
+
+# created after loading; DATE(encounter_datetime) matches the daily date_filter so days are index lookups
+INDEXES = """
+CREATE INDEX person_name_person ON person_name (person_id);
+CREATE INDEX person_address_person ON person_address (person_id);
+CREATE INDEX encounter_day ON encounter (DATE(encounter_datetime));
+CREATE INDEX obs_encounter ON obs (encounter_id);
+CREATE INDEX concept_name_concept ON concept_name (concept_id);
+CREATE INDEX concept_uuid ON concept (uuid);
+"""
+
+PROGRAMS = ['OPD Program', 'NCD Program', 'HIV Program', 'Maternal Health', 'Under Five', 'TB Program']
+ENCOUNTER_TYPES = ['REGISTRATION', 'VITALS', 'DIAGNOSIS', 'TREATMENT', 'DISPENSING', 'APPOINTMENT',
+                   'LAB RESULTS', 'OUTCOME']
+DISTRICTS = ['Lilongwe', 'Blantyre', 'Zomba', 'Mzuzu', 'Kasungu', 'Mangochi', 'Salima', 'Dedza']
+GIVEN_NAMES = ['Chikondi', 'Mphatso', 'Thoko', 'Kondwani', 'Tiyamike', 'Limbani', 'Chisomo', 'Yamikani']
+FAMILY_NAMES = ['Banda', 'Phiri', 'Mwale', 'Chirwa', 'Tembo', 'Nkhoma', 'Gondwe', 'Kaunda']
+
+OBS_PER_ENCOUNTER = 8
+ENCOUNTERS_PER_PERSON = 3
+CONCEPTS = 400
+DRUGS = 120
+FACILITIES = 40
+CHUNK_ROWS = 500_000
+
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+DATETIME_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$")
+# MySQL resolves ORDER BY against the select list; SQLite finds e.encounter_id and o.encounter_id ambiguous
+TRAILING_ORDER_BY = re.compile(r"^(.*)\sORDER BY\s+(\w+)(\s+LIMIT\s+\d+)?\s*$", re.DOTALL | re.IGNORECASE)
+
+
+def _datediff(end, start):
+    """MySQL DATEDIFF(end, start): whole days between the date parts"""
+    if end is None or start is None:
+        return None
+    return (date.fromisoformat(str(end)[:10]) - date.fromisoformat(str(start)[:10])).days
+
+
+def _floor(value):
+    return None if value is None else math.floor(value)
+
+
+def _mysql_dialect(query):
+    """Rewrite a trailing ORDER BY <column> [LIMIT n] to sort the result columns, as MySQL would"""
+    match = TRAILING_ORDER_BY.match(query)
+    if match is None:
+        return query
+    body, column, limit = match.groups()
+    return f'SELECT * FROM ({body}) ORDER BY "{column}"{limit or ""}'
+
+
+def _field_type(value):
+    """MySQL type code a server would report for a value (what _arrow_schema_from_cursor maps)"""
+    if isinstance(value, bool) or isinstance(value, int):
+        return FIELD_TYPE.LONGLONG
+    if isinstance(value, float):
+        return FIELD_TYPE.DOUBLE
+    if isinstance(value, str) and DATE_PATTERN.match(value):
+        return FIELD_TYPE.DATE
+    if isinstance(value, str) and DATETIME_PATTERN.match(value):
+        return FIELD_TYPE.DATETIME
+    return FIELD_TYPE.VAR_STRING
+
+
+class StandInCursor:
+    """sqlite3 cursor with pymysql's context manager protocol and MySQL type codes in description"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._peeked = []
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def execute(self, query, *args):
+        self._cursor.execute(_mysql_dialect(query), *args)
+        self._peeked = []
+        if self._cursor.description is None:
+            self.description = None
+            return self
+        # type codes come from the first row, like a server's column metadata would
+        first = self._cursor.fetchone()
+        self._peeked = [first] if first is not None else []
+        self.description = [(column[0], _field_type(first[i]) if first is not None else FIELD_TYPE.VAR_STRING,
+                             None, None, None, None, True)
+                            for i, column in enumerate(self._cursor.description)]
+        return self
+
+    def fetchmany(self, size):
+        rows, self._peeked = self._peeked, []
+        rows += self._cursor.fetchmany(size - len(rows))
+        return rows
+
+    def fetchall(self):
+        rows, self._peeked = self._peeked, []
+        return rows + self._cursor.fetchall()
+
+    def fetchone(self):
+        if self._peeked:
+            return self._peeked.pop()
+        return self._cursor.fetchone()
+
+    def close(self):
+        self._cursor.close()
+
+
+class StandInConnection:
+    """DB-API connection over the stand-in database; cursor classes (e.g. SSCursor) are accepted and ignored"""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.create_function("DATEDIFF", 2, _datediff, deterministic=True)
+        self._conn.create_function("FLOOR", 1, _floor, deterministic=True)
+
+    def cursor(self, cursor_class=None):
+        return StandInCursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+def connect(path):
+    """Open the stand-in database at path (a DataFetcher connection_factory once bound with functools.partial)"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No stand-in database at {path}; seed it first")
+    return StandInConnection(path)
+
+
+def _insert(conn, table, frame):
+    placeholders = ", ".join("?" for _ in frame.columns)
+    conn.executemany(f"INSERT INTO {table} ({', '.join(frame.columns)}) VALUES ({placeholders})",
+                     frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None))
+
+
+def seed(path, obs_rows, start_date, end_date, seed=0):
+    """
+    Create the stand-in database at path with about obs_rows obs rows (the number of rows QERY
+    returns) spread over encounters between start_date and end_date. Returns the obs row count.
+    """
+    rng = np.random.default_rng(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript("PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;" + SCHEMA)
+
+    encounters = max(1, math.ceil(obs_rows / OBS_PER_ENCOUNTER))
+    persons = max(1, encounters // ENCOUNTERS_PER_PERSON)
+    days = pd.date_range(start_date, end_date, freq='D')
+
+    # dimensions
+    _insert(conn, 'location', pd.DataFrame({
+        'location_id': np.arange(1, FACILITIES + 1),
+        'name': [f"Health Centre {i}" for i in range(1, FACILITIES + 1)],
+        'city_village': [DISTRICTS[i % len(DISTRICTS)] for i in range(FACILITIES)]}))
+    _insert(conn, 'users', pd.DataFrame({
+        'user_id': np.arange(1, FACILITIES + 1),
+        'username': [f"clerk{i}" for i in range(1, FACILITIES + 1)],
+        'location_id': np.arange(1, FACILITIES + 1)}))
+    _insert(conn, 'program', pd.DataFrame({'program_id': np.arange(1, len(PROGRAMS) + 1), 'name': PROGRAMS}))
+    _insert(conn, 'encounter_type', pd.DataFrame({
+        'encounter_type_id': np.arange(1, len(ENCOUNTER_TYPES) + 1), 'name': ENCOUNTER_TYPES}))
+    concept_ids = np.arange(1, CONCEPTS + 1)
+    _insert(conn, 'concept', pd.DataFrame({'concept_id': concept_ids,
+                                           'uuid': [f"concept-uuid-{i:06d}" for i in concept_ids]}))
+    _insert(conn, 'concept_name', pd.DataFrame({
+        'concept_id': concept_ids, 'name': [f"Concept {i}" for i in concept_ids],
+        'locale': 'en', 'concept_name_type': 'FULLY_SPECIFIED'}))
+    _insert(conn, 'drug', pd.DataFrame({'drug_id': np.arange(1, DRUGS + 1),
+                                        'name': [f"Drug {i}" for i in range(1, DRUGS + 1)]}))
+
+    # people
+    for offset in range(0, persons, CHUNK_ROWS):
+        ids = np.arange(offset + 1, min(offset + CHUNK_ROWS, persons) + 1)
+        n = len(ids)
+        birthdays = pd.Timestamp(end_date) - pd.to_timedelta(rng.integers(0, 90 * 365, n), unit='D')
+        _insert(conn, 'person', pd.DataFrame({'person_id': ids, 'gender': rng.choice(['M', 'F'], n),
+                                              'birthdate': birthdays.strftime('%Y-%m-%d'), 'voided': 0}))
+        _insert(conn, 'patient', pd.DataFrame({'patient_id': ids}))
+        _insert(conn, 'person_name', pd.DataFrame({
+            'person_id': ids, 'given_name': rng.choice(GIVEN_NAMES, n), 'family_name': rng.choice(FAMILY_NAMES, n)}))
+        district = rng.integers(0, len(DISTRICTS), n)
+        _insert(conn, 'person_address', pd.DataFrame({
+            'person_id': ids, 'state_province': np.array(DISTRICTS)[district],
+            'township_division': [f"TA {d}-{t}" for d, t in zip(district, rng.integers(1, 6, n))],
+            'city_village': [f"Village {v}" for v in rng.integers(1, 200, n)]}))
+
+    # encounters in date order, so encounter_id grows with encounter_datetime like in production
+    for offset in range(0, encounters, CHUNK_ROWS):
+        ids = np.arange(offset + 1, min(offset + CHUNK_ROWS, encounters) + 1)
+        n = len(ids)
+        day_index = (ids - 1) * len(days) // encounters
+        moments = days[day_index] + pd.to_timedelta(rng.integers(7 * 3600, 17 * 3600, n), unit='s')
+        _insert(conn, 'encounter', pd.DataFrame({
+            'encounter_id': ids, 'patient_id': rng.integers(1, persons + 1, n),
+            'encounter_type': rng.integers(1, len(ENCOUNTER_TYPES) + 1, n),
+            'program_id': rng.integers(1, len(PROGRAMS) + 1, n), 'creator': rng.integers(1, FACILITIES + 1, n),
+            'encounter_datetime': moments.strftime('%Y-%m-%d %H:%M:%S'),
+            'date_changed': moments.strftime('%Y-%m-%d %H:%M:%S')}))
+
+    # obs: coded, numeric, text (half of them concept uuids) and drug values
+    for offset in range(0, obs_rows, CHUNK_ROWS):
+        ids = np.arange(offset + 1, min(offset + CHUNK_ROWS, obs_rows) + 1)
+        n = len(ids)
+        kind = rng.random(n)
+        coded, numeric, text = kind < 0.4, (kind >= 0.4) & (kind < 0.7), (kind >= 0.7) & (kind < 0.9)
+        uuid_text = text & (rng.random(n) < 0.5)
+        values_text = np.where(uuid_text, pd.Series(rng.integers(1, CONCEPTS + 1, n)).map("concept-uuid-{:06d}".format),
+                               pd.Series(rng.integers(1, 50, n)).map("free text {}".format))
+        encounter_ids = np.minimum((ids - 1) // OBS_PER_ENCOUNTER + 1, encounters)
+        _insert(conn, 'obs', pd.DataFrame({
+            'obs_id': ids, 'encounter_id': encounter_ids, 'concept_id': rng.integers(1, CONCEPTS + 1, n),
+            'value_coded': np.where(coded, rng.integers(1, CONCEPTS + 1, n), None),
+            'value_text': np.where(text, values_text, None),
+            'value_numeric': np.where(numeric, np.round(rng.random(n) * 200, 1), None),
+            'value_drug': np.where(~(coded | numeric | text), rng.integers(1, DRUGS + 1, n), None),
+            'voided': 0, 'date_created': days[(encounter_ids - 1) * len(days) // encounters].strftime('%Y-%m-%d 12:00:00'),
+            'date_voided': None}))
+        conn.commit()
+
+    conn.executescript(INDEXES)
+    conn.commit()
+    conn.close()
+    return obs_rows
+
+
+def main():
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from config import START_DATE
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path')
+    parser.add_argument('--obs-rows', type=int, default=1_000_000)
+    parser.add_argument('--start-date', default=START_DATE)
+    parser.add_argument('--end-date', default=date.today().isoformat())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    seed(args.path, args.obs_rows, args.start_date, args.end_date, seed=args.seed)
+    print(f"Seeded {args.obs_rows:,} obs rows into {args.path} in {time.perf_counter() - started:.1f}s "
+          f"({os.path.getsize(args.path) / 1e6:.0f} MB)")
+
+
+if __name__ == '__main__':
+    main()
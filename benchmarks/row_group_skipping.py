@@ -0,0 +1,103 @@
+"""
+Row group skipping benchmark for the parquet storage layouts.
+
+Writes the same synthetic OPD-shaped data three ways (default writer, unsorted with the
+SORTED_LAYOUT row group size, and the sorted layout) and reports, for a single-facility
+query, how many row groups DuckDB can skip from the Facility_CODE min/max statistics
+and how long the query takes.
+
+    python benchmarks/row_group_skipping.py --rows 2000000 --facilities 60
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from db_services import DataFetcher
+
+
+def synthetic_frame(rows, facilities, days=90, seed=7):
+    """Rows in encounter order, i.e. facilities interleaved the way extraction writes them"""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('2025-01-01') + pd.to_timedelta(np.sort(rng.integers(0, days, rows)), unit='D')
+    return pd.DataFrame({
+        'person_id': rng.integers(1, rows // 5 + 2, rows),
+        'encounter_id': np.arange(1, rows + 1),
+        'Date': dates.date,
+        'Facility_CODE': rng.integers(1, facilities + 1, rows),
+        'Facility': pd.Series(rng.integers(1, facilities + 1, rows)).map('Facility {}'.format),
+        'Gender': rng.choice(['M', 'F'], rows),
+        'Age': rng.integers(0, 90, rows),
+        'concept_name': pd.Series(rng.integers(0, 300, rows)).map('Concept {}'.format),
+        'ValueN': np.where(rng.random(rows) < 0.3, rng.random(rows) * 100, np.nan),
+    })
+
+
+def row_groups_read(path, facility_code):
+    """(row groups whose Facility_CODE statistics can contain the code, total row groups)"""
+    metadata = pq.ParquetFile(path).metadata
+    index = metadata.schema.to_arrow_schema().get_field_index('Facility_CODE')
+    read = 0
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(index).statistics
+        if stats is None or not stats.has_min_max or stats.min <= facility_code <= stats.max:
+            read += 1
+    return read, metadata.num_row_groups
+
+
+def query_seconds(path, facility_code, repeat=5):
+    """Best-of-N time of a single-facility dashboard style query"""
+    con = duckdb.connect()
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        con.execute(f"SELECT count(*), count(DISTINCT person_id) FROM '{path}' "
+                    f"WHERE Facility_CODE = {facility_code} AND Date >= DATE '2025-02-01'").fetchall()
+        best = min(best, time.perf_counter() - started)
+    con.close()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--facilities', type=int, default=50)
+    parser.add_argument('--row-group-rows', type=int, default=122880)
+    parser.add_argument('--facility', type=int, default=7, help='Facility_CODE queried')
+    args = parser.parse_args()
+
+    df = synthetic_frame(args.rows, args.facilities)
+    default = DataFetcher(use_localhost=True)
+    sorted_layout = DataFetcher(use_localhost=True, sorted_layout=True, row_group_rows=args.row_group_rows)
+
+    def unsorted_sized(frame, path):
+        # same row group sizing as the sorted layout, rows left in extraction order
+        table = default._conform_table(pa.Table.from_pandas(frame, preserve_index=False))
+        pq.write_table(table, path, row_group_size=args.row_group_rows)
+
+    layouts = {
+        'default writer': default.write_parquet,
+        'unsorted, sized row groups': unsorted_sized,
+        'sorted layout': sorted_layout.write_parquet,
+    }
+
+    print(f"{args.rows:,} rows, {args.facilities} facilities, query Facility_CODE = {args.facility}")
+    print(f"{'layout':<28}{'size MB':>9}{'row groups read':>18}{'skipped':>9}{'query ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (name, write) in enumerate(layouts.items()):
+            path = os.path.join(tmp, f"layout_{i}.parquet")
+            write(df, path)
+            read, total = row_groups_read(path, args.facility)
+            print(f"{name:<28}{os.path.getsize(path) / 1e6:>9.1f}{f'{read}/{total}':>18}"
+                  f"{total - read:>9}{query_seconds(path, args.facility) * 1000:>10.1f}")
+
+if __name__ == '__main__':
+    main()
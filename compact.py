@@ -0,0 +1,42 @@
+# compact.py
+"""
+Merge the small parquet files appending refreshes leave in the store.
+
+    python compact.py            # compact data/latest_data_opd(.parquet)
+    python compact.py --min-files 2
+
+Needs SNAPSHOTS: the merged store is published as a new snapshot, so readers never see it mid-merge.
+Prints the run's metrics as JSON; they are also appended to data/compaction_metrics.jsonl.
+"""
+import argparse
+import json
+import sys
+from data_storage import DataStorage
+import config_defaults  # noqa: F401  (defaults for settings an older config.py lacks)
+from config import DATA_FILE_NAME_, COMPACTION_MIN_FILES, COMPACTION_MIN_ROW_GROUP_ROWS, SNAPSHOTS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact the parquet store")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--filename", default=DATA_FILE_NAME_)
+    parser.add_argument("--min-files", type=int, default=COMPACTION_MIN_FILES,
+                        help="merge partitions with at least this many files")
+    parser.add_argument("--min-row-group-rows", type=int, default=COMPACTION_MIN_ROW_GROUP_ROWS,
+                        help="rewrite files whose row groups average fewer rows than this")
+    args = parser.parse_args(argv)
+    if not SNAPSHOTS:
+        print("Compaction needs SNAPSHOTS = True in config.py", file=sys.stderr)
+        return 1
+
+    storage = DataStorage(data_dir=args.data_dir, filename=args.filename)
+    metrics = storage.compact(min_files=args.min_files, min_row_group_rows=args.min_row_group_rows)
+    if metrics is None:
+        print("Store is being refreshed; compaction skipped")
+        return 0
+    print(json.dumps(metrics, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
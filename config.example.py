@@ -1,10 +1,37 @@
 import os
+import pyarrow as pa
 
 USE_LOCALHOST = True
 START_DATE = '2025-12-01'
 LOAD_FRESH_DATA = False # Set to True to always start from START_DATE and fetch fresh data. Not recommended for large datasets.
 PREFIX_NAME = '/'  # Set to your desired prefix for https paths, e.g., '/myapp'
 
+# DATA EXTRACTION
+STREAM_EXTRACTION = False # Set to True to stream each day through a server-side cursor into parquet. Keeps memory flat on busy days.
+ARROW_BATCH_ROWS = 50000 # Rows per Arrow record batch written when STREAM_EXTRACTION is on
+EXTRACTION_WORKERS = 1 # Concurrent DB connections for backfills (all share one SSH tunnel). 1 = sequential
+EXTRACTION_DAYS_PER_TASK = 7 # Days handed to a worker at a time when EXTRACTION_WORKERS > 1
+PARTITIONED_STORE = False # Store data as data/latest_data_opd/year_month=YYYY-MM/Facility_CODE=X/*.parquet. Refreshes rewrite only touched partitions
+CDC_MODE = False # After one baseline load, fetch only new/changed obs past stored watermarks (data/cdc_state.json) and delete voided obs. Use a fresh load when switching on
+CDC_LOOKBACK_MINUTES = 10 # Overlap re-read on CDC timestamp watermarks to catch late commits
+SORTED_LAYOUT = False # Write the store sorted by (Facility_CODE, Date, encounter_id), zstd-compressed, so facility/date filters skip row groups
+PARQUET_ROW_GROUP_ROWS = 122880 # Rows per row group with SORTED_LAYOUT. Smaller = finer skipping for small facilities, larger = better compression
+STAR_SCHEMA = False # After each refresh publish data/latest_data_opd_star/ (narrow fact + person/location/concept dimensions). Pages read it through a view with the same columns
+LOCAL_VISIT_DAYS = True # Maintain visit_days/new_revisit and first/last visit per person locally (data/latest_data_opd_visits/) from ingested encounters. They replace any visit_days/new_revisit QERY still selects
+SNAPSHOTS = False # Publish every refresh as a write-once data/snapshots/<id>/ (hard links) and swap data/snapshots/CURRENT. Each request reads one snapshot
+SNAPSHOT_RETENTION = 3 # Published snapshots kept on disk, including the current one
+COMPACTION_MIN_FILES = 4 # Partitions with at least this many files (left by appending refreshes) get merged into one by compact.py (needs SNAPSHOTS; skipped otherwise)
+COMPACTION_MIN_ROW_GROUP_ROWS = 12288 # Files whose row groups average fewer rows than this also get rewritten by compact.py
+QUERY_CACHE_MB = 256 # Memory per worker for cached DuckDB page query results (least recently used dropped first), keyed by SQL + parameters + data version
+DUCKDB_THREADS = 2 # Threads of each worker's DuckDB database (shared by the worker's request threads)
+DUCKDB_MEMORY_LIMIT = '1GB' # Memory limit of each worker's DuckDB database
+ARROW_SNAPSHOT = False # After each refresh write data/arrow/<id>.arrow (uncompressed Arrow IPC, sorted by facility/date) that every worker memory-maps; facility frames are sliced from it instead of each worker caching its own copies
+SERVING_DB = False # After each refresh build data/serving/<id>.duckdb (obs clustered by facility/date, indexed on person_id/encounter_id) that pages query read-only instead of the parquet store
+WARM_FACILITIES = 10 # After each refresh every worker pre-runs the facility frame and today's dashboard query of this many hot facilities
+WARM_POLL_SECONDS = 15 # How often workers check data/refresh_event.json for a new refresh
+RUN_REPORT_HISTORY = 200 # fetch_data run reports (per-day timings, rows, bytes, retries) kept in data/run_reports.jsonl, served at /api/ingest/runs
+USERS_FILE_FORMAT = "parquet" # Format of the users/roles table written each refresh: "parquet" (compact, typed) or "csv". Pages read whichever is present, parquet first
+
 
 RELATIVE_DAYS = [ 'Today', 'Yesterday', 'Last 7 Days', 'Last 30 Days', 'This Week', 'Last Week', 'This Month', 'Last Month' ]
 
@@ -35,6 +62,28 @@ ORDER_NAME_ = 'Order_Name'
 PROGRAM_ = 'Program'
 ENCOUNTER_ = 'Encounter'
 
+# STORAGE SCHEMA - ARROW TYPES APPLIED ON EVERY PARQUET WRITE. COLUMNS NOT LISTED KEEP THE TYPE THE QUERY RETURNS
+CATEGORY_ = pa.dictionary(pa.int32(), pa.string()) # dictionary-encoded text, read back by pandas as category
+DATA_SCHEMA = {
+    PERSON_ID_: pa.int64(),
+    ENCOUNTER_ID_: pa.int64(),
+    'obs_id': pa.int64(),
+    AGE_: pa.int32(),
+    DATE_: pa.date32(),
+    VALUE_NUMERIC_: pa.float64(),
+    FACILITY_: CATEGORY_,
+    PROGRAM_: CATEGORY_,
+    ENCOUNTER_: CATEGORY_,
+    CONCEPT_NAME_: CATEGORY_,
+    OBS_VALUE_CODED_: CATEGORY_,
+    GENDER_: CATEGORY_,
+    AGE_GROUP_: CATEGORY_,
+    NEW_REVISIT_: CATEGORY_,
+    HOME_DISTRICT_: CATEGORY_,
+    TA_: CATEGORY_,
+    VILLAGE_: CATEGORY_,
+}
+
 # HANDLE GLOBAL IMPORT OF DATA FROM PARQUET FILE AND MANAGE AS CACHE FILES
 PARQUET_FILE_PATH = os.path.join(os.getcwd(), 'data', 'latest_data_opd.parquet')
 CACHE_FILE_PATH = os.path.join(os.getcwd(), 'data', 'cache_opd.parquet')
@@ -68,6 +117,16 @@ SSH_CONFIG = {
     'remote_bind_address': ('path_to_db_endpoint', 3306)
 }
 
+# Several databases (e.g. one per district) served as one dataset. Each source is fetched concurrently
+# with its own SSH tunnel and recovery state into data/sources/<name>/; pages read all of them, rows tagged
+# with the source name in a `source` column. Leave empty to fetch the single DB_CONFIG/SSH_CONFIG database.
+# Every source needs a unique name plus db_config and ssh_config; a refresh with an incomplete entry fails up front.
+# DATA_SOURCES = [
+#     {'name': 'lilongwe', 'db_config': {...like DB_CONFIG...}, 'ssh_config': {...like SSH_CONFIG...}},
+#     {'name': 'mzimba', 'db_config': {...}, 'ssh_config': {...}},
+# ]
+DATA_SOURCES = []
+
 # on production remove COLLATE utf8mb3_general_ci
 QERY = """
 SELECT 
@@ -91,14 +150,18 @@ SELECT
         pa.state_province AS Home_district,
         pa.township_division AS TA,
         pa.city_village AS Village,
-        v.visit_days,
         cn.name AS obs_value_coded,
         c.name AS concept_name,
         o.value_text as Value,
         o.value_numeric as ValueN,
         d.name as DrugName,
         cnn.name as Value_name,
-        d.name as Order_Name
+        d.name as Order_Name,
+        o.obs_id,
+        o.voided AS obs_voided,
+        o.date_created AS obs_date_created,
+        o.date_voided AS obs_date_voided,
+        e.date_changed AS encounter_date_changed
     FROM person AS p
     JOIN patient AS pa2 ON p.person_id = pa2.patient_id
     JOIN person_name pn2 ON p.person_id = pn2.person_id
@@ -108,12 +171,6 @@ SELECT
     INNER JOIN program AS pr ON e.program_id = pr.program_id
     INNER JOIN users AS u ON e.creator = u.user_id
     INNER JOIN location AS l ON u.location_id = l.location_id
-    -- Join with precomputed visit days
-    JOIN (
-        SELECT patient_id, COUNT(DISTINCT DATE(encounter_datetime)) AS visit_days
-        FROM encounter
-        GROUP BY patient_id
-    ) AS v ON v.patient_id = p.person_id
     LEFT JOIN obs o ON o.encounter_id = e.encounter_id
     LEFT JOIN concept_name cn ON o.value_coded = cn.concept_id AND cn.locale = 'en' AND cn.concept_name_type = 'FULLY_SPECIFIED'
     LEFT JOIN concept_name c ON o.concept_id = c.concept_id
@@ -122,8 +179,6 @@ SELECT
     LEFT JOIN drug as d on o.value_drug = d.drug_id
     WHERE p.voided = 0
     {date_filter}
-) AS main
-
 """
 
 actual_keys_in_data = ['person_id', 'encounter_id', 
@@ -0,0 +1,400 @@
+import os
+import pyarrow as pa
+
+USE_LOCALHOST = True
+START_DATE = '2025-12-01'
+LOAD_FRESH_DATA = False # Set to True to always start from START_DATE and fetch fresh data. Not recommended for large datasets.
+PREFIX_NAME = '/'  # Set to your desired prefix for https paths, e.g., '/myapp'
+
+# DATA EXTRACTION
+STREAM_EXTRACTION = False # Set to True to stream each day through a server-side cursor into parquet. Keeps memory flat on busy days.
+ARROW_BATCH_ROWS = 50000 # Rows per Arrow record batch written when STREAM_EXTRACTION is on
+EXTRACTION_WORKERS = 1 # Concurrent DB connections for backfills (all share one SSH tunnel). 1 = sequential
+EXTRACTION_DAYS_PER_TASK = 7 # Days handed to a worker at a time when EXTRACTION_WORKERS > 1
+PARTITIONED_STORE = False # Store data as data/latest_data_opd/year_month=YYYY-MM/Facility_CODE=X/*.parquet. Refreshes rewrite only touched partitions
+CDC_MODE = False # After one baseline load, fetch only new/changed obs past stored watermarks (data/cdc_state.json) and delete voided obs. Use a fresh load when switching on
+CDC_LOOKBACK_MINUTES = 10 # Overlap re-read on CDC timestamp watermarks to catch late commits
+SORTED_LAYOUT = False # Write the store sorted by (Facility_CODE, Date, encounter_id), zstd-compressed, so facility/date filters skip row groups
+PARQUET_ROW_GROUP_ROWS = 122880 # Rows per row group with SORTED_LAYOUT. Smaller = finer skipping for small facilities, larger = better compression
+STAR_SCHEMA = False # After each refresh publish data/latest_data_opd_star/ (narrow fact + person/location/concept dimensions). Pages read it through a view with the same columns
+LOCAL_VISIT_DAYS = True # Maintain visit_days/new_revisit and first/last visit per person locally (data/latest_data_opd_visits/) from ingested encounters. They replace any visit_days/new_revisit QERY still selects
+SNAPSHOTS = False # Publish every refresh as a write-once data/snapshots/<id>/ (hard links) and swap data/snapshots/CURRENT. Each request reads one snapshot
+SNAPSHOT_RETENTION = 3 # Published snapshots kept on disk, including the current one
+COMPACTION_MIN_FILES = 4 # Partitions with at least this many files (left by appending refreshes) get merged into one by compact.py (needs SNAPSHOTS; skipped otherwise)
+COMPACTION_MIN_ROW_GROUP_ROWS = 12288 # Files whose row groups average fewer rows than this also get rewritten by compact.py
+QUERY_CACHE_MB = 256 # Memory per worker for cached DuckDB page query results (least recently used dropped first), keyed by SQL + parameters + data version
+DUCKDB_THREADS = 2 # Threads of each worker's DuckDB database (shared by the worker's request threads)
+DUCKDB_MEMORY_LIMIT = '1GB' # Memory limit of each worker's DuckDB database
+ARROW_SNAPSHOT = False # After each refresh write data/arrow/<id>.arrow (uncompressed Arrow IPC, sorted by facility/date) that every worker memory-maps; facility frames are sliced from it instead of each worker caching its own copies
+SERVING_DB = False # After each refresh build data/serving/<id>.duckdb (obs clustered by facility/date, indexed on person_id/encounter_id) that pages query read-only instead of the parquet store
+WARM_FACILITIES = 10 # After each refresh every worker pre-runs the facility frame and today's dashboard query of this many hot facilities
+WARM_POLL_SECONDS = 15 # How often workers check data/refresh_event.json for a new refresh
+RUN_REPORT_HISTORY = 200 # fetch_data run reports (per-day timings, rows, bytes, retries) kept in data/run_reports.jsonl, served at /api/ingest/runs
+USERS_FILE_FORMAT = "parquet" # Format of the users/roles table written each refresh: "parquet" (compact, typed) or "csv". Pages read whichever is present, parquet first
+
+
+RELATIVE_DAYS = [ 'Today', 'Yesterday', 'Last 7 Days', 'Last 30 Days', 'This Week', 'Last Week', 'This Month', 'Last Month' ]
+
+# REFERENTIAL COLUMNS - THESE SHOULD MATCH THE QUERY OUTPUT COLUMNS
+DATA_FILE_NAME_ = "latest_data_opd.parquet"
+
+FIRST_NAME_ = 'given_name'
+LAST_NAME_ = 'family_name'
+DATE_ = 'Date'
+PERSON_ID_ = 'person_id'
+ENCOUNTER_ID_ = 'encounter_id'
+FACILITY_ = 'Facility'
+AGE_GROUP_ = 'Age_Group'
+AGE_ = 'Age'
+GENDER_ = 'Gender'
+NEW_REVISIT_ = 'new_revisit'
+HOME_DISTRICT_ = 'Home_district'
+TA_ = 'TA'
+VILLAGE_ = 'Village'
+FACILITY_CODE_ = 'Facility_CODE'
+OBS_VALUE_CODED_ = 'obs_value_coded'
+CONCEPT_NAME_ = 'concept_name'
+VALUE_ = 'Value'
+VALUE_NUMERIC_ = 'ValueN'
+DRUG_NAME_ = 'DrugName'
+VALUE_NAME_ = 'Value_name'
+ORDER_NAME_ = 'Order_Name'
+PROGRAM_ = 'Program'
+ENCOUNTER_ = 'Encounter'
+
+# STORAGE SCHEMA - ARROW TYPES APPLIED ON EVERY PARQUET WRITE. COLUMNS NOT LISTED KEEP THE TYPE THE QUERY RETURNS
+CATEGORY_ = pa.dictionary(pa.int32(), pa.string()) # dictionary-encoded text, read back by pandas as category
+DATA_SCHEMA = {
+    PERSON_ID_: pa.int64(),
+    ENCOUNTER_ID_: pa.int64(),
+    'obs_id': pa.int64(),
+    AGE_: pa.int32(),
+    DATE_: pa.date32(),
+    VALUE_NUMERIC_: pa.float64(),
+    FACILITY_: CATEGORY_,
+    PROGRAM_: CATEGORY_,
+    ENCOUNTER_: CATEGORY_,
+    CONCEPT_NAME_: CATEGORY_,
+    OBS_VALUE_CODED_: CATEGORY_,
+    GENDER_: CATEGORY_,
+    AGE_GROUP_: CATEGORY_,
+    NEW_REVISIT_: CATEGORY_,
+    HOME_DISTRICT_: CATEGORY_,
+    TA_: CATEGORY_,
+    VILLAGE_: CATEGORY_,
+}
+
+# HANDLE GLOBAL IMPORT OF DATA FROM PARQUET FILE AND MANAGE AS CACHE FILES
+PARQUET_FILE_PATH = os.path.join(os.getcwd(), 'data', 'latest_data_opd.parquet')
+CACHE_FILE_PATH = os.path.join(os.getcwd(), 'data', 'cache_opd.parquet')
+TIMESTAMP_FILE_PATH = os.path.join(os.getcwd(), 'data', 'TimeStamp.csv')
+
+# For local database connection
+DB_CONFIG_LOCAL = {
+    'host': 'localhost',
+    'user': 'user',
+    'password': 'password',
+    'database': 'local_database',
+    'port': 3306
+}
+
+# for production database connection
+DB_CONFIG = {
+    'host': 'hostname',
+    'user': 'user',
+    'password': 'password',
+    'database': 'database',
+    'port': 3306
+}
+
+# SSH configuration for production database connection
+SSH_CONFIG = {
+    'ssh_host': 'aws_host',
+    'ssh_port': 22,
+    'ssh_user': 'ubuntu',
+    'ssh_password': 'password',  # OR use ssh_pkey if using key
+    # 'ssh_pkey': 'key.pem',  #private key name stored in ssh directory
+    'remote_bind_address': ('path_to_db_endpoint', 3306)
+}
+
+# Several databases (e.g. one per district) served as one dataset. Each source is fetched concurrently
+# with its own SSH tunnel and recovery state into data/sources/<name>/; pages read all of them, rows tagged
+# with the source name in a `source` column. Leave empty to fetch the single DB_CONFIG/SSH_CONFIG database.
+# Every source needs a unique name plus db_config and ssh_config; a refresh with an incomplete entry fails up front.
+# DATA_SOURCES = [
+#     {'name': 'lilongwe', 'db_config': {...like DB_CONFIG...}, 'ssh_config': {...like SSH_CONFIG...}},
+#     {'name': 'mzimba', 'db_config': {...}, 'ssh_config': {...}},
+# ]
+DATA_SOURCES = []
+
+# on production remove COLLATE utf8mb3_general_ci
+QERY = """
+SELECT 
+        p.person_id,
+        e.encounter_id,
+        pn2.given_name,
+        pn2.family_name,
+        gender AS Gender, 
+        FLOOR(DATEDIFF(e.encounter_datetime, birthdate) / 365) AS Age, 
+        CASE 
+            WHEN FLOOR(DATEDIFF(e.encounter_datetime, birthdate) / 365) < 5 THEN 'Under 5'
+            ELSE 'Over 5'
+        END AS Age_Group,
+        DATE(e.encounter_datetime) AS Date, 
+        pr.name AS Program, 
+        l.name AS Facility,
+        l.location_id AS Facility_CODE, 
+        u.username AS User, 
+        l.city_village AS District, 
+        et.name AS Encounter,
+        pa.state_province AS Home_district,
+        pa.township_division AS TA,
+        pa.city_village AS Village,
+        cn.name AS obs_value_coded,
+        c.name AS concept_name,
+        o.value_text as Value,
+        o.value_numeric as ValueN,
+        d.name as DrugName,
+        cnn.name as Value_name,
+        d.name as Order_Name,
+        o.obs_id,
+        o.voided AS obs_voided,
+        o.date_created AS obs_date_created,
+        o.date_voided AS obs_date_voided,
+        e.date_changed AS encounter_date_changed
+    FROM person AS p
+    JOIN patient AS pa2 ON p.person_id = pa2.patient_id
+    JOIN person_name pn2 ON p.person_id = pn2.person_id
+    JOIN person_address AS pa ON p.person_id = pa.person_id
+    JOIN encounter AS e ON p.person_id = e.patient_id
+    JOIN encounter_type AS et ON e.encounter_type = et.encounter_type_id
+    INNER JOIN program AS pr ON e.program_id = pr.program_id
+    INNER JOIN users AS u ON e.creator = u.user_id
+    INNER JOIN location AS l ON u.location_id = l.location_id
+    LEFT JOIN obs o ON o.encounter_id = e.encounter_id
+    LEFT JOIN concept_name cn ON o.value_coded = cn.concept_id AND cn.locale = 'en' AND cn.concept_name_type = 'FULLY_SPECIFIED'
+    LEFT JOIN concept_name c ON o.concept_id = c.concept_id
+    LEFT JOIN concept co ON o.value_text = co.uuid
+    LEFT JOIN concept_name cnn ON co.concept_id = cnn.concept_id
+    LEFT JOIN drug as d on o.value_drug = d.drug_id
+    WHERE p.voided = 0
+    {date_filter}
+"""
+
+actual_keys_in_data = ['person_id', 'encounter_id', 
+                                       'Gender', 'Age', 'Age_Group', 
+                                       'Date', 'Program', 'Facility', 
+                                       'Facility_CODE', 'User', 'District', 
+                                       'Encounter', 'Home_district', 'TA', 
+                                       'Village', 'visit_days', 'obs_value_coded','concept_name', 'Value',"",
+                                       'ValueN', 'DrugName', 'Value_name', 'new_revisit','count','count_set','sum','Order_Name']
+
+
+# TEST CONNECTION
+#!/usr/bin/env python3
+"""
+Database Connection Tester for Config
+"""
+
+import pymysql
+import paramiko
+from sshtunnel import SSHTunnelForwarder
+import socket
+import sys
+
+def test_local_connection():
+    """Test local database connection"""
+    try:
+        connection = pymysql.connect(
+            host=DB_CONFIG_LOCAL['host'],
+            user=DB_CONFIG_LOCAL['user'],
+            password=DB_CONFIG_LOCAL['password'],
+            database=DB_CONFIG_LOCAL['database'],
+            port=DB_CONFIG_LOCAL['port'],
+            connect_timeout=5
+        )
+        connection.close()
+        return True, "Localhost connection successful"
+    except pymysql.Error as e:
+        return False, f"Localhost connection failed: {str(e)}"
+    except Exception as e:
+        return False, f"Localhost connection error: {str(e)}"
+
+def test_direct_connection():
+    """Test direct database connection"""
+    try:
+        connection = pymysql.connect(
+            host=DB_CONFIG['host'],
+            user=DB_CONFIG['user'],
+            password=DB_CONFIG['password'],
+            database=DB_CONFIG['database'],
+            port=DB_CONFIG['port'],
+            connect_timeout=5
+        )
+        connection.close()
+        return True, "Direct database connection successful"
+    except pymysql.Error as e:
+        return False, f"Direct connection failed: {str(e)}"
+    except Exception as e:
+        return False, f"Direct connection error: {str(e)}"
+
+def test_ssh_connection():
+    """Test SSH tunnel and database connection"""
+    try:
+        # First test SSH connection
+        ssh_config = SSH_CONFIG.copy()
+        
+        # Prepare SSH connection arguments
+        ssh_args = {
+            'ssh_address_or_host': (ssh_config['ssh_host'], ssh_config['ssh_port']),
+            'ssh_username': ssh_config['ssh_user'],
+            'remote_bind_address': ssh_config['remote_bind_address']
+        }
+        
+        # Add either password or private key
+        if 'ssh_password' in ssh_config and ssh_config['ssh_password']:
+            ssh_args['ssh_password'] = ssh_config['ssh_password']
+        elif 'ssh_pkey' in ssh_config and ssh_config['ssh_pkey']:
+            # Look for key file in ssh directory relative to script location
+            key_path = os.path.join(os.path.dirname(__file__), 'ssh', ssh_config['ssh_pkey'])
+            if os.path.exists(key_path):
+                ssh_args['ssh_pkey'] = key_path
+            else:
+                ssh_args['ssh_pkey'] = ssh_config['ssh_pkey']
+        else:
+            return False, "SSH configuration missing authentication method"
+        
+        # Create tunnel
+        with SSHTunnelForwarder(**ssh_args) as tunnel:
+            tunnel.start()
+            
+            # Test database connection through tunnel
+            connection = pymysql.connect(
+                host='127.0.0.1',
+                user=DB_CONFIG['user'],
+                password=DB_CONFIG['password'],
+                database=DB_CONFIG['database'],
+                port=tunnel.local_bind_port,
+                connect_timeout=5
+            )
+            connection.close()
+            tunnel.stop()
+            
+            return True, "SSH tunnel and database connection successful"
+            
+    except paramiko.ssh_exception.AuthenticationException:
+        return False, "SSH authentication failed - check username, password or key"
+    except paramiko.ssh_exception.SSHException as e:
+        return False, f"SSH connection failed: {str(e)}"
+    except socket.error as e:
+        return False, f"Network error: {str(e)}"
+    except pymysql.Error as e:
+        return False, f"Database connection through SSH failed: {str(e)}"
+    except Exception as e:
+        return False, f"SSH tunnel error: {str(e)}"
+
+def test_query_execution(connection_params):
+    """Test if a simple query can be executed"""
+    try:
+        connection = pymysql.connect(**connection_params)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            result = cursor.fetchone()
+        connection.close()
+        return True, "Query execution successful"
+    except Exception as e:
+        return False, f"Query execution failed: {str(e)}"
+
+def main():
+    print("=" * 60)
+    print("DATABASE CONFIGURATION TESTER")
+    print("=" * 60)
+    
+    print(f"\nConfiguration Settings:")
+    print(f"USE_LOCALHOST: {USE_LOCALHOST}")
+    print(f"START_DATE: {START_DATE}")
+    print(f"PREFIX_NAME: {PREFIX_NAME}")
+    print("-" * 60)
+    
+    if USE_LOCALHOST:
+        print("\nTesting Localhost Configuration...")
+        success, message = test_local_connection()
+        
+        if success:
+            print(f"{message}")
+            # Test query execution
+            conn_params = {
+                'host': DB_CONFIG_LOCAL['host'],
+                'user': DB_CONFIG_LOCAL['user'],
+                'password': DB_CONFIG_LOCAL['password'],
+                'database': DB_CONFIG_LOCAL['database'],
+                'port': DB_CONFIG_LOCAL['port']
+            }
+            query_success, query_message = test_query_execution(conn_params)
+            if query_success:
+                print(f"{query_message}")
+                print("\n🎉 Configurations for Localhost are safe to use!")
+            else:
+                print(f"{query_message}")
+                print("\nConnection works but query execution failed - check database permissions")
+        else:
+            print(f"{message}")
+            print("\nDatabase connection failed, check credentials")
+            
+    else:
+        print("\nTesting Production Configuration...")
+        
+        # Test direct connection first
+        direct_success, direct_message = test_direct_connection()
+        
+        if direct_success:
+            print(f"{direct_message}")
+            # Test query execution
+            conn_params = {
+                'host': DB_CONFIG['host'],
+                'user': DB_CONFIG['user'],
+                'password': DB_CONFIG['password'],
+                'database': DB_CONFIG['database'],
+                'port': DB_CONFIG['port']
+            }
+            query_success, query_message = test_query_execution(conn_params)
+            if query_success:
+                print(f"{query_message}")
+                print("\nConfigurations for Production are safe to use!")
+            else:
+                print(f"{query_message}")
+                print("\nDirect connection works but query execution failed - check database permissions")
+        
+        else:
+            print(f"{direct_message}")
+            print("\nAttempting SSH Tunnel Connection...")
+            
+            # Test SSH connection
+            ssh_success, ssh_message = test_ssh_connection()
+            
+            if ssh_success:
+                print(f"{ssh_message}")
+                print("\n🎉 Configurations for Production with SSH are safe to use!")
+            else:
+                print(f"{ssh_message}")
+                print("\n Database connection failed, check credentials")
+    
+    print("\n" + "=" * 60)
+
+if __name__ == "__main__":
+    # Check if required modules are installed
+    required_modules = ['pymysql', 'paramiko', 'sshtunnel']
+    missing_modules = []
+    
+    for module in required_modules:
+        try:
+            __import__(module)
+        except ImportError:
+            missing_modules.append(module)
+    
+    if missing_modules:
+        print("Missing required modules. Please install:")
+        print(f"pip install {' '.join(missing_modules)}")
+        sys.exit(1)
+    
+    main()
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""
+Defaults of the settings added to config.example.py after the first release.
+
+A deployed config.py copied from an older config.example.py does not define them. Importing
+this module before `from config import ...` sets the missing ones on the config module to the
+values config.example.py documents, so such a deployment keeps starting (with every new
+feature at its default) instead of failing with ImportError. Settings config.py does define
+are never touched.
+"""
+import pyarrow as pa
+
+import config
+
+CATEGORY_ = pa.dictionary(pa.int32(), pa.string())
+
+DEFAULTS = {
+    'STREAM_EXTRACTION': False,
+    'ARROW_BATCH_ROWS': 50000,
+    'EXTRACTION_WORKERS': 1,
+    'EXTRACTION_DAYS_PER_TASK': 7,
+    'PARTITIONED_STORE': False,
+    'CDC_MODE': False,
+    'CDC_LOOKBACK_MINUTES': 10,
+    'SORTED_LAYOUT': False,
+    'PARQUET_ROW_GROUP_ROWS': 122880,
+    'STAR_SCHEMA': False,
+    'LOCAL_VISIT_DAYS': True,
+    'SNAPSHOTS': False,
+    'SNAPSHOT_RETENTION': 3,
+    'COMPACTION_MIN_FILES': 4,
+    'COMPACTION_MIN_ROW_GROUP_ROWS': 12288,
+    'QUERY_CACHE_MB': 256,
+    'DUCKDB_THREADS': 2,
+    'DUCKDB_MEMORY_LIMIT': '1GB',
+    'ARROW_SNAPSHOT': False,
+    'SERVING_DB': False,
+    'WARM_FACILITIES': 10,
+    'WARM_POLL_SECONDS': 15,
+    'RUN_REPORT_HISTORY': 200,
+    'USERS_FILE_FORMAT': "parquet",
+    'DATA_SOURCES': [],
+    'CATEGORY_': CATEGORY_,
+    'DATA_SCHEMA': {
+        config.PERSON_ID_: pa.int64(),
+        config.ENCOUNTER_ID_: pa.int64(),
+        'obs_id': pa.int64(),
+        config.AGE_: pa.int32(),
+        config.DATE_: pa.date32(),
+        config.VALUE_NUMERIC_: pa.float64(),
+        config.FACILITY_: CATEGORY_,
+        config.PROGRAM_: CATEGORY_,
+        config.ENCOUNTER_: CATEGORY_,
+        config.CONCEPT_NAME_: CATEGORY_,
+        config.OBS_VALUE_CODED_: CATEGORY_,
+        config.GENDER_: CATEGORY_,
+        config.AGE_GROUP_: CATEGORY_,
+        config.NEW_REVISIT_: CATEGORY_,
+        config.HOME_DISTRICT_: CATEGORY_,
+        config.TA_: CATEGORY_,
+        config.VILLAGE_: CATEGORY_,
+    },
+}
+
+for name, value in DEFAULTS.items():
+    if not hasattr(config, name):
+        setattr(config, name, value)
@@ -1,97 +1,1042 @@
 import os
+import numpy as np
 import pandas as pd
-from config import QERY,USE_LOCALHOST, DATA_FILE_NAME_
-from db_services import DataFetcher
+import pyarrow as pa
+import config_defaults  # noqa: F401  (defaults for settings an older config.py lacks)
+from config import (QERY, USE_LOCALHOST, DATA_FILE_NAME_, STREAM_EXTRACTION,
+                    EXTRACTION_WORKERS, EXTRACTION_DAYS_PER_TASK, PARTITIONED_STORE,
+                    CDC_MODE, CDC_LOOKBACK_MINUTES, SORTED_LAYOUT, PARQUET_ROW_GROUP_ROWS,
+                    STAR_SCHEMA, LOCAL_VISIT_DAYS, SNAPSHOTS, SNAPSHOT_RETENTION,
+                    COMPACTION_MIN_FILES, COMPACTION_MIN_ROW_GROUP_ROWS, RUN_REPORT_HISTORY,
+                    QUERY_CACHE_MB, WARM_FACILITIES, WARM_POLL_SECONDS, USERS_FILE_FORMAT, DATA_SOURCES,
+                    DUCKDB_THREADS, DUCKDB_MEMORY_LIMIT, ARROW_SNAPSHOT, ARROW_BATCH_ROWS,
+                    SERVING_DB, PERSON_ID_, ENCOUNTER_ID_,
+                    FACILITY_CODE_,
+                    DATE_, GENDER_, HOME_DISTRICT_, TA_, VILLAGE_,
+                    PROGRAM_, ENCOUNTER_, CONCEPT_NAME_, OBS_VALUE_CODED_)
+from db_services import DataFetcher, HIVE_TYPES_SQL
+import projection
 from datetime import datetime
 import logging
 import json
+import re
 import duckdb
+import shutil
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import g, has_request_context
 from functools import lru_cache
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Enrichment applied once when rows are written to the store, so callbacks only read the results:
+# column -> (DuckDB expression, source columns). Expressions are idempotent (rows get rewritten).
+# Reads fill them in for rows written before a column was added (see _with_derived).
+DERIVED_COLUMNS = {
+    GENDER_: (f"CASE \"{GENDER_}\" WHEN 'M' THEN 'Male' WHEN 'F' THEN 'Female' ELSE \"{GENDER_}\" END", [GENDER_]),
+    'DateValue': (f"CAST(\"{DATE_}\" AS DATE)", [DATE_]),
+    'Residence': (f"\"{HOME_DISTRICT_}\" || ', TA-' || \"{TA_}\" || ', ' || \"{VILLAGE_}\"",
+                  [HOME_DISTRICT_, TA_, VILLAGE_]),
+}
+
+class QueryCache:
+    """
+    Result frames of DuckDB queries keyed by (normalized SQL, parameters, data version), the least
+    recently used evicted once the frames together take more than max_bytes.
+    Callers get shallow copies: with copy-on-write (always on from pandas 3) they can change
+    their frame freely without the cached one being touched or copied up front.
+    """
+    # quoted literals and identifiers are kept verbatim when the SQL is normalized
+    _QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+    _shallow = int(pd.__version__.split('.')[0]) >= 3 or pd.get_option("mode.copy_on_write") is True
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()  # key -> (frame, bytes)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def key(cls, sql, params, version):
+        """Cache key; SQL differing only in whitespace outside quotes shares an entry"""
+        parts = cls._QUOTED.split(sql.strip())
+        normalized = "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts))
+        return normalized, params, version
+
+    def get(self, key, run):
+        """The cached frame for key, or run() cached under it"""
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is not None:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return self._private(entry[0])
+            self.misses += 1
+        frame = run()
+        size = int(frame.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            if size <= self.max_bytes:
+                if key in self._frames:
+                    self.bytes -= self._frames.pop(key)[1]
+                self._frames[key] = (frame, size)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    self.bytes -= self._frames.popitem(last=False)[1][1]
+                    self.evictions += 1
+        return self._private(frame)
+
+    def put(self, key, run):
+        """Run and cache a query unless it is cached already (warm-up)"""
+        with self._lock:
+            if key in self._frames:
+                return
+        self.get(key, run)
+
+    def invalidate(self, version=None):
+        """Drop every entry not of data version `version` (all with None); returns how many were dropped"""
+        with self._lock:
+            stale = [key for key in self._frames if key[2] != version or version is None]
+            for key in stale:
+                self.bytes -= self._frames.pop(key)[1]
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._frames), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _private(self, frame):
+        return frame.copy(deep=not self._shallow)
+
+
+# the repository: default paths point into its data/ directory, whatever the working directory
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REFRESH_EVENT_FILE = "refresh_event.json"
+# with DATA_SOURCES, rows read through the stacked source stores carry the source name in this column
+SOURCE_COLUMN = "source"
+# facilities this process has served, most requested first; the warm-up starts with them
+_facility_hits = Counter()
+_watcher_pid = None
+_query_cache = QueryCache(QUERY_CACHE_MB * 1024 * 1024)
+# one in-process DuckDB database per worker process, (pid, connection); threads query it through their own cursor
+_duckdb_database = None
+_duckdb_lock = threading.Lock()
+_duckdb_local = threading.local()
+# serving databases attached to the worker's DuckDB database, alias -> pid, oldest first
+_serving_attached = {}
+# requests reading each attached serving database right now (alias -> count); read ones stay attached
+_serving_readers = Counter()
+
+# The standard page access patterns. Values are bound as named parameters, never spliced into the SQL
+FACILITY_FILTERS = {
+    'facility': f"{FACILITY_CODE_} = $facility",
+    'facility_since': f"{FACILITY_CODE_} = $facility AND \"{DATE_}\" >= $start",
+    'facility_range': f"{FACILITY_CODE_} = $facility AND \"{DATE_}\" BETWEEN $start AND $end",
+    'facility_until': f"{FACILITY_CODE_} = $facility AND \"{DATE_}\" <= $end",
+    # all facilities between start and end (the configuration preview); no $facility to bind
+    'range': f"\"{DATE_}\" BETWEEN $start AND $end",
+}
+# users table as written by refresh(), most compact format first
+USERS_FILES = ("users_data.parquet", "users_data.csv")
+# always let in on top of the users table
+TEST_ADMIN = ('m3his@dhd', 'reports_admin')
+
+def _data_path(*parts):
+    """Path under the repository's data/ directory (BASE_DIR read at call time, so tests can move it)"""
+    return os.path.join(BASE_DIR, "data", *parts)
+
 class DataStorage:
     def __init__(self, query=QERY, data_dir="data", filename=DATA_FILE_NAME_):
         self.query = query
-        self.script_dir = os.path.dirname(os.path.realpath(__file__))
-        os.chdir(self.script_dir)
-        logging.debug(f"Working directory set to: {os.getcwd()}")
+        # paths are anchored at the repository, whatever the working directory
+        self.script_dir = BASE_DIR
         self.data_dir = os.path.join(self.script_dir, data_dir)
         os.makedirs(self.data_dir, exist_ok=True)
         self.filepath = os.path.join(self.data_dir, filename)
         self.dropdown_filepath = os.path.join(self.data_dir, 'dcc_dropdown_json', 'dropdowns.json')
 
-    def fetch_and_save(self):
-        """Fetch fresh data from DB and save to Parquet."""
-        fetcher = DataFetcher(use_localhost=USE_LOCALHOST)
+    @staticmethod
+    def _fetcher(source=None, state_dir=None):
+        """
+        DataFetcher configured with the store options from config. For one of DATA_SOURCES it
+        connects through that source's own route and keeps its recovery state in state_dir.
+        """
+        if source is None:
+            route = dict(use_localhost=USE_LOCALHOST)
+        else:
+            route = dict(use_localhost=source.get('use_localhost', False),
+                         ssh_config=source.get('ssh_config'),
+                         db_config=source.get('db_config'),
+                         connection_factory=source.get('connection_factory'),
+                         state_dir=state_dir)
+        return DataFetcher(**route,
+                           streaming=STREAM_EXTRACTION,
+                           arrow_batch_rows=ARROW_BATCH_ROWS,
+                           parallel_workers=EXTRACTION_WORKERS,
+                           days_per_task=EXTRACTION_DAYS_PER_TASK,
+                           partitioned=PARTITIONED_STORE,
+                           cdc=CDC_MODE,
+                           cdc_lookback_minutes=CDC_LOOKBACK_MINUTES,
+                           sorted_layout=SORTED_LAYOUT,
+                           row_group_rows=PARQUET_ROW_GROUP_ROWS,
+                           track_visits=LOCAL_VISIT_DAYS,
+                           derived_columns=DERIVED_COLUMNS,
+                           run_report_history=RUN_REPORT_HISTORY)
+
+    def fetch_and_save(self, blocking=True):
+        """
+        Fetch fresh data from DB and save to Parquet.
+        With blocking=False returns False straight away if another refresh holds the store lock.
+        With DATA_SOURCES every source is refreshed at once; the sources that did refresh are
+        published even if others failed, then a RuntimeError names the failed ones.
+        """
+        failed = []
+        # held until the snapshot is out, so compaction never rewrites files mid-refresh
+        with DataFetcher.store_lock(self.filepath, blocking=blocking) as acquired:
+            if not acquired:
+                logging.info("Another refresh holds the store lock; skipped")
+                return False
+            if DATA_SOURCES:
+                failed = self._fetch_sources()
+            else:
+                self._fetch_into(self._fetcher(), self.filepath)
+            snapshot_id = self.publish_snapshot() if SNAPSHOTS else None
+            if ARROW_SNAPSHOT:
+                self.publish_arrow_snapshot(snapshot_id)
+            if SERVING_DB:
+                self.publish_serving_db(snapshot_id)
+            self.publish_refresh_event(snapshot_id)
+        if failed:
+            raise RuntimeError(f"Refresh failed for sources: {', '.join(failed)}")
+        return True
+
+    def _fetch_into(self, fetcher, filepath):
+        """Run one fetch_data of the query into the store at filepath"""
         df = fetcher.fetch_data(
             self.query,
-            filename=self.filepath,
+            filename=filepath,
             date_column='Date',
             batch_size=50000,
         )
-        if df is not None and not df.empty:
-            df.to_parquet(self.filepath, index=False)
-            logging.info(f"Data saved to {self.filepath} (Parquet format)")
+        if fetcher.disk_merge:
+            # the fetcher already merged the daily batches into the parquet file
+            logging.info(f"Data merged into {filepath} (Parquet format)")
+        elif df is not None and not df.empty:
+            # swap in a new file: published snapshots hard-link the old one
+            fetcher.write_parquet(df, f"{filepath}.tmp")
+            os.replace(f"{filepath}.tmp", filepath)
+            logging.info(f"Data saved to {filepath} (Parquet format)")
         else:
             logging.warning("No data fetched from database.")
+        if STAR_SCHEMA:
+            fetcher.publish_star_schema(filepath)
+
+    @staticmethod
+    def source_filepath(path, name):
+        """Store of one of DATA_SOURCES: data/sources/<name>/<store file name>"""
+        return os.path.join(os.path.dirname(path), "sources", name, os.path.basename(path))
+
+    def _fetch_sources(self):
+        """
+        Refresh all DATA_SOURCES concurrently, each with its own fetcher (SSH tunnel, checkpoint,
+        CDC marks, daily batches, run reports) writing its own store under data/sources/<name>/.
+        A failed source keeps its last data and resumes from its checkpoint on the next run.
+        Returns the names of the sources that failed.
+        """
+        DataStorage._check_sources(DATA_SOURCES)
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(DATA_SOURCES), thread_name_prefix="source") as pool:
+            futures = {}
+            for source in DATA_SOURCES:
+                filepath = self.source_filepath(self.filepath, source['name'])
+                fetcher = self._fetcher(source, state_dir=os.path.dirname(filepath))
+                futures[pool.submit(self._fetch_into, fetcher, filepath)] = source['name']
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    logging.info(f"Source {futures[future]} refreshed")
+                except Exception:
+                    logging.exception(f"Refresh of source {futures[future]} failed")
+                    failed.append(futures[future])
+        return sorted(failed)
+
+    @staticmethod
+    def _check_sources(sources):
+        """
+        Raise ValueError naming every DATA_SOURCES entry that cannot be fetched, before any source
+        is. Each needs a unique name and a route: a connection_factory, use_localhost, or a db_config
+        with an ssh_config (remote databases are only reached through the SSH tunnel).
+        """
+        problems = []
+        names = [source.get('name') for source in sources]
+        for number, source in enumerate(sources):
+            label = source.get('name') or f"entry {number}"
+            if not source.get('name'):
+                problems.append(f"{label} has no name")
+            elif names.count(source['name']) > 1:
+                problems.append(f"{label} is named more than once")
+            if source.get('connection_factory') is not None or source.get('use_localhost'):
+                continue
+            missing = [key for key in ('db_config', 'ssh_config') if not source.get(key)]
+            ssh_config = source.get('ssh_config') or {}
+            if ssh_config:
+                missing += [f"ssh_config['{key}']" for key in ('ssh_host', 'ssh_user', 'remote_bind_address')
+                            if key not in ssh_config]
+                if 'ssh_password' not in ssh_config and 'ssh_pkey' not in ssh_config:
+                    missing.append("ssh_config['ssh_password'] or ['ssh_pkey']")
+            if missing:
+                problems.append(f"{label} has no {', '.join(missing)} (or set use_localhost / connection_factory)")
+        if problems:
+            raise ValueError(f"Invalid DATA_SOURCES in config.py: {'; '.join(problems)}")
+
+    def compact(self, min_files=COMPACTION_MIN_FILES, min_row_group_rows=COMPACTION_MIN_ROW_GROUP_ROWS,
+                history_file="compaction_metrics.jsonl"):
+        """
+        Merge the small files left by appending refreshes (see DataFetcher.compact), then publish
+        the result as a new snapshot. Readers stay on the snapshot they pinned (its hard links keep
+        the merged-away files) until CURRENT moves, so this needs SNAPSHOTS: without them readers
+        glob the live store and could see a partition both before and after its merge.
+        Skipped, returning None, without SNAPSHOTS or while a refresh holds the store lock. Each
+        store's metrics are appended as one JSON line to data/<history_file>. Returns the metrics,
+        or with DATA_SOURCES a list holding the metrics of each source store.
+        """
+        if not SNAPSHOTS:
+            logging.warning("Compaction needs SNAPSHOTS (readers would glob the store mid-merge); skipped")
+            return None
+        fetcher = self._fetcher()
+        stores = ([self.source_filepath(self.filepath, source['name']) for source in DATA_SOURCES]
+                  if DATA_SOURCES else [self.filepath])
+        with fetcher.store_lock(self.filepath, blocking=False) as acquired:
+            if not acquired:
+                logging.info("Store is being refreshed; compaction skipped")
+                return None
+            results = [fetcher.compact(store, min_files=min_files, min_row_group_rows=min_row_group_rows)
+                       for store in stores]
+            if any(metrics['partitions_compacted'] for metrics in results):
+                snapshot_id = self.publish_snapshot()
+                if ARROW_SNAPSHOT:
+                    self.publish_arrow_snapshot(snapshot_id)
+                if SERVING_DB:
+                    self.publish_serving_db(snapshot_id)
+                self.publish_refresh_event(snapshot_id)
+        with open(os.path.join(self.data_dir, history_file), 'a') as f:
+            for metrics in results:
+                f.write(json.dumps(metrics) + "\n")
+        return results if DATA_SOURCES else results[0]
+
+    # Snapshots
+    @staticmethod
+    def _link_or_copy(source, target):
+        """Hard-link a file (store files are only ever replaced, never rewritten in place), else copy it"""
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+    def publish_snapshot(self):
+        """
+        Publish the current store (file or partitioned dataset, star and visit tables, and those
+        of each of DATA_SOURCES under sources/<name>/) as a write-once
+        data/snapshots/<snapshot_id>/ directory, then atomically point CURRENT at it.
+        Snapshots beyond SNAPSHOT_RETENTION are removed, oldest first.
+        """
+        snapshot_root = os.path.join(self.data_dir, "snapshots")
+        snapshot_id = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        staging_dir = os.path.join(snapshot_root, f".staging_{snapshot_id}")
+        os.makedirs(staging_dir)
+        stores = [(self.filepath, staging_dir)]
+        stores += [(self.source_filepath(self.filepath, source['name']), os.path.join(staging_dir, "sources", source['name']))
+                   for source in DATA_SOURCES]
+        try:
+            for store, target_dir in stores:
+                os.makedirs(target_dir, exist_ok=True)
+                for source in (store, DataFetcher.dataset_dir(store),
+                               DataFetcher.star_dir(store), DataFetcher.visits_dir(store)):
+                    target = os.path.join(target_dir, os.path.basename(source))
+                    if os.path.isdir(source):
+                        shutil.copytree(source, target, copy_function=self._link_or_copy)
+                    elif os.path.isfile(source):
+                        self._link_or_copy(source, target)
+            os.replace(staging_dir, os.path.join(snapshot_root, snapshot_id))
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        pointer = os.path.join(snapshot_root, "CURRENT")
+        with open(f"{pointer}.tmp", 'w') as f:
+            f.write(snapshot_id)
+        os.replace(f"{pointer}.tmp", pointer)
+        logging.info(f"Snapshot {snapshot_id} published")
+
+        published = sorted(d for d in os.listdir(snapshot_root)
+                           if not d.startswith('.') and os.path.isdir(os.path.join(snapshot_root, d)))
+        for old in published[:-max(SNAPSHOT_RETENTION, 1)]:
+            if old != snapshot_id:
+                shutil.rmtree(os.path.join(snapshot_root, old), ignore_errors=True)
+        return snapshot_id
+
+    @staticmethod
+    def current_snapshot(data_dir=None):
+        """Id of the snapshot CURRENT points to, or None before the first publish"""
+        data_dir = data_dir or _data_path()
+        try:
+            with open(os.path.join(data_dir, "snapshots", "CURRENT"), 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def snapshot_id(data_dir=None):
+        """
+        Snapshot this request reads. The first lookup inside a Flask request (every Dash callback
+        runs in one) pins the id on flask.g, so all queries of the request see the same refresh.
+        Changes exactly once per refresh, so it doubles as a cache key. None without SNAPSHOTS.
+        """
+        data_dir = data_dir or _data_path()
+        if not SNAPSHOTS:
+            return None
+        if not has_request_context():
+            return DataStorage.current_snapshot(data_dir)
+        if 'snapshot_id' not in g:
+            g.snapshot_id = DataStorage.current_snapshot(data_dir)
+        return g.snapshot_id
+
+    # Shared Arrow snapshot
+    def publish_arrow_snapshot(self, snapshot_id=None):
+        """
+        Materialize the current rows once as an uncompressed Arrow IPC file, data/arrow/<id>.arrow,
+        sorted by facility and date, with a sidecar index of each facility's row range. Workers
+        memory-map it, so all of them serve from the same page-cache copy. The id is the snapshot's
+        (pinned requests keep finding theirs) or a new one, and data/arrow/CURRENT points to it.
+        """
+        # the refresh process may run anywhere: read the store's columns afresh, not by data/ version
+        DataStorage._source_columns.cache_clear()
+        arrow_dir = os.path.join(self.data_dir, "arrow")
+        os.makedirs(arrow_dir, exist_ok=True)
+        arrow_id = snapshot_id or datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        path = os.path.join(arrow_dir, f"{arrow_id}.arrow")
+        rows = DataStorage._union_sources(DataStorage._pinned_path(self.filepath), DataStorage._rows_with_visits)
+        con = DataStorage.connection()
+
+        reader = con.execute(f"SELECT * FROM {rows} ORDER BY {FACILITY_CODE_}, \"{DATE_}\"").to_arrow_reader(
+            ARROW_BATCH_ROWS)
+        with pa.OSFile(f"{path}.tmp", 'wb') as sink, pa.ipc.new_file(sink, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+        # same ORDER BY as the file, so the running total is each facility's first row
+        counts = con.execute(f"SELECT CAST({FACILITY_CODE_} AS VARCHAR) AS code, count(*) AS n "
+                             f"FROM {rows} GROUP BY {FACILITY_CODE_} ORDER BY {FACILITY_CODE_}").fetchall()
+        index, offset = {}, 0
+        for code, n in counts:
+            if code is not None:
+                index[code] = [offset, n]
+            offset += n
+        with open(f"{path}.index.tmp", 'w') as f:
+            json.dump(index, f)
+        os.replace(f"{path}.index.tmp", f"{path}.index")
+        os.replace(f"{path}.tmp", path)
+
+        # workers still mapping a removed file keep reading it until they move on
+        DataStorage._point_to(arrow_dir, arrow_id, ".arrow", (".arrow", ".arrow.index"))
+        logging.info(f"Arrow snapshot {arrow_id} published ({offset} rows)")
+        return arrow_id
+
+    @staticmethod
+    def _point_to(directory, published_id, extension, suffixes):
+        """Move directory/CURRENT to published_id and remove the files of ids beyond SNAPSHOT_RETENTION"""
+        pointer = os.path.join(directory, "CURRENT")
+        with open(f"{pointer}.tmp", 'w') as f:
+            f.write(published_id)
+        os.replace(f"{pointer}.tmp", pointer)
+        published = sorted(f[:-len(extension)] for f in os.listdir(directory) if f.endswith(extension))
+        for old in published[:-max(SNAPSHOT_RETENTION, 1)]:
+            if old != published_id:
+                for suffix in suffixes:
+                    if os.path.exists(os.path.join(directory, f"{old}{suffix}")):
+                        os.remove(os.path.join(directory, f"{old}{suffix}"))
+
+    @staticmethod
+    def _published_file(directory, extension, data_dir=None):
+        """directory/<id><extension> of the pinned snapshot's id (else CURRENT's) if it exists, or None"""
+        data_dir = data_dir or _data_path()
+        published_id = DataStorage.snapshot_id(data_dir)
+        if published_id is None:
+            try:
+                with open(os.path.join(directory, "CURRENT")) as f:
+                    published_id = f.read().strip()
+            except FileNotFoundError:
+                return None
+        path = os.path.join(directory, f"{published_id}{extension}")
+        return path if os.path.exists(path) else None
+
+    @staticmethod
+    def arrow_snapshot(data_dir=None):
+        """
+        (table, facility index) of the Arrow snapshot this request reads (the pinned snapshot's,
+        else CURRENT), or None if there is none. The table is memory-mapped once per worker:
+        its buffers point into the mapping, nothing is read into the process.
+        """
+        data_dir = data_dir or _data_path()
+        path = DataStorage._published_file(os.path.join(data_dir, "arrow"), ".arrow", data_dir)
+        return DataStorage._map_arrow(path) if path else None
+
+    @staticmethod
+    @lru_cache(maxsize=2)
+    def _map_arrow(path):
+        with open(f"{path}.index") as f:
+            index = json.load(f)
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        return table, index
+
+    # Serving database
+    def publish_serving_db(self, snapshot_id=None):
+        """
+        Build the current rows into a DuckDB database file, data/serving/<id>.duckdb, that pages
+        query instead of the parquet store: table obs, clustered by facility and date so zone maps
+        skip the row groups of other facilities and dates, with ART indexes on person_id and
+        encounter_id for cohort lookups. Ids and CURRENT work like the Arrow snapshot's.
+        """
+        # the refresh process may run anywhere: read the store's columns afresh, not by data/ version
+        DataStorage._source_columns.cache_clear()
+        serving_dir = os.path.join(self.data_dir, "serving")
+        os.makedirs(serving_dir, exist_ok=True)
+        serving_id = snapshot_id or datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        path = os.path.join(serving_dir, f"{serving_id}.duckdb")
+        rows = DataStorage._union_sources(DataStorage._pinned_path(self.filepath), DataStorage._rows_with_visits)
+        con = DataStorage.connection()
+
+        for leftover in (f"{path}.tmp", f"{path}.tmp.wal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        con.execute(f"ATTACH '{path}.tmp' AS serving_build")
+        try:
+            con.execute(f"CREATE TABLE serving_build.obs AS SELECT * FROM {rows} "
+                        f"ORDER BY {FACILITY_CODE_}, \"{DATE_}\"")
+            columns = set(con.execute("SELECT column_name FROM duckdb_columns() "
+                                      "WHERE database_name = 'serving_build' AND table_name = 'obs'").df()['column_name'])
+            for column in (PERSON_ID_, ENCOUNTER_ID_):
+                if column in columns:
+                    con.execute(f"CREATE INDEX obs_{column} ON serving_build.obs (\"{column}\")")
+            count = con.execute("SELECT count(*) FROM serving_build.obs").fetchone()[0]
+            con.execute("CHECKPOINT serving_build")
+        finally:
+            con.execute("DETACH serving_build")
+        os.replace(f"{path}.tmp", path)
+
+        DataStorage._point_to(serving_dir, serving_id, ".duckdb", (".duckdb",))
+        logging.info(f"Serving database {serving_id} published ({count} rows)")
+        return serving_id
+
+    @staticmethod
+    def serving_source(data_dir=None):
+        """
+        FROM target of the serving database this request reads (the pinned snapshot's, else CURRENT),
+        attached read-only to the worker's DuckDB database on first use, or None if there is none.
+        Inside a Flask request the database is pinned on flask.g until release_serving() at teardown,
+        and older databases are only detached once no request reads them.
+        """
+        data_dir = data_dir or _data_path()
+        if has_request_context() and 'serving_alias' in g:
+            return f"{g.serving_alias}.obs"
+        path = DataStorage._published_file(os.path.join(data_dir, "serving"), ".duckdb", data_dir)
+        if path is None:
+            return None
+        alias = "serving_" + re.sub(r"\W", "_", os.path.basename(path)[:-len(".duckdb")])
+        pid = os.getpid()
+        # before taking the lock: opening the worker's database takes it too
+        con = DataStorage.connection()
+        with _duckdb_lock:
+            if _serving_attached.get(alias) != pid:
+                con.execute(f"ATTACH IF NOT EXISTS '{os.path.abspath(path)}' AS {alias} (READ_ONLY)")
+                _serving_attached[alias] = pid
+            if has_request_context():
+                _serving_readers[alias] += 1
+                g.serving_alias = alias
+        DataStorage._detach_unread_serving(con)
+        return f"{alias}.obs"
+
+    @staticmethod
+    def release_serving(exc=None):
+        """teardown_request hook: the request is done with its serving database (see serving_source)"""
+        alias = g.pop('serving_alias', None)
+        if alias is None:
+            return
+        with _duckdb_lock:
+            _serving_readers[alias] -= 1
+            if _serving_readers[alias] <= 0:
+                del _serving_readers[alias]
+        DataStorage._detach_unread_serving(DataStorage.connection())
+
+    @staticmethod
+    def _detach_unread_serving(con):
+        """
+        Detach the serving databases older than the last two that no request reads any more.
+        Readers outside a request (the warm-up) query CURRENT's, which is among the last two.
+        """
+        with _duckdb_lock:
+            for old in [a for a, p in _serving_attached.items() if p == os.getpid()][:-2]:
+                if _serving_readers[old]:
+                    continue
+                try:
+                    con.execute(f"DETACH {old}")
+                    del _serving_attached[old]
+                except duckdb.Error:
+                    pass
+
+    @staticmethod
+    def _arrow_facility_frame(snapshot, location, start=None, end=None, columns=None):
+        """
+        Rows of one facility cut from the Arrow snapshot: the facility's row range and, within it,
+        the date range (rows are date-sorted per facility) are zero-copy slices of the mapping.
+        Same rows and columns as the FACILITY_FILTERS pattern the bounds describe.
+        """
+        table, index = snapshot
+        offset, length = index.get(str(location), (0, 0))
+        rows = table.slice(offset, length)
+        if start is not None or end is not None:
+            dates = rows.column(DATE_)
+            # NULL dates sort last and never match a date bound
+            dated = len(rows) - dates.null_count
+            values = dates.slice(0, dated).to_numpy().astype('datetime64[us]')
+            first = np.searchsorted(values, np.datetime64(pd.Timestamp(start).to_pydatetime(), 'us')) if start is not None else 0
+            last = (np.searchsorted(values, np.datetime64(pd.Timestamp(end).to_pydatetime(), 'us'), side='right')
+                    if end is not None else dated)
+            rows = rows.slice(first, max(last - first, 0))
+        selected = rows.select([c for c in columns if c in rows.column_names]) if columns else rows
+        frame = selected.to_pandas(split_blocks=True, date_as_object=False)
+        if not columns or 'months' in columns:
+            # computed per request like parquet_source() does, as it moves with the current date
+            dates = pd.to_datetime(rows.column(DATE_).to_pandas()).dt.normalize()
+            frame['months'] = ((pd.Timestamp.today().normalize() - dates).dt.days // 30).to_numpy()
+        return frame
+
+    @staticmethod
+    def _pinned_path(path):
+        """Path of a store file inside the pinned snapshot (unchanged without snapshots)"""
+        data_dir = os.path.dirname(path)
+        snapshot_id = DataStorage.snapshot_id(data_dir)
+        if snapshot_id is None:
+            return path
+        return os.path.join(data_dir, "snapshots", snapshot_id, os.path.basename(path))
+
+    @staticmethod
+    def parquet_source(path=None):
+        """
+        FROM target for DuckDB queries on the stored data, read from the pinned snapshot.
+        With STAR_SCHEMA this is a view joining the published fact and dimension tables
+        back into the same columns. With PARTITIONED_STORE this reads the hive dataset,
+        so filters on Facility_CODE (and year_month) prune whole partitions.
+        With LOCAL_VISIT_DAYS the locally maintained visit_days/new_revisit are joined on.
+        With DATA_SOURCES the source stores are stacked (each joined with its own visit tables).
+        With SERVING_DB all of this is read from the published serving database instead.
+        `months` (whole 30-day periods before today) is added here as it moves with the current date.
+        """
+        path = path or _data_path(DATA_FILE_NAME_)
+        source = SERVING_DB and DataStorage.serving_source(os.path.dirname(path))
+        if not source:
+            source = DataStorage._union_sources(DataStorage._pinned_path(path), DataStorage._rows_with_visits)
+        return (f"(SELECT *, CAST(floor(date_diff('day', CAST(\"{DATE_}\" AS DATE), current_date) / 30) AS INTEGER) "
+                f"AS months FROM {source})")
+
+    @staticmethod
+    def _rows_with_visits(path):
+        """Rows of one store with its derived columns completed and visit columns joined on (LOCAL_VISIT_DAYS)"""
+        source = DataStorage._with_derived(DataStorage._single_store_source(path))
+        if LOCAL_VISIT_DAYS:
+            source = DataFetcher.with_visits(source, DataFetcher.visits_dir(path))
+        return source
+
+    @staticmethod
+    def _union_sources(path, source_of):
+        """
+        source_of(path), or with DATA_SOURCES the source_of() of every source store present,
+        stacked by column name with each row tagged with its source in SOURCE_COLUMN.
+        """
+        if not DATA_SOURCES:
+            return source_of(path)
+        parts = [f"SELECT *, '{source['name']}' AS {SOURCE_COLUMN} FROM {source_of(store)}"
+                 for source in DATA_SOURCES
+                 if DataStorage._store_exists(store := DataStorage.source_filepath(path, source['name']))]
+        if not parts:
+            return source_of(path)
+        return f"({' UNION ALL BY NAME '.join(parts)})"
+
+    @staticmethod
+    def _with_derived(source):
+        """
+        Wrap a store source so every row carries the DERIVED_COLUMNS, also rows of files written
+        before a column was added (missing, or NULL under union_by_name): stored values are used
+        where present, the expression fills the rest. Columns derived from themselves (Gender)
+        are always recomputed, which is a no-op on rows already written with them.
+        """
+        columns = DataStorage._source_columns(source, DataStorage.data_version())
+        replaced, added = [], []
+        for name, (expression, sources) in DERIVED_COLUMNS.items():
+            if not set(sources) <= columns:
+                continue
+            if name in sources:
+                replaced.append(f'{expression} AS "{name}"')
+            elif name in columns:
+                replaced.append(f'COALESCE("{name}", {expression}) AS "{name}"')
+            else:
+                added.append(f'{expression} AS "{name}"')
+        if not replaced and not added:
+            return source
+        select = "*" + (f" REPLACE ({', '.join(replaced)})" if replaced else "")
+        select += "".join(f", {column}" for column in added)
+        return f"(SELECT {select} FROM {source})"
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _source_columns(source, version):
+        """Column names of a store source (an empty set if it cannot be read), cached per data version"""
+        try:
+            return frozenset(row[0] for row in DataStorage.connection().execute(f"DESCRIBE SELECT * FROM {source}").fetchall())
+        except duckdb.Error:
+            return frozenset()
+
+    @staticmethod
+    def _store_source(path):
+        """FROM target of the stored rows themselves, across DATA_SOURCES when configured"""
+        return DataStorage._union_sources(path, DataStorage._single_store_source)
+
+    @staticmethod
+    def _single_store_source(path):
+        """FROM target of the rows of one store (star view, partitioned dataset or file)"""
+        if STAR_SCHEMA:
+            star_view = DataFetcher.star_view(DataFetcher.star_dir(path))
+            if star_view is not None:
+                return star_view
+        if not PARTITIONED_STORE:
+            return f"'{path}'"
+        dataset_glob = f"{DataFetcher.dataset_dir(path)}/*/*/*.parquet"
+        return (f"(SELECT * EXCLUDE (year_month) FROM read_parquet('{dataset_glob}', "
+                f"hive_partitioning=true, hive_types={HIVE_TYPES_SQL}, union_by_name=true))")
+
+    @staticmethod
+    def data_exists(path=None):
+        """True if the stored data (file or partitioned dataset, of any of DATA_SOURCES) is present"""
+        path = path or _data_path(DATA_FILE_NAME_)
+        path = DataStorage._pinned_path(path)
+        if DATA_SOURCES:
+            return any(DataStorage._store_exists(DataStorage.source_filepath(path, source['name']))
+                       for source in DATA_SOURCES)
+        return DataStorage._store_exists(path)
+
+    @staticmethod
+    def _store_exists(path):
+        return os.path.exists(DataFetcher.dataset_dir(path) if PARTITIONED_STORE else path)
+
+    @staticmethod
+    def query_duckdb(sql: str, params=None, cache=True) -> pd.DataFrame:
+        """
+        Cached DuckDB query, with optional named parameters ($name in the SQL) bound by DuckDB.
+        Cache key is the SQL and parameters plus the data version, so a refresh never serves stale rows.
+        Callers may modify the frame they get (see QueryCache).
+        """
+        params = tuple(sorted(params.items())) if params else ()
+        if not cache:
+            return DataStorage._run_query(sql, params)
+        key = QueryCache.key(sql, params, DataStorage.data_version())
+        return _query_cache.get(key, lambda: DataStorage._run_query(sql, params))
+
+    @staticmethod
+    def cache_stats():
+        """Entries, bytes and hit/miss/eviction counters of this worker's query cache"""
+        return _query_cache.stats()
 
     @staticmethod
-    def query_duckdb(sql: str) -> pd.DataFrame:
+    def _run_query(sql, params=()):
+        con = DataStorage.connection()
+        return (con.execute(sql, dict(params)) if params else con.execute(sql)).df()
+
+    @staticmethod
+    def connection():
         """
-        Cached DuckDB query.
-        Cache key is the SQL string itself.
+        This thread's DuckDB connection: a cursor on the worker's one in-process database, opened
+        with DUCKDB_THREADS and DUCKDB_MEMORY_LIMIT and caching parquet footers across queries, so
+        repeated page queries skip re-reading file metadata. Reopened in a forked child.
         """
-        logging.debug("DuckDB cache miss")
-        return duckdb.query(sql).df()
+        global _duckdb_database
+        pid = os.getpid()
+        if _duckdb_database is None or _duckdb_database[0] != pid:
+            with _duckdb_lock:
+                if _duckdb_database is None or _duckdb_database[0] != pid:
+                    database = duckdb.connect(config={'threads': DUCKDB_THREADS,
+                                                      'memory_limit': DUCKDB_MEMORY_LIMIT})
+                    database.execute("SET GLOBAL parquet_metadata_cache = true")
+                    _duckdb_database = (pid, database)
+        if getattr(_duckdb_local, 'pid', None) != pid:
+            _duckdb_local.con = _duckdb_database[1].cursor()
+            _duckdb_local.pid = pid
+        return _duckdb_local.con
+
+    # Page queries (built in one place so the warm-up issues exactly the queries pages cache under)
+    @staticmethod
+    def facility_query(pattern, location, start=None, end=None, columns=None):
+        """
+        (SQL, parameters) of a FACILITY_FILTERS pattern: all rows of a facility ('facility'),
+        from start on ('facility_since'), between start and end ('facility_range') or up to end ('facility_until'),
+        or of every facility between start and end ('range', location unused).
+        Only `columns` are selected when given (see projection).
+        """
+        params = {'facility': str(location)} if "$facility" in FACILITY_FILTERS[pattern] else {}
+        if start is not None:
+            params['start'] = pd.Timestamp(start).to_pydatetime()
+        if end is not None:
+            params['end'] = pd.Timestamp(end).to_pydatetime()
+        select = ", ".join(f'"{c}"' for c in columns) if columns else "*"
+        return f"SELECT {select} FROM {DataStorage.parquet_source()} WHERE {FACILITY_FILTERS[pattern]}", params
+
+    @staticmethod
+    def query_facility(pattern, location, start=None, end=None, columns=None):
+        """
+        Rows of one facility through a FACILITY_FILTERS pattern (cached, see query_duckdb).
+        With ARROW_SNAPSHOT they are sliced from the shared Arrow snapshot instead, uncached.
+        """
+        _facility_hits[str(location)] += 1
+        if ARROW_SNAPSHOT:
+            snapshot = DataStorage.arrow_snapshot()
+            if snapshot is not None:
+                return DataStorage._arrow_facility_frame(snapshot, location, start, end, columns)
+        return DataStorage.query_duckdb(*DataStorage.facility_query(pattern, location, start, end, columns))
+
+    @staticmethod
+    def store_columns():
+        """Column names pages can select from parquet_source() (cached per data version)"""
+        return DataStorage.query_duckdb(f"DESCRIBE SELECT * FROM {DataStorage.parquet_source()}")['column_name'].tolist()
+
+    # Refresh events and warm-up
+    def publish_refresh_event(self, snapshot_id=None):
+        """Atomically rewrite data/refresh_event.json; workers watching its mtime warm their caches"""
+        event = {'refreshed_at': datetime.now().isoformat(timespec='seconds'), 'snapshot_id': snapshot_id}
+        path = os.path.join(self.data_dir, REFRESH_EVENT_FILE)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(event, f)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def data_version(data_dir=None):
+        """Version of the data queries see: the pinned snapshot, else the last refresh event"""
+        data_dir = data_dir or _data_path()
+        if SNAPSHOTS:
+            return DataStorage.snapshot_id(data_dir)
+        try:
+            return os.stat(os.path.join(data_dir, REFRESH_EVENT_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def warm_up(facilities=WARM_FACILITIES):
+        """
+        Run the queries users are about to issue against the new data: the facility frames (HMIS report
+        columns) and the default (today) dashboards of the facilities this worker served most, topped
+        up with the busiest facilities of the last week.
+        """
+        if ARROW_SNAPSHOT and DataStorage.arrow_snapshot() is not None:
+            # facility frames are cut from the mapped snapshot on demand; mapping it is the warm-up
+            return
+        started = time.perf_counter()
+        hot = [code for code, _ in _facility_hits.most_common(facilities)]
+        if len(hot) < facilities:
+            week_ago = pd.Timestamp.today().normalize() - pd.Timedelta(days=7)
+            busiest = DataStorage._run_query(
+                f"SELECT CAST({FACILITY_CODE_} AS VARCHAR) AS code, count(*) AS n "
+                f"FROM {DataStorage.parquet_source()} WHERE Date >= $start "
+                f"GROUP BY 1 ORDER BY n DESC LIMIT {int(facilities)}", (('start', week_ago.to_pydatetime()),))
+            hot += [code for code in busiest['code'] if code not in hot][:facilities - len(hot)]
+
+        # the dashboard opens on today, and loads a week before its start date
+        dashboard_since = pd.Timestamp.today().normalize() - pd.Timedelta(days=7)
+        version = DataStorage.data_version()
+        available = DataStorage.store_columns()
+        report_columns = projection.hmis_report_columns(available, _data_path("hmis_reports.json"), _data_path("uploads"))
+        dashboard_columns = projection.dashboard_columns(available, _data_path("visualizations", "validated_dashboard.json"))
+        for code in hot:
+            for sql, params in (DataStorage.facility_query('facility', code, columns=report_columns),
+                                DataStorage.facility_query('facility_since', code, dashboard_since,
+                                                           columns=dashboard_columns)):
+                params = tuple(sorted(params.items()))
+                _query_cache.put(QueryCache.key(sql, params, version), lambda: DataStorage._run_query(sql, params))
+        logging.info(f"Warmed {len(hot)} facilities in {time.perf_counter() - started:.1f}s; "
+                     f"query cache {_query_cache.stats()}")
+
+    @staticmethod
+    def start_refresh_watcher(data_dir=None, poll_seconds=WARM_POLL_SECONDS):
+        """
+        Start (once per process, so once per gunicorn worker) a daemon thread that polls the refresh
+        event's mtime and, whenever a new refresh is published, drops the cached results of older
+        data and runs warm_up() in the background.
+        """
+        data_dir = data_dir or _data_path()
+        global _watcher_pid
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+        event_path = os.path.join(data_dir, REFRESH_EVENT_FILE)
+
+        def watch():
+            seen = None
+            while True:
+                try:
+                    mtime = os.stat(event_path).st_mtime_ns
+                except FileNotFoundError:
+                    mtime = None
+                if mtime is not None and mtime != seen:
+                    seen = mtime
+                    dropped = _query_cache.invalidate(DataStorage.data_version(data_dir))
+                    logging.info(f"Refresh published; {dropped} cached results dropped")
+                    try:
+                        DataStorage.warm_up()
+                    except Exception as e:
+                        logging.warning(f"Cache warm-up failed: {e}")
+                time.sleep(poll_seconds)
+
+        threading.Thread(target=watch, name="refresh-watcher", daemon=True).start()
 
     def load_data(self):
         """Load data from Parquet and clean it."""
-        if not os.path.exists(self.filepath):
+        if not self.data_exists(self.filepath):
             logging.error("Parquet file not found, fetching fresh data...")
             self.fetch_and_save()
 
-        df = pd.read_parquet(self.filepath)
+        df = self.query_duckdb(f"SELECT * FROM {self.parquet_source(self.filepath)}", cache=False)
         df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
         df = df[df['Date'] <= datetime.now()]
         # logging.info(f"Data loaded successfully from {self.filepath}")
         return df
     def save_dcc_dropdown_json(self):
-        if not os.path.exists(self.dropdown_filepath):
+        """
+        Build the dropdown catalog (dropdowns.json) with one DuckDB aggregate scan over the
+        Program, Encounter, concept_name and obs_value_coded columns: the sorted value lists
+        the admin dropdowns use, plus value frequencies, the concepts recorded per program
+        and the coded values recorded per concept.
+        """
+        if not self.data_exists(self.filepath):
             logging.error("Parquet file not found, fetching fresh data...")
             self.fetch_and_save()
-        df = pd.read_parquet(self.filepath)
-        dropdown_json = {"programs":sorted(df.Program.dropna().unique().tolist()),
-                         "encounters":sorted(df.Encounter.dropna().unique().tolist()),
-                         "concepts":sorted(df.concept_name.dropna().unique().tolist())
-                         }
-        with open(self.dropdown_filepath, 'w') as r:
-            json.dump(dropdown_json, r, indent=2)
+        groups = {'programs': (PROGRAM_,), 'encounters': (ENCOUNTER_,), 'concepts': (CONCEPT_NAME_,),
+                  'program_concepts': (PROGRAM_, CONCEPT_NAME_),
+                  'coded_values': (CONCEPT_NAME_, OBS_VALUE_CODED_)}
+        columns = [PROGRAM_, ENCOUNTER_, CONCEPT_NAME_, OBS_VALUE_CODED_]
+        grouping_sets = ", ".join("(" + ", ".join(f'"{c}"' for c in cols) + ")" for cols in groups.values())
+        counts = self.query_duckdb(
+            f"SELECT {', '.join(f'CAST({c} AS VARCHAR) AS {c}' for c in columns)}, "
+            f"GROUPING({', '.join(columns)}) AS grouping_id, count(*) AS n "
+            f"FROM {self._store_source(self.filepath)} "
+            f"GROUP BY GROUPING SETS ({grouping_sets})", cache=False)
+
+        catalog = {'generated_at': datetime.now().isoformat(timespec='seconds'), 'counts': {}}
+        for key, cols in groups.items():
+            # GROUPING() sets a bit (first column = highest) for every column not in the set
+            grouping_id = sum(1 << (len(columns) - 1 - i) for i, c in enumerate(columns) if c not in cols)
+            rows = counts[(counts['grouping_id'] == grouping_id) & counts[list(cols)].notna().all(axis=1)]
+            if len(cols) == 1:
+                catalog[key] = sorted(rows[cols[0]].tolist())
+                catalog['counts'][key] = dict(sorted(zip(rows[cols[0]], rows['n'].astype(int).tolist())))
+            else:
+                nested = {}
+                for parent, child in sorted(zip(rows[cols[0]], rows[cols[1]])):
+                    nested.setdefault(parent, []).append(child)
+                catalog[key] = nested
+
+        os.makedirs(os.path.dirname(self.dropdown_filepath), exist_ok=True)
+        with open(f"{self.dropdown_filepath}.tmp", 'w') as r:
+            json.dump(catalog, r, indent=2)
+        os.replace(f"{self.dropdown_filepath}.tmp", self.dropdown_filepath)
+
+    @staticmethod
+    def load_catalog(path=None):
+        """The dropdown catalog, re-read only when the file changes (empty lists before the first build)"""
+        path = path or _data_path("dcc_dropdown_json", "dropdowns.json")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return {'programs': [], 'encounters': [], 'concepts': [], 'counts': {},
+                    'program_concepts': {}, 'coded_values': {}}
+        return DataStorage._read_catalog(path, mtime)
+
+    @staticmethod
+    @lru_cache(maxsize=4)
+    def _read_catalog(path, mtime):
+        with open(path) as r:
+            return json.load(r)
     def preview_data(self, col_index="Date", tail=10):
         """Print sample data for quick inspection."""
         df = self.load_data()
         print(df[col_index].tail(tail))
         print(f"Total records: {len(df)}")
         return df
-    def fetch_and_save_single_table(self):
-        """Fetch fresh data from DB and save to CSV."""
+    def fetch_and_save_single_table(self, file_format="csv"):
+        """Fetch fresh data from DB and save to CSV (or parquet with file_format="parquet")."""
         fetcher = DataFetcher(use_localhost=USE_LOCALHOST)
         df = fetcher.fetch_single_table(
             single_table_query=self.query,
-            single_table_name=self.filepath
+            single_table_name=self.filepath,
+            file_format=file_format
         )
         if df is not None and not df.empty:
-            df.to_csv(self.filepath, index=False)
-            logging.info(f"Data saved to {self.filepath} (csv format)")
+            if file_format == "csv":
+                df.to_csv(self.filepath, index=False)
+            logging.info(f"Data saved to {self.filepath} ({file_format} format)")
         else:
             logging.warning("No data fetched from database.")
 
-if __name__ == "__main__":
+    @staticmethod
+    def user_directory(data_dir=None):
+        """uuid -> tuple of roles from the users table, re-read only when the file changes"""
+        data_dir = data_dir or _data_path()
+        for name in USERS_FILES:
+            path = os.path.join(data_dir, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            return DataStorage._read_users(path, mtime)
+        return DataStorage._read_users(None, None)
+
+    @staticmethod
+    def user_roles(uuid, data_dir=None):
+        """Roles of a user (empty for unknown users), an O(1) lookup in user_directory()"""
+        data_dir = data_dir or _data_path()
+        return DataStorage.user_directory(data_dir).get(uuid, ())
+
+    @staticmethod
+    @lru_cache(maxsize=4)
+    def _read_users(path, mtime):
+        roles = {}
+        if path is not None:
+            users = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+            for user_id, role in zip(users['user_id'], users['role']):
+                roles.setdefault(user_id, []).append(role)
+        roles.setdefault(TEST_ADMIN[0], []).append(TEST_ADMIN[1])
+        return {user_id: tuple(user_roles) for user_id, user_roles in roles.items()}
+
+USERS_QUERY = "SELECT u.uuid as user_id, ur.role as role FROM users u JOIN user_role ur ON u.user_id = ur.user_id"
+
+def refresh(blocking=True):
+    """
+    One full data refresh: the main store, the dropdown options and the users table.
+    Returns False (doing nothing) when blocking is off and another refresh is running.
+    """
     storage = DataStorage(query=QERY)
-    storage.fetch_and_save()
-    storage.preview_data()
+    if not storage.fetch_and_save(blocking=blocking):
+        return False
     storage.save_dcc_dropdown_json()
 
-    users = DataStorage(query="SELECT u.uuid as user_id, ur.role as role FROM users u JOIN user_role ur ON u.user_id = ur.user_id", 
-                        filename="users_data.csv")
-    users.fetch_and_save_single_table()
+    users = DataStorage(query=USERS_QUERY, filename=f"users_data.{USERS_FILE_FORMAT}")
+    users.fetch_and_save_single_table(file_format=USERS_FILE_FORMAT)
+    # only one format on disk, so readers never pick up a stale table
+    for name in USERS_FILES:
+        if name != f"users_data.{USERS_FILE_FORMAT}" and os.path.exists(os.path.join(users.data_dir, name)):
+            os.remove(os.path.join(users.data_dir, name))
+    return True
+
+if __name__ == "__main__":
+    refresh()
+    DataStorage(query=QERY).preview_data()
@@ -3,25 +3,105 @@ import os
 from datetime import datetime, timedelta
 import socket
 import pymysql
+import pymysql.cursors
+from pymysql.constants import FIELD_TYPE
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import duckdb
 from sshtunnel import SSHTunnelForwarder
-import tempfile
-import pickle
+import shutil
+import glob
+import json
+import hashlib
+import fcntl
 import logging
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
-from config import DB_CONFIG, SSH_CONFIG, DB_CONFIG_LOCAL, START_DATE, LOAD_FRESH_DATA
+import config_defaults  # noqa: F401  (defaults for settings an older config.py lacks)
+from config import DB_CONFIG, SSH_CONFIG, DB_CONFIG_LOCAL, START_DATE, LOAD_FRESH_DATA, DATA_SCHEMA
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# MySQL column type -> Arrow type used when streaming result sets to parquet.
+# Anything not listed (VARCHAR, TEXT, ENUM, ...) is written as a string column.
+MYSQL_ARROW_TYPES = {
+    FIELD_TYPE.TINY: pa.int64(),
+    FIELD_TYPE.SHORT: pa.int64(),
+    FIELD_TYPE.INT24: pa.int64(),
+    FIELD_TYPE.LONG: pa.int64(),
+    FIELD_TYPE.LONGLONG: pa.int64(),
+    FIELD_TYPE.YEAR: pa.int64(),
+    FIELD_TYPE.FLOAT: pa.float64(),
+    FIELD_TYPE.DOUBLE: pa.float64(),
+    FIELD_TYPE.DECIMAL: pa.float64(),
+    FIELD_TYPE.NEWDECIMAL: pa.float64(),
+    FIELD_TYPE.DATE: pa.date32(),
+    FIELD_TYPE.NEWDATE: pa.date32(),
+    FIELD_TYPE.DATETIME: pa.timestamp('us'),
+    FIELD_TYPE.TIMESTAMP: pa.timestamp('us'),
+}
+
+
+# Stable row key used to upsert/deduplicate rows instead of drop_duplicates() over every column.
+# It is a 64-bit hash of the columns that identify an extracted obs row (those present are used).
+ROW_KEY_COLUMN = 'row_key'
+ROW_KEY_COLUMNS = ['encounter_id', 'obs_id', 'concept_name', 'obs_value_coded', 'Value', 'ValueN',
+                   'DrugName', 'Value_name', 'Order_Name']
+
+# Change data capture high-water marks: dataset column -> source column.
+# Ids advance with '>', timestamps with '>=' minus CDC_LOOKBACK_MINUTES (upserts are idempotent).
+CDC_WATERMARKS = {
+    'obs_id': 'o.obs_id',
+    'encounter_id': 'e.encounter_id',
+    'obs_date_created': 'o.date_created',
+    'encounter_date_changed': 'e.date_changed',
+    'obs_date_voided': 'o.date_voided',
+}
+CDC_ID_WATERMARKS = ('obs_id', 'encounter_id')
+# Baseline loads in CDC mode leave voided obs out; later voids arrive as deletes
+CDC_BASE_FILTER = "AND (o.obs_id IS NULL OR o.voided = 0) "
+
+# Hive partition columns of the partitioned store. Partition values are always read back as text.
+PARTITION_COLUMNS = ['year_month', 'Facility_CODE']
+HIVE_TYPES_SQL = "{'year_month': VARCHAR, 'Facility_CODE': VARCHAR}"
+
+# Sorted storage layout: every query filters on Facility_CODE then Date, so rows sorted this way
+# give row groups with narrow min/max statistics that DuckDB can skip.
+SORT_COLUMNS = ['Facility_CODE', 'Date', 'encounter_id']
+SORTED_COMPRESSION = 'zstd'
+
+# Star-schema serving tables: dimension -> (key column, attributes that may move off the fact table).
+# Only attributes with a single value per key in the store are moved, so no row ever reads another
+# row's value; anything that varies over time (addresses, the user's District) stays on the fact table.
+STAR_DIMENSIONS = {
+    'person': ('person_id', ['given_name', 'family_name', 'Gender']),
+    'location': ('Facility_CODE', ['Facility']),
+}
+# Published star schemas kept under star_dir (readers of the previous one finish on it)
+STAR_RETENTION = 2
+# Concept-name columns stored on the fact table as int keys (<column>_key) into dim_concept
+STAR_CONCEPT_COLUMNS = ['concept_name', 'obs_value_coded', 'Value_name']
+
+# Per-person visit columns maintained locally (instead of a GROUP BY over the whole encounter
+# table in the source query) and joined onto rows on read
+VISIT_COLUMNS = ['visit_days', 'new_revisit']
+
 
 if LOAD_FRESH_DATA:
-    # drop file latest_data_opd.parquet if exists in data folder
+    # drop file latest_data_opd.parquet (and its partitioned dataset) if exists in data folder
     file_path = os.path.join(os.getcwd(), "data", "latest_data_opd.parquet")
     if os.path.exists(file_path):
         os.remove(file_path)
         logger.info("Removed existing data file for fresh load.")
+    if os.path.isdir(os.path.splitext(file_path)[0]):
+        shutil.rmtree(os.path.splitext(file_path)[0])
+        logger.info("Removed existing partitioned dataset for fresh load.")
 
 
 class DataFetcher:
@@ -30,37 +110,134 @@ class DataFetcher:
       - per-day batch parquet saving
       - safe read of main parquet (quarantines corrupted file)
       - rebuild main parquet from daily batches
-      - recovery state to resume partially finished runs
+      - JSON checkpoint manifest (completed days, batch checksums) to resume partially finished runs
       - automatic re-attempts when batch save/read fails
+      - optional streaming mode: server-side cursor -> Arrow record batches -> daily parquet
+      - optional parallel backfill: day ranges spread over a bounded set of connections
+      - optional hive-partitioned store where a refresh only rewrites touched partitions
+      - optional watermark-based change data capture (new/changed obs upserted, voided obs deleted)
+      - optional sorted layout (Facility_CODE, Date, encounter_id) with zstd and sized row groups
+      - optional star-schema serving tables (narrow fact + person/location/concept dimensions)
+      - optional local, incremental visit_days / first & last visit per person
     """
 
-    def __init__(self, use_localhost=False, ssh_config=SSH_CONFIG, db_config=DB_CONFIG,
-                 max_batch_save_retries=3, batch_retry_delay=2):
+    def __init__(self, use_localhost=False, ssh_config=SSH_CONFIG, db_config=None,
+                 max_batch_save_retries=3, batch_retry_delay=2, streaming=False,
+                 arrow_batch_rows=50000, parallel_workers=1, days_per_task=7, partitioned=False,
+                 cdc=False, cdc_state_file=None, cdc_lookback_minutes=10, sorted_layout=False,
+                 row_group_rows=122880, checkpoint_file=None, track_visits=False, derived_columns=None,
+                 connection_factory=None, run_report_file=None, run_report_history=200, state_dir=None):
         """
         Initialize DataFetcher with connection options
 
         Args:
             use_localhost: Boolean - True for local DB, False for remote
             ssh_config: SSH configuration for remote connection
-            db_config: Database configuration
+            db_config: Database configuration (default DB_CONFIG_LOCAL or DB_CONFIG per use_localhost)
             max_batch_save_retries: how many times to retry saving/validating a batch parquet
             batch_retry_delay: seconds to wait between retries
+            streaming: stream each day through an unbuffered cursor straight into its
+                batch parquet instead of building the day's DataFrame in memory
+            arrow_batch_rows: rows per Arrow record batch when streaming
+            parallel_workers: number of concurrent DB connections used to backfill days
+                (1 keeps the sequential single-connection behaviour)
+            days_per_task: length of the day ranges handed to each parallel worker
+            partitioned: keep the main store as a hive-partitioned dataset
+                (year_month=YYYY-MM/Facility_CODE=X/) and only rewrite touched partitions
+            cdc: after a baseline load, fetch only rows past the stored high-water marks
+                (obs_id, encounter_id, obs/encounter timestamps) and apply voided obs as deletes
+            cdc_state_file: JSON file holding the high-water marks (default data/cdc_state.json)
+            cdc_lookback_minutes: overlap re-read on timestamp marks to catch late commits
+            sorted_layout: write parquet sorted by SORT_COLUMNS, zstd-compressed, with
+                row_group_rows-sized row groups and page statistics
+            row_group_rows: rows per row group when sorted_layout is on
+            checkpoint_file: JSON manifest of the days a run has extracted/merged, with
+                batch checksums, used to resume an interrupted run (default data/checkpoint.json)
+            track_visits: after each run update the per-person visit tables next to the store
+                (visit_days, new_revisit, first/last visit date) from the days it re-extracted
+            derived_columns: {name: (DuckDB expression, [source columns])} computed on every store
+                write when the source columns are present (an existing column of that name is replaced).
+                Expressions must be idempotent since rows are rewritten by later merges
+            connection_factory: zero-argument callable returning a DB-API connection, used instead
+                of the pymysql routes (no SSH tunnel), e.g. a local stand-in database for benchmarks
+            run_report_file: JSON-lines history of fetch_data run reports (per-day SQL/transfer/write
+                timings, rows, bytes, retries, quarantined batches), default data/run_reports.jsonl
+            run_report_history: number of run reports kept in run_report_file
+            state_dir: directory of the run's recovery state (daily batches, checkpoint, CDC marks,
+                run reports), default data/. Give each fetcher its own when several run at once
         """
         self.use_localhost = use_localhost
         self.ssh_route = ssh_config if not use_localhost else None
-        self.db_route = DB_CONFIG_LOCAL if use_localhost else db_config
+        self.db_route = db_config or (DB_CONFIG_LOCAL if use_localhost else DB_CONFIG)
         self.path = os.path.dirname(os.path.realpath(__file__))
-        self.recovery_file = os.path.join(tempfile.gettempdir(), "data_fetch_recovery.pkl")
+        self.state_dir = state_dir or os.path.join(self.path, "data")
+        self.checkpoint_file = checkpoint_file or os.path.join(self.state_dir, "checkpoint.json")
         self.max_batch_save_retries = max_batch_save_retries
         self.batch_retry_delay = batch_retry_delay
+        self.streaming = streaming
+        self.arrow_batch_rows = arrow_batch_rows
+        self.parallel_workers = max(1, int(parallel_workers))
+        self.days_per_task = max(1, int(days_per_task))
+        self.partitioned = partitioned
+        self.cdc = cdc
+        self.cdc_state_file = cdc_state_file or os.path.join(self.state_dir, "cdc_state.json")
+        self.cdc_lookback_minutes = cdc_lookback_minutes
+        self.sorted_layout = sorted_layout
+        self.row_group_rows = row_group_rows
+        self.track_visits = track_visits
+        self.derived_columns = derived_columns or {}
+        self.connection_factory = connection_factory
+        self.run_report_file = run_report_file or os.path.join(self.state_dir, "run_reports.jsonl")
+        self.run_report_history = run_report_history
+        self.run_report = None
+        self._report_lock = threading.Lock()
 
         # ensure data directories exist
-        os.makedirs(os.path.join(self.path, "data", "batches"), exist_ok=True)
+        os.makedirs(os.path.join(self.state_dir, "batches"), exist_ok=True)
+
+    @property
+    def disk_merge(self):
+        """True when runs merge daily batch files into the main parquet instead of returning a DataFrame"""
+        return self.streaming or self.parallel_workers > 1 or self.partitioned or self.cdc
+
+    @staticmethod
+    def dataset_dir(filename):
+        """Directory of the partitioned dataset that replaces a single parquet file (x.parquet -> x/)"""
+        return os.path.splitext(filename)[0]
+
+    def _store_path(self, filename):
+        """Path of the main store: the parquet file, or its dataset directory in partitioned mode"""
+        return self.dataset_dir(filename) if self.partitioned else filename
+
+    @contextmanager
+    def _open_tunnel(self):
+        """Yield an SSH tunnel for remote routes (shared by all connections of a run), or None for localhost"""
+        if self.use_localhost or self.connection_factory is not None:
+            yield None
+            return
+
+        if self.ssh_route and "ssh_password" in self.ssh_route:
+            logger.info("Using password for SSH")
+            auth = {'ssh_password': self.ssh_route['ssh_password']}
+        else:
+            logger.info("Using private key for SSH")
+            auth = {'ssh_private_key': f"ssh/{self.ssh_route['ssh_pkey']}"}
+
+        with SSHTunnelForwarder(
+                (self.ssh_route['ssh_host'], 22),
+                ssh_username=self.ssh_route['ssh_user'],
+                remote_bind_address=self.ssh_route['remote_bind_address'],
+                **auth
+        ) as tunnel:
+            logger.info(f"SSH tunnel established on port {tunnel.local_bind_port}")
+            yield tunnel
 
     def _get_db_connection(self, tunnel=None):
         """Establish database connection with error handling"""
         try:
-            if not self.use_localhost:
+            if self.connection_factory is not None:
+                conn = self.connection_factory()
+            elif not self.use_localhost:
                 # Remote connection with SSH tunnel
                 sock = socket.socket()
                 sock.settimeout(30)
@@ -96,6 +273,100 @@ class DataFetcher:
             raise
 
 
+    # Run telemetry
+    def _start_run_report(self, filename):
+        """Begin the report of one fetch_data run"""
+        started = datetime.now()
+        self.run_report = {
+            'run_id': started.strftime('%Y%m%dT%H%M%S%f'),
+            'store': filename,
+            'started_at': started.isoformat(timespec='seconds'),
+            'mode': {'streaming': self.streaming, 'parallel_workers': self.parallel_workers,
+                     'partitioned': self.partitioned, 'cdc': self.cdc, 'sorted_layout': self.sorted_layout},
+            'status': 'running',
+            'days': {},
+            'phases': {},
+            'quarantined': [],
+            '_started': time.perf_counter(),
+        }
+
+    def _record_day(self, day, **metrics):
+        """Add timings (seconds), rows, bytes and retries to a day's entry of the run report (thread-safe)"""
+        if self.run_report is None:
+            return
+        with self._report_lock:
+            entry = self.run_report['days'].setdefault(day, {
+                'sql_seconds': 0.0, 'transfer_seconds': 0.0, 'write_seconds': 0.0,
+                'rows': 0, 'bytes': 0, 'retries': 0})
+            for name, value in metrics.items():
+                entry[name] = entry.get(name, 0) + value
+
+    def _record_quarantined(self, day, path):
+        if self.run_report is None:
+            return
+        with self._report_lock:
+            self.run_report['quarantined'].append({'day': day, 'path': path})
+
+    @contextmanager
+    def _timed_phase(self, name):
+        """Add the wall-clock time of a block (merge, visits, ...) to a phase of the run report"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.run_report is not None:
+                with self._report_lock:
+                    phases = self.run_report['phases']
+                    phases[name] = round(phases.get(name, 0) + time.perf_counter() - started, 4)
+
+    def _finish_run_report(self, store_path):
+        """Total the run report and append it to the rolling history in run_report_file"""
+        report = self.run_report
+        if report is None:
+            return
+        seconds = time.perf_counter() - report.pop('_started')
+        if report['status'] == 'running':
+            report['status'] = 'ok'
+        report['finished_at'] = datetime.now().isoformat(timespec='seconds')
+        report['seconds'] = round(seconds, 3)
+        for entry in report['days'].values():
+            for name in ('sql_seconds', 'transfer_seconds', 'write_seconds'):
+                entry[name] = round(entry[name], 4)
+        totals = {name: sum(entry[name] for entry in report['days'].values())
+                  for name in ('sql_seconds', 'transfer_seconds', 'write_seconds', 'rows', 'bytes', 'retries')}
+        totals.update({name: round(totals[name], 3) for name in ('sql_seconds', 'transfer_seconds', 'write_seconds')})
+        totals['rows_per_sec'] = round(totals['rows'] / seconds) if seconds else None
+        if os.path.isdir(store_path):
+            totals['store_bytes'] = sum(os.path.getsize(f) for f in glob.glob(os.path.join(store_path, '**', '*.parquet'),
+                                                                                recursive=True))
+        elif os.path.exists(store_path):
+            totals['store_bytes'] = os.path.getsize(store_path)
+        report['totals'] = totals
+
+        try:
+            history = self.run_reports(self.run_report_file)
+            history.append(report)
+            os.makedirs(os.path.dirname(self.run_report_file), exist_ok=True)
+            with open(f"{self.run_report_file}.tmp", 'w') as f:
+                for entry in history[-max(self.run_report_history, 1):]:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(f"{self.run_report_file}.tmp", self.run_report_file)
+        except Exception as e:
+            logger.warning(f"Could not write run report: {e}")
+        logger.info(f"Run {report['run_id']} {report['status']}: {totals['rows']} rows in {report['seconds']}s "
+                    f"(sql {totals['sql_seconds']}s, transfer {totals['transfer_seconds']}s, "
+                    f"write {totals['write_seconds']}s, phases {report['phases']})")
+
+    @staticmethod
+    def run_reports(report_file, limit=None):
+        """Run reports kept in report_file, oldest first (the last `limit` only when given)"""
+        try:
+            with open(report_file, 'r') as f:
+                reports = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+        return reports[-limit:] if limit else reports
+
     # Safe parquet helpers
     def safe_read_parquet(self, filepath):
         """
@@ -119,7 +390,7 @@ class DataFetcher:
 
     def _batch_file_path(self, current_date):
         """Return absolute path for a day's batch parquet file"""
-        batch_dir = os.path.join(self.path, "data", "batches")
+        batch_dir = os.path.join(self.state_dir, "batches")
         return os.path.join(batch_dir, f"{current_date.strftime('%Y-%m-%d')}.parquet")
 
     def _save_daily_batch(self, df, current_date):
@@ -133,13 +404,16 @@ class DataFetcher:
             return None
 
         batch_path = self._batch_file_path(current_date)
+        label = current_date.strftime('%Y-%m-%d')
+        df = self._with_row_key(df)
 
         attempt = 0
         while attempt < self.max_batch_save_retries:
+            started = time.perf_counter()
             try:
                 # Save batch file (atomic approach)
                 temp_batch = f"{batch_path}.tmp"
-                df.to_parquet(temp_batch, index=False, engine="pyarrow")
+                self.write_parquet(df, temp_batch)
                 os.replace(temp_batch, batch_path)
                 logger.info(f"📦 Saved batch file: {batch_path} ({len(df)} rows)")
 
@@ -149,10 +423,13 @@ class DataFetcher:
                 if validated_df is None or validated_df.empty:
                     raise ValueError("Validated batch read returned empty DataFrame")
 
+                self._record_day(label, write_seconds=time.perf_counter() - started, rows=len(validated_df),
+                                 bytes=os.path.getsize(batch_path))
                 return validated_df
 
             except Exception as e:
                 attempt += 1
+                self._record_day(label, write_seconds=time.perf_counter() - started, retries=1)
                 logger.error(f"Attempt {attempt}/{self.max_batch_save_retries} failed saving/validating "
                              f"batch {batch_path}: {e}")
                 # try to cleanup temp file if exists
@@ -173,6 +450,7 @@ class DataFetcher:
             if os.path.exists(batch_path):
                 os.replace(batch_path, quarantined)
             logger.error(f"All retries failed. Batch moved to {quarantined}")
+            self._record_quarantined(label, quarantined)
         except Exception as ex:
             logger.error(f"Failed to quarantine bad batch file: {ex}")
 
@@ -183,7 +461,7 @@ class DataFetcher:
         Rebuild the main parquet from saved daily batch parquets.
         Returns the rebuilt DataFrame (or empty df on failure).
         """
-        batch_dir = os.path.join(self.path, "data", "batches")
+        batch_dir = os.path.join(self.state_dir, "batches")
         if not os.path.exists(batch_dir):
             logger.error("No batch directory exists to rebuild from.")
             return pd.DataFrame()
@@ -210,11 +488,11 @@ class DataFetcher:
             logger.error("All batch files failed to load. Cannot rebuild.")
             return pd.DataFrame()
 
-        final_df = pd.concat(frames, ignore_index=True).drop_duplicates()
+        final_df = self._dedupe_by_key(pd.concat(frames, ignore_index=True))
         # Atomic write
         temp_main = f"{main_file}.tmp"
         try:
-            final_df.to_parquet(temp_main, index=False, engine="pyarrow")
+            self.write_parquet(final_df, temp_main)
             os.replace(temp_main, main_file)
             logger.info(f"🎉 Main parquet rebuilt successfully from {len(frames)} batch files")
         except Exception as e:
@@ -228,32 +506,169 @@ class DataFetcher:
 
         return final_df
 
-    # Recovery helpers
-    def _save_recovery_state(self, state):
-        """Save recovery state to file"""
+    # Keyed upsert / dedup
+    @staticmethod
+    def _row_keys(df):
+        """
+        64-bit row keys from the identifying columns. Numeric columns are hashed as float64 so a
+        key does not change when a column is read back as float (ints with NULLs) or int.
+        """
+        columns = [c for c in ROW_KEY_COLUMNS if c in df.columns]
+        if not columns:
+            columns = [c for c in df.columns if c != ROW_KEY_COLUMN]
+        parts = pd.DataFrame({
+            c: df[c].astype('float64') if pd.api.types.is_numeric_dtype(df[c]) else df[c]
+            for c in columns
+        })
+        return pd.util.hash_pandas_object(parts, index=False).to_numpy()
+
+    def _with_row_key(self, df):
+        """
+        Return df with a complete uint64 row_key column. Stored keys are reused as they are; any other
+        dtype (float64 or object after concatenating frames with and without keys, where hashes above
+        2**53 are already rounded) is recomputed from the key columns.
+        """
+        if df.empty:
+            return df
+        if ROW_KEY_COLUMN not in df.columns or df[ROW_KEY_COLUMN].dtype != 'uint64':
+            return df.assign(**{ROW_KEY_COLUMN: self._row_keys(df)})
+        return df
+
+    def _append_row_key(self, batch):
+        """Add the row_key column to an Arrow record batch"""
+        key_columns = [c for c in ROW_KEY_COLUMNS if c in batch.schema.names] or batch.schema.names
+        keys = self._row_keys(batch.select(key_columns).to_pandas())
+        return batch.append_column(ROW_KEY_COLUMN, pa.array(keys, type=pa.uint64()))
+
+    def _dedupe_by_key(self, df):
+        """Drop duplicate rows by row_key (last one wins) instead of comparing every column"""
+        df = self._with_row_key(df)
+        if df.empty:
+            return df
+        return df.drop_duplicates(subset=[ROW_KEY_COLUMN], keep='last', ignore_index=True)
+
+    def _keyed_merge(self, existing_df, incoming_df):
+        """
+        Upsert incoming rows into existing_df by row_key.
+        Only the incoming keys are hashed into a lookup set; existing rows are probed against it
+        by their stored key, so no full-frame duplicate scan is needed.
+        """
+        incoming_df = self._dedupe_by_key(incoming_df)
+        if existing_df is None or existing_df.empty:
+            return incoming_df
+        if incoming_df.empty:
+            return existing_df
+        existing_df = self._with_row_key(existing_df)
+        replaced = existing_df[ROW_KEY_COLUMN].isin(incoming_df[ROW_KEY_COLUMN])
+        return pd.concat([existing_df[~replaced.to_numpy()], incoming_df], ignore_index=True)
+
+    def _merge_existing_file(self, filename, df):
+        """
+        Merge a frame with the rows already in filename. Only the stored row_key column is
+        read first; the full file is only loaded if it holds rows the frame does not have.
+        """
+        df = self._dedupe_by_key(df)
         try:
-            with open(self.recovery_file, 'wb') as f:
-                pickle.dump(state, f)
+            existing_keys = pd.read_parquet(filename, columns=[ROW_KEY_COLUMN], engine="pyarrow")[ROW_KEY_COLUMN]
+        except Exception:
+            existing_keys = None
+
+        if existing_keys is not None and not existing_keys.isna().any():
+            only_existing = ~existing_keys.isin(df[ROW_KEY_COLUMN]).to_numpy()
+            if not only_existing.any():
+                return df
+            existing_df = self.safe_read_parquet(filename)
+            if len(existing_df) == len(only_existing):
+                return pd.concat([existing_df[only_existing], df], ignore_index=True)
+            return self._keyed_merge(existing_df, df)
+
+        existing_df = self.safe_read_parquet(filename)
+        return self._keyed_merge(existing_df, df)
+
+    # Checkpoint manifest
+    def _load_checkpoint(self, filename):
+        """
+        Load the checkpoint manifest of an interrupted run into the given main file.
+        Returns an empty manifest when there is none, it is unreadable or it belongs to another file.
+        Layout: {"filename": ..., "days": {"YYYY-MM-DD": {"status": "extracted"|"merged",
+                 "rows": n, "last_encounter_id": id, "batch": "YYYY-MM-DD.parquet", "sha256": ...}}}
+        """
+        manifest = {'filename': os.path.abspath(filename), 'days': {}}
+        if not os.path.exists(self.checkpoint_file):
+            return manifest
+        try:
+            with open(self.checkpoint_file, 'r') as f:
+                saved = json.load(f)
         except Exception as e:
-            logger.warning(f"Failed to save recovery state: {e}")
+            logger.warning(f"Failed to load checkpoint manifest: {e}")
+            return manifest
+        if saved.get('filename') != manifest['filename']:
+            logger.warning(f"Ignoring checkpoint manifest written for {saved.get('filename')}")
+            return manifest
+        manifest['days'] = saved.get('days', {})
+        return manifest
+
+    def _save_checkpoint(self, manifest):
+        """Atomically write the checkpoint manifest"""
+        try:
+            state = dict(manifest, updated_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            temp_file = f"{self.checkpoint_file}.tmp"
+            os.makedirs(os.path.dirname(self.checkpoint_file), exist_ok=True)
+            with open(temp_file, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(temp_file, self.checkpoint_file)
+        except Exception as e:
+            logger.warning(f"Failed to save checkpoint manifest: {e}")
 
-    def _load_recovery_state(self):
-        """Load recovery state if exists"""
-        if os.path.exists(self.recovery_file):
+    def _clear_checkpoint(self):
+        """Remove the checkpoint manifest once a run has finished"""
+        if os.path.exists(self.checkpoint_file):
             try:
-                with open(self.recovery_file, 'rb') as f:
-                    return pickle.load(f)
-            except Exception as e:
-                logger.warning(f"Failed to load recovery state: {e}")
-        return None
+                os.remove(self.checkpoint_file)
+            except Exception:
+                pass
 
-    def _clear_recovery_state(self):
-        """Clean up recovery file"""
-        if os.path.exists(self.recovery_file):
+    @staticmethod
+    def _file_checksum(path):
+        """sha256 of a file, read in chunks"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _checkpoint_entry(self, current_date, rows, status='extracted'):
+        """Manifest entry for a day whose batch file (if any) has been written and validated"""
+        batch_path = self._batch_file_path(current_date)
+        entry = {'status': status, 'rows': int(rows), 'last_encounter_id': None, 'batch': None, 'sha256': None}
+        if rows and os.path.exists(batch_path):
+            entry['batch'] = os.path.basename(batch_path)
+            entry['sha256'] = self._file_checksum(batch_path)
             try:
-                os.remove(self.recovery_file)
-            except Exception:
+                ids = pq.read_table(batch_path, columns=['encounter_id']).column(0)
+                last_id = pc.max(ids).as_py()
+                entry['last_encounter_id'] = None if last_id is None else int(last_id)
+            except (KeyError, pa.ArrowInvalid):
                 pass
+        return entry
+
+    def _verified_days(self, manifest, status=None):
+        """
+        Days of the manifest that can be skipped on resume: empty days, and days whose batch file
+        is still on disk with the recorded checksum. Optionally limited to one status.
+        """
+        verified = []
+        for day, entry in manifest['days'].items():
+            if status is not None and entry.get('status') != status:
+                continue
+            if entry.get('batch'):
+                batch_path = self._batch_file_path(pd.Timestamp(day))
+                if not os.path.exists(batch_path) or self._file_checksum(batch_path) != entry.get('sha256'):
+                    if entry.get('status') != 'merged':
+                        logger.warning(f"Batch for {day} missing or changed since checkpoint; re-extracting")
+                        continue
+            verified.append(day)
+        return sorted(verified)
 
     # Main process flow
     def fetch_data(self, query_template, filename='data/latest_data_opd.parquet',
@@ -267,76 +682,87 @@ class DataFetcher:
             date_column: Date column for incremental loading
             batch_size: Number of records per batch
             force_rebuild: If True, will rebuild the file from scratch with default start date
+
+        Returns:
+            The combined DataFrame, or None in streaming/parallel mode (data is only written to disk)
         """
         # Create absolute path
         abs_filename = os.path.join(self.path, filename)
         os.makedirs(os.path.dirname(abs_filename), exist_ok=True)
+        # single parquet file, or the partitioned dataset directory next to it
+        store_path = self._store_path(abs_filename)
+        self._start_run_report(abs_filename)
 
         try:
+            if self.partitioned and not os.path.exists(store_path) and os.path.exists(abs_filename):
+                self._migrate_to_partitions(abs_filename, store_path, date_column)
+
+            if self.cdc:
+                if (not force_rebuild and self._load_cdc_state() is not None and os.path.exists(store_path)
+                        and self._is_existing_file_valid(store_path, date_column)):
+                    return self._fetch_changes(query_template, abs_filename, date_column)
+                # no watermarks yet: do a normal day-by-day baseline load without voided obs
+                logger.info("No CDC watermarks found; running baseline load")
+                query_template = query_template.replace("{date_filter}", CDC_BASE_FILTER + "{date_filter}")
+
             # 1. Determine start date
-            file_exists = os.path.exists(abs_filename)
-            if force_rebuild or not file_exists or not self._is_existing_file_valid(abs_filename, date_column):
+            file_exists = os.path.exists(store_path)
+            if force_rebuild or not file_exists or not self._is_existing_file_valid(store_path, date_column):
                 logger.warning("Starting fresh rebuild (force rebuild or missing/invalid file)")
                 start_date = START_DATE  # Default start date for rebuilds
                 if file_exists:
                     # safe_read_parquet would have moved corrupt file; ensure removal for fresh rebuild
                     try:
-                        os.remove(abs_filename)
+                        if os.path.isdir(store_path):
+                            shutil.rmtree(store_path)
+                        else:
+                            os.remove(store_path)
                     except Exception:
                         pass
-                self._clear_recovery_state()
+                self._clear_checkpoint()
             else:
-                start_date = self._get_last_extraction_date(abs_filename, date_column)
+                start_date = self._get_last_extraction_date(store_path, date_column)
                 if start_date is None:
                     # fallback
                     start_date = START_DATE
 
             # 2. Process in batches with recovery
-            if self.use_localhost:
-                conn = self._get_db_connection()
-                try:
-                    final_df = self._process_daily_batches(conn, query_template, abs_filename,
-                                                          date_column, batch_size, start_date)
-                finally:
-                    conn.close()
-            elif self.ssh_route and "ssh_password" in self.ssh_route:
-                logger.info("Using password for SSH")
-                with SSHTunnelForwarder(
-                        (self.ssh_route['ssh_host'], 22),
-                        ssh_username=self.ssh_route['ssh_user'],
-                        ssh_password=self.ssh_route['ssh_password'],
-                        remote_bind_address=self.ssh_route['remote_bind_address']
-                ) as tunnel:
-                    logger.info(f"SSH tunnel established on port {tunnel.local_bind_port}")
+            with self._open_tunnel() as tunnel:
+                # the partitioned store is only ever fed from daily batch files, never a full DataFrame
+                if self.parallel_workers > 1 or (self.partitioned and not self.streaming):
+                    self._parallel_daily_batches(tunnel, query_template, abs_filename,
+                                                 date_column, batch_size, start_date)
+                    final_df = None
+                else:
                     conn = self._get_db_connection(tunnel)
                     try:
                         final_df = self._process_daily_batches(conn, query_template, abs_filename,
                                                               date_column, batch_size, start_date)
                     finally:
                         conn.close()
+
+            if final_df is None:
+                # Daily batches are merged into the main parquet on disk; nothing is held in memory
+                result = None
             else:
-                logger.info("Using private key for SSH")
-                with SSHTunnelForwarder(
-                        (self.ssh_route['ssh_host'], 22),
-                        ssh_username=self.ssh_route['ssh_user'],
-                        ssh_private_key=f"ssh/{self.ssh_route['ssh_pkey']}",
-                        remote_bind_address=self.ssh_route['remote_bind_address']
-                ) as tunnel:
-                    logger.info(f"SSH tunnel established on port {tunnel.local_bind_port}")
-                    conn = self._get_db_connection(tunnel)
-                    try:
-                        final_df = self._process_daily_batches(conn, query_template, abs_filename,
-                                                              date_column, batch_size, start_date)
-                    finally:
-                        conn.close()
+                with self._timed_phase('finalize'):
+                    result = self._finalize_operation(final_df, abs_filename)
 
-            return self._finalize_operation(final_df, abs_filename)
+            if self.cdc:
+                self._save_cdc_state(self._store_watermarks(store_path))
+            if self.track_visits:
+                with self._timed_phase('visits'):
+                    self.refresh_visits(abs_filename, date_column, since=start_date)
+            return result
 
         except Exception as e:
             logger.error(f"Data fetch failed: {e}")
             logger.info("Recovery data preserved. Will resume from last batch.")
+            self.run_report.update(status='failed', error=str(e))
             raise
-    def fetch_single_table(self, single_table_name, single_table_query):
+        finally:
+            self._finish_run_report(store_path)
+    def fetch_single_table(self, single_table_name, single_table_query, file_format="csv"):
         """
         Robust incremental data fetcher with auto-rebuild capability
         
@@ -346,15 +772,16 @@ class DataFetcher:
             date_column: Date column for incremental loading
             batch_size: Number of records per batch
             force_rebuild: If True, will rebuild the file from scratch with default start date 2025-01-01
+            file_format: "csv", or "parquet" for a compact typed file (written atomically)
         """
         
         try:
             
-            if self.use_localhost:
+            if self.use_localhost or self.connection_factory is not None:
                 conn = self._get_db_connection()
                 try:
                     table_df = pd.read_sql(single_table_query, conn)
-                    table_df.to_csv(os.path.join(self.path, single_table_name))
+                    self._save_single_table(table_df, os.path.join(self.path, single_table_name), file_format)
                 finally:
                     conn.close()
             elif "ssh_password" in self.ssh_route:
@@ -370,7 +797,7 @@ class DataFetcher:
                     conn = self._get_db_connection(tunnel)
                     try:
                         table_df = pd.read_sql(single_table_query, conn)
-                        table_df.to_csv(os.path.join(self.path, single_table_name))
+                        self._save_single_table(table_df, os.path.join(self.path, single_table_name), file_format)
                     finally:
                         conn.close()
             else:
@@ -389,7 +816,7 @@ class DataFetcher:
                     conn = self._get_db_connection(tunnel)
                     try:
                         table_df = pd.read_sql(single_table_query, conn)
-                        table_df.to_csv(os.path.join(self.path, single_table_name))
+                        self._save_single_table(table_df, os.path.join(self.path, single_table_name), file_format)
                     finally:
                         conn.close()
             
@@ -398,36 +825,46 @@ class DataFetcher:
         except Exception as e:
             logger.error(f"Data fetch failed: {e}")
             raise
+
+    @staticmethod
+    def _save_single_table(table_df, path, file_format):
+        """Write a fetched lookup table as csv or, swapped in atomically, as parquet"""
+        if file_format == "parquet":
+            table_df.to_parquet(f"{path}.tmp", index=False)
+            os.replace(f"{path}.tmp", path)
+        else:
+            table_df.to_csv(path)
         
     def _process_daily_batches(self, conn, query_template, filename, date_column, batch_size, start_date):
         """Process data day by day with batch processing within each day"""
-        recovery_state = self._load_recovery_state()
+        if self.streaming:
+            return self._stream_daily_batches(conn, query_template, filename, date_column, start_date)
+
+        manifest = self._load_checkpoint(filename)
 
         # LOAD EXISTING DATA FIRST (using safe reader)
         existing_df = self.safe_read_parquet(filename)
-        if existing_df.empty and os.path.exists(os.path.join(self.path, "data", "batches")):
+        if existing_df.empty and os.path.exists(os.path.join(self.state_dir, "batches")):
             # try to rebuild from batches if existing read failed/returned empty
             logger.warning("Main parquet empty/corrupt — attempting rebuild from batches...")
             rebuilt = self.rebuild_main_file_from_batches(filename)
             if not rebuilt.empty:
                 existing_df = rebuilt
 
-        if recovery_state:
-            # if recovery contains partial df, it's only new data not yet merged into main file
-            current_date = pd.to_datetime(recovery_state.get('current_date'))
-            new_data_df = recovery_state.get('df', pd.DataFrame())
-            last_id = recovery_state.get('last_id', 0)
-            # ensure new_data_df is DataFrame
-            if not isinstance(new_data_df, pd.DataFrame):
-                new_data_df = pd.DataFrame(new_data_df)
-        else:
-            current_date = pd.to_datetime(start_date)
-            new_data_df = pd.DataFrame()  # Only new data
-            last_id = 0
+        # days an interrupted run extracted but did not merge into the main file are replayed from their batch files
+        pending_days = self._verified_days(manifest, status='extracted')
+        done_days = set(self._verified_days(manifest, status='merged')) | set(pending_days)
+        pending_frames = [pd.read_parquet(self._batch_file_path(pd.Timestamp(day)), engine="pyarrow")
+                          for day in pending_days if manifest['days'][day].get('batch')]
+        new_data_df = pd.concat(pending_frames, ignore_index=True) if pending_frames else pd.DataFrame()
+        if done_days:
+            logger.info(f"Resuming from checkpoint: {len(done_days)} days already extracted")
+        current_date = pd.to_datetime(start_date)
+        last_id = 0
 
         # COMBINE EXISTING AND NEW DATA (safe)
         if not existing_df.empty and not new_data_df.empty:
-            final_df = pd.concat([existing_df, new_data_df], ignore_index=True).drop_duplicates()
+            final_df = self._keyed_merge(existing_df, new_data_df)
         elif not existing_df.empty:
             final_df = existing_df.copy()
         elif not new_data_df.empty:
@@ -439,13 +876,19 @@ class DataFetcher:
 
         # Iterate through each day from start_date to today
         while current_date.date() <= today:
+            if current_date.strftime('%Y-%m-%d') in done_days:
+                current_date += timedelta(days=1)
+                continue
             logger.info(f"Processing date: {current_date.strftime('%Y-%m-%d')}")
 
             # Process all batches for the current day
             day_new_df = self._process_single_day(conn, query_template, date_column,
                                                  batch_size, current_date, last_id)
 
-            if not day_new_df.empty:
+            if day_new_df is None:
+                # not checkpointed: the day's stored rows stay and the next run extracts it again
+                logger.error(f"❌ Extraction of {current_date.strftime('%Y-%m-%d')} failed; day skipped.")
+            elif not day_new_df.empty:
                 # 1️⃣ Save daily batch to dedicated file and validate read-back (with retries)
                 validated_batch = self._save_daily_batch(day_new_df, current_date)
 
@@ -455,24 +898,21 @@ class DataFetcher:
                     if final_df.empty:
                         final_df = validated_batch.copy()
                     else:
-                        final_df = pd.concat([final_df, validated_batch], ignore_index=True).drop_duplicates()
-
-                    # Update last processed ID for recovery
-                    if 'encounter_id' in validated_batch.columns:
-                        last_id = validated_batch['encounter_id'].max()
+                        final_df = self._keyed_merge(final_df, validated_batch)
 
-                    # Save intermediate results and recovery state
-                    self._save_recovery_state({
-                        'current_date': current_date,
-                        'last_id': last_id,
-                        'df': validated_batch  # Store only new data for recovery
-                    })
+                    # Checkpoint the day: its validated batch file is the recovery copy until merged
+                    day = current_date.strftime('%Y-%m-%d')
+                    manifest['days'][day] = self._checkpoint_entry(current_date, len(validated_batch))
+                    self._save_checkpoint(manifest)
 
                     # 3️⃣ Save the COMBINED DATA (existing + new) atomically
                     try:
                         temp_main = f"{filename}.tmp"
-                        final_df.to_parquet(temp_main, index=False, engine="pyarrow")
-                        os.replace(temp_main, filename)
+                        with self._timed_phase('merge'):
+                            self.write_parquet(final_df, temp_main)
+                            os.replace(temp_main, filename)
+                        manifest['days'][day]['status'] = 'merged'
+                        self._save_checkpoint(manifest)
                     except Exception as e:
                         logger.error(f"Failed to write combined main parquet: {e}")
                         # Attempt to rebuild from batches as fallback
@@ -481,7 +921,7 @@ class DataFetcher:
                         if not rebuilt.empty:
                             final_df = rebuilt
                         else:
-                            logger.error("Rebuild failed; keeping current final_df in memory and saving recovery state.")
+                            logger.error("Rebuild failed; keeping current final_df in memory (day stays checkpointed as extracted).")
 
                     logger.info(f"Completed date {current_date.strftime('%Y-%m-%d')}. Total records: {len(final_df)}")
 
@@ -491,16 +931,16 @@ class DataFetcher:
             # Move to next day and reset last_id
             current_date += timedelta(days=1)
             last_id = 0
-            
-        # Cleanup batch files at the end of the run regardless of outcome
-            try:
-                self._cleanup_batches()
-            except Exception as e:
-                logger.warning(f"Batch cleanup encountered an error: {e}")
+
+        # the batch files stay until _finalize_operation has saved final_df: they are what the
+        # checkpoint manifest replays after a crash
         return final_df
 
     def _process_single_day(self, conn, query_template, date_column, batch_size, current_date, last_id=0):
-        """Process all records for a single day in batches"""
+        """
+        Process all records for a single day in batches.
+        Returns None if a batch query fails: a partial day must never replace the stored one.
+        """
         day_df = pd.DataFrame()
         processed_count = 0
         while True:
@@ -511,11 +951,14 @@ class DataFetcher:
             batch_query = f"{query} ORDER BY encounter_id LIMIT {batch_size}"
 
             logger.debug(f"Fetching batch for {date_str} from ID {last_id}")
+            started = time.perf_counter()
             try:
+                # read_sql fetches the whole batch, so this covers the query and the transfer
                 batch_df = pd.read_sql(batch_query, conn)
+                self._record_day(date_str, sql_seconds=time.perf_counter() - started)
             except Exception as e:
                 logger.error(f"SQL read failed for date {date_str}: {e}")
-                break
+                return None
 
             if batch_df.empty:
                 break
@@ -531,6 +974,1041 @@ class DataFetcher:
 
         return day_df
 
+    # Storage schema
+    @staticmethod
+    def _conform_table(table):
+        """Cast the columns declared in DATA_SCHEMA; a column that cannot be cast keeps its type"""
+        for name, arrow_type in DATA_SCHEMA.items():
+            idx = table.schema.get_field_index(name)
+            if idx == -1 or table.schema.field(idx).type == arrow_type:
+                continue
+            column = table.column(idx)
+            try:
+                if pa.types.is_dictionary(arrow_type) and not pa.types.is_string(column.type):
+                    column = column.cast(pa.string())
+                column = column.cast(arrow_type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as e:
+                logger.warning(f"Column {name} kept as {table.schema.field(idx).type}: {e}")
+                continue
+            table = table.set_column(idx, pa.field(name, arrow_type), column)
+        return table
+
+    def write_parquet(self, df, path):
+        """Write a DataFrame to parquet with derived columns, DATA_SCHEMA types and sorted layout (if on) applied"""
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.derived_columns:
+            con = duckdb.connect()
+            try:
+                con.register('frame', table)
+                table = con.sql(self._derive_sql(con, "SELECT * FROM frame")).to_arrow_table()
+            finally:
+                con.close()
+        table = self._conform_table(table)
+        if not self.sorted_layout:
+            pq.write_table(table, path)
+            return
+        sort_keys = [(c, 'ascending') for c in SORT_COLUMNS if c in table.column_names]
+        if sort_keys:
+            table = table.sort_by(sort_keys)
+        pq.write_table(table, path, compression=SORTED_COMPRESSION, row_group_size=self.row_group_rows,
+                       write_statistics=True, write_page_index=True)
+
+    @staticmethod
+    def _duckdb_type(arrow_type):
+        """DuckDB column type a DATA_SCHEMA Arrow type is stored as"""
+        if pa.types.is_dictionary(arrow_type):
+            return 'VARCHAR'
+        return {pa.int32(): 'INTEGER', pa.int64(): 'BIGINT', pa.float64(): 'DOUBLE',
+                pa.date32(): 'DATE', pa.string(): 'VARCHAR'}.get(arrow_type)
+
+    def _conform_sql(self, con, relation_sql):
+        """
+        Wrap a DuckDB relation so the DATA_SCHEMA columns it carries are written with their declared types.
+        Dictionary columns are plain VARCHAR here; DuckDB dictionary-encodes them in the parquet pages.
+        Like _conform_table, a column with values that cannot be cast keeps its type (with a warning)
+        rather than having them turned into NULLs.
+        """
+        described = con.execute(f"DESCRIBE ({relation_sql})").fetchall()
+        targets = {}
+        for row in described:
+            name, current = row[0], row[1]
+            target = self._duckdb_type(DATA_SCHEMA[name]) if name in DATA_SCHEMA else None
+            if target and current != target:
+                targets[name] = (current, target)
+        if not targets:
+            return relation_sql
+        # one scan counts, per column, the values a cast would lose
+        failures = con.execute("SELECT " + ", ".join(
+            f'count_if("{name}" IS NOT NULL AND TRY_CAST("{name}" AS {target}) IS NULL)'
+            for name, (_, target) in targets.items()) + f" FROM ({relation_sql})").fetchone()
+        casts = []
+        for (name, (current, target)), failed in zip(targets.items(), failures):
+            if failed:
+                logger.warning(f"Column {name} kept as {current}: {failed} values cannot be cast to {target}")
+                continue
+            casts.append(f'CAST("{name}" AS {target}) AS "{name}"')
+        if not casts:
+            return relation_sql
+        return f"SELECT * REPLACE ({', '.join(casts)}) FROM ({relation_sql})"
+
+    def _derive_sql(self, con, relation_sql):
+        """Wrap a relation so it carries the derived columns whose source columns it has"""
+        if not self.derived_columns:
+            return relation_sql
+        columns = {row[0] for row in con.execute(f"DESCRIBE ({relation_sql})").fetchall()}
+        replaced, added = [], []
+        for name, (expression, sources) in self.derived_columns.items():
+            if not set(sources) <= columns:
+                continue
+            (replaced if name in columns else added).append(f'{expression} AS "{name}"')
+        if not replaced and not added:
+            return relation_sql
+        select = "*" + (f" REPLACE ({', '.join(replaced)})" if replaced else "")
+        select += "".join(f", {column}" for column in added)
+        return f"SELECT {select} FROM ({relation_sql})"
+
+    def _store_sql(self, con, relation_sql):
+        """Relation as written to the store: derived columns, declared types, ordered by SORT_COLUMNS in sorted layout"""
+        relation_sql = self._conform_sql(con, self._derive_sql(con, relation_sql))
+        if not self.sorted_layout:
+            return relation_sql
+        columns = {row[0] for row in con.execute(f"DESCRIBE ({relation_sql})").fetchall()}
+        order_by = ", ".join(f'"{c}"' for c in SORT_COLUMNS if c in columns)
+        return f"SELECT * FROM ({relation_sql}) ORDER BY {order_by}" if order_by else relation_sql
+
+    def _copy_options(self):
+        """DuckDB COPY ... TO options for store files"""
+        if not self.sorted_layout:
+            return "FORMAT PARQUET"
+        return f"FORMAT PARQUET, COMPRESSION {SORTED_COMPRESSION.upper()}, ROW_GROUP_SIZE {self.row_group_rows}"
+
+    # Streaming extraction
+    def _arrow_schema_from_cursor(self, description):
+        """Build an Arrow schema from a DB-API cursor description, with DATA_SCHEMA types taking precedence"""
+        return pa.schema([
+            pa.field(col[0], DATA_SCHEMA.get(col[0], MYSQL_ARROW_TYPES.get(col[1], pa.string())))
+            for col in description
+        ])
+
+    @staticmethod
+    def _to_arrow_array(values, arrow_type):
+        """Convert one column of fetched rows, falling back to inference + cast (e.g. Decimal -> float)"""
+        try:
+            return pa.array(values, type=arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            if pa.types.is_string(arrow_type) or pa.types.is_dictionary(arrow_type):
+                values = [v.decode('utf-8', errors='replace') if isinstance(v, (bytes, bytearray)) else v
+                          for v in values]
+                return pa.array([v if v is None else str(v) for v in values], type=arrow_type)
+            return pa.array(values).cast(arrow_type)
+
+    def _rows_to_record_batch(self, rows, schema):
+        """Turn a list of row tuples into an Arrow record batch with a fixed schema"""
+        columns = list(zip(*rows))
+        arrays = [self._to_arrow_array(list(col), field.type) for col, field in zip(columns, schema)]
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def _stream_single_day(self, conn, query_template, current_date):
+        """
+        Stream one day's rows through an unbuffered server-side cursor and write them as
+        fixed-size Arrow record batches straight into the day's batch parquet.
+        Returns the number of rows written (0 for an empty day), or None on persistent failure.
+        """
+        date_str = current_date.strftime('%Y-%m-%d')
+        date_filter = f"AND DATE(e.encounter_datetime) = '{date_str}' "
+        query = f"{query_template.format(date_filter=date_filter)} ORDER BY encounter_id"
+        return self._stream_query_to_batch(conn, query, self._batch_file_path(current_date), date_str)
+
+    def _stream_query_to_batch(self, conn, query, batch_path, label):
+        """
+        Stream a query's result set into batch_path as fixed-size Arrow record batches.
+        Includes automatic re-attempts on failure, like _save_daily_batch.
+        Returns the number of rows written (0 if empty, no file is left), or None on persistent failure.
+        """
+        temp_batch = f"{batch_path}.tmp"
+
+        attempt = 0
+        while attempt < self.max_batch_save_retries:
+            writer = None
+            rows_written = 0
+            timings = {'sql_seconds': 0.0, 'transfer_seconds': 0.0, 'write_seconds': 0.0}
+            try:
+                with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+                    started = time.perf_counter()
+                    cursor.execute(query)
+                    timings['sql_seconds'] += time.perf_counter() - started
+                    schema = self._arrow_schema_from_cursor(cursor.description)
+                    while True:
+                        started = time.perf_counter()
+                        rows = cursor.fetchmany(self.arrow_batch_rows)
+                        if not rows:
+                            timings['transfer_seconds'] += time.perf_counter() - started
+                            break
+                        batch = self._append_row_key(self._rows_to_record_batch(rows, schema))
+                        fetched = time.perf_counter()
+                        timings['transfer_seconds'] += fetched - started
+                        if writer is None:
+                            writer = pq.ParquetWriter(temp_batch, batch.schema)
+                        writer.write_batch(batch)
+                        timings['write_seconds'] += time.perf_counter() - fetched
+                        rows_written += len(rows)
+                        logger.info(f"Streamed {rows_written} records for {label}")
+
+                if writer is None:
+                    logger.debug("No data to save for %s", label)
+                    self._record_day(label, **timings)
+                    # drop a stale batch left by an interrupted run so it is not merged
+                    if os.path.exists(batch_path):
+                        os.remove(batch_path)
+                    return 0
+
+                started = time.perf_counter()
+                writer.close()
+                writer = None
+                os.replace(temp_batch, batch_path)
+
+                # Validate from the footer only; the batch is never loaded back into memory
+                written = pq.ParquetFile(batch_path).metadata.num_rows
+                if written != rows_written:
+                    raise ValueError(f"Batch has {written} rows, expected {rows_written}")
+                timings['write_seconds'] += time.perf_counter() - started
+
+                logger.info(f"📦 Streamed batch file: {batch_path} ({rows_written} rows)")
+                self._record_day(label, rows=rows_written, bytes=os.path.getsize(batch_path), **timings)
+                return rows_written
+
+            except Exception as e:
+                attempt += 1
+                self._record_day(label, retries=1, **timings)
+                logger.error(f"Attempt {attempt}/{self.max_batch_save_retries} failed streaming "
+                             f"batch {batch_path}: {e}")
+                try:
+                    if writer is not None:
+                        writer.close()
+                    if os.path.exists(temp_batch):
+                        os.remove(temp_batch)
+                except Exception:
+                    pass
+
+                if attempt < self.max_batch_save_retries:
+                    logger.info(f"Retrying in {self.batch_retry_delay}s...")
+                    time.sleep(self.batch_retry_delay)
+
+        # All retries failed: quarantine and return None
+        try:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            quarantined = f"{batch_path}.bad_{timestamp}"
+            if os.path.exists(batch_path):
+                os.replace(batch_path, quarantined)
+            logger.error(f"All retries failed. Batch moved to {quarantined}")
+            self._record_quarantined(label, quarantined)
+        except Exception as ex:
+            logger.error(f"Failed to quarantine bad batch file: {ex}")
+
+        return None
+
+    def _stream_daily_batches(self, conn, query_template, filename, date_column, start_date):
+        """
+        Streaming counterpart of _process_daily_batches.
+        Each day is written to its own batch parquet; the main parquet is then rebuilt once
+        by replacing the extracted days, so memory stays flat regardless of day size.
+        """
+        manifest = self._load_checkpoint(filename)
+        completed_days = self._verified_days(manifest)
+        if completed_days:
+            logger.info(f"Resuming from checkpoint: {len(completed_days)} days already extracted")
+        current_date = pd.to_datetime(start_date)
+
+        today = datetime.now().date()
+        while current_date.date() <= today:
+            day = current_date.strftime('%Y-%m-%d')
+            if day in completed_days:
+                current_date += timedelta(days=1)
+                continue
+            logger.info(f"Processing date: {day}")
+            rows = self._stream_single_day(conn, query_template, current_date)
+            if rows is None:
+                logger.error(f"❌ Batch for {day} skipped due to validation failure.")
+            else:
+                completed_days.append(day)
+                manifest['days'][day] = self._checkpoint_entry(current_date, rows)
+                self._save_checkpoint(manifest)
+            current_date += timedelta(days=1)
+
+        if completed_days:
+            with self._timed_phase('merge'):
+                self._merge_batches_into_main(filename, date_column, completed_days)
+            self._write_timestamp()
+        else:
+            logger.info("No new data found.")
+
+        self._clear_checkpoint()
+        self._cleanup_after_merge()
+
+    # Parallel backfill
+    def _day_ranges(self, start_date, skip_days=()):
+        """Split start_date..today into contiguous ranges of days_per_task days, skipping completed days"""
+        days = pd.date_range(pd.to_datetime(start_date).normalize(), pd.Timestamp(datetime.now().date()), freq='D')
+        skip_days = set(skip_days)
+        days = [d for d in days if d.strftime('%Y-%m-%d') not in skip_days]
+        return [days[i:i + self.days_per_task] for i in range(0, len(days), self.days_per_task)]
+
+    def _extract_day(self, conn, query_template, date_column, batch_size, current_date):
+        """
+        Extract one day into its validated batch parquet.
+        Returns the row count (0 for an empty day) or None if extraction or validation failed.
+        """
+        if self.streaming:
+            return self._stream_single_day(conn, query_template, current_date)
+
+        day_df = self._process_single_day(conn, query_template, date_column, batch_size, current_date)
+        if day_df is None:
+            return None
+        if day_df.empty:
+            batch_path = self._batch_file_path(current_date)
+            if os.path.exists(batch_path):
+                os.remove(batch_path)
+            return 0
+        validated_batch = self._save_daily_batch(day_df, current_date)
+        return None if validated_batch is None else len(validated_batch)
+
+    def _parallel_daily_batches(self, tunnel, query_template, filename, date_column, batch_size, start_date):
+        """
+        Backfill start_date..today with up to parallel_workers concurrent connections through
+        one shared tunnel. Each worker thread keeps its own connection and writes the same
+        validated daily batch files as the sequential run; the main parquet is merged once at the end.
+        """
+        manifest = self._load_checkpoint(filename)
+        completed_days = self._verified_days(manifest)
+        day_ranges = self._day_ranges(start_date, skip_days=completed_days)
+        if completed_days:
+            logger.info(f"Resuming parallel backfill: {len(completed_days)} days already extracted")
+
+        local = threading.local()
+        connections = []
+        lock = threading.Lock()
+
+        def worker_connection():
+            if getattr(local, 'conn', None) is None:
+                local.conn = self._get_db_connection(tunnel)
+                with lock:
+                    connections.append(local.conn)
+            return local.conn
+
+        def run_range(days):
+            conn = worker_connection()
+            done = []
+            for current_date in days:
+                logger.info(f"Processing date: {current_date.strftime('%Y-%m-%d')}")
+                rows = self._extract_day(conn, query_template, date_column, batch_size, current_date)
+                if rows is None:
+                    # not checkpointed nor replaced: the day's stored rows are kept
+                    logger.error(f"❌ Batch for {current_date.strftime('%Y-%m-%d')} skipped: extraction or validation failed.")
+                    continue
+                day = current_date.strftime('%Y-%m-%d')
+                entry = self._checkpoint_entry(current_date, rows)
+                done.append(day)
+                with lock:
+                    completed_days.append(day)
+                    manifest['days'][day] = entry
+                    self._save_checkpoint(manifest)
+            return done
+
+        logger.info(f"Parallel backfill of {sum(len(r) for r in day_ranges)} days "
+                    f"over {self.parallel_workers} connections")
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_workers,
+                                    thread_name_prefix="fetch-worker") as pool:
+                futures = [pool.submit(run_range, days) for days in day_ranges]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            for conn in connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+        if completed_days:
+            with self._timed_phase('merge'):
+                self._merge_batches_into_main(filename, date_column, sorted(completed_days))
+            self._write_timestamp()
+        else:
+            logger.info("No new data found.")
+
+        self._clear_checkpoint()
+        self._cleanup_after_merge()
+
+    def _batch_files(self, days):
+        """
+        Sorted list of the daily batch parquet files of `days` that are on disk. Batches of other days
+        (say left by a run whose re-extraction of that day failed) are never merged.
+        """
+        paths = (self._batch_file_path(pd.Timestamp(day)) for day in sorted(set(days)))
+        return [path for path in paths if os.path.exists(path)]
+
+    @staticmethod
+    def _outside_days(date_column, days_sql):
+        """Filter keeping the rows not of the listed days, rows without a date included (NOT IN alone drops them)"""
+        return f"NOT COALESCE(CAST(\"{date_column}\" AS DATE) IN ({days_sql}), false)"
+
+    def _merge_batches_into_main(self, main_file, date_column, replaced_days):
+        """
+        Rewrite the main parquet as: existing rows outside the replaced days + the replaced days' batch files.
+        Runs inside DuckDB so rows are streamed from parquet to parquet without a pandas copy.
+        In partitioned mode only the touched partitions of the dataset are rewritten.
+        """
+        if self.partitioned:
+            return self._merge_batches_into_partitions(self.dataset_dir(main_file), date_column, replaced_days)
+
+        batch_files = self._batch_files(replaced_days)
+        days_sql = ", ".join(f"DATE '{d}'" for d in replaced_days)
+
+        selects = []
+        if os.path.exists(main_file):
+            selects.append(f"SELECT * FROM read_parquet('{main_file}') "
+                           f"WHERE {self._outside_days(date_column, days_sql)}")
+        if batch_files:
+            files_sql = ", ".join(f"'{bf}'" for bf in batch_files)
+            selects.append(f"SELECT * FROM read_parquet([{files_sql}], union_by_name=true)")
+        if not selects:
+            return
+
+        temp_main = f"{main_file}.tmp"
+        con = duckdb.connect()
+        try:
+            relation = self._store_sql(con, ' UNION ALL BY NAME '.join(selects))
+            con.execute(f"COPY ({relation}) TO '{temp_main}' ({self._copy_options()})")
+            os.replace(temp_main, main_file)
+            logger.info(f"🎉 Main parquet updated from {len(batch_files)} streamed batch files")
+        except Exception:
+            if os.path.exists(temp_main):
+                os.remove(temp_main)
+            raise
+        finally:
+            con.close()
+
+    # Partitioned dataset
+    @staticmethod
+    def _partition_select(source_sql, date_column):
+        """SELECT adding the hive partition columns (year_month, text Facility_CODE) to a relation"""
+        return (f"SELECT * REPLACE (CASE WHEN TRY_CAST(Facility_CODE AS DOUBLE) = TRY_CAST(Facility_CODE AS BIGINT) "
+                f"THEN CAST(TRY_CAST(Facility_CODE AS BIGINT) AS VARCHAR) ELSE CAST(Facility_CODE AS VARCHAR) END "
+                f"AS Facility_CODE), strftime(CAST(\"{date_column}\" AS DATE), '%Y-%m') AS year_month "
+                f"FROM {source_sql}")
+
+    @staticmethod
+    def _partition_dir(dataset_dir, year_month, facility_code):
+        """Directory of one (year_month, Facility_CODE) partition; NULL values go to the hive default partition"""
+        month = "__HIVE_DEFAULT_PARTITION__" if year_month is None else year_month
+        code = "__HIVE_DEFAULT_PARTITION__" if facility_code is None else facility_code
+        return os.path.join(dataset_dir, f"year_month={month}", f"Facility_CODE={code}")
+
+    @staticmethod
+    def _parquet_files(directory):
+        """Parquet files directly inside a directory (empty list if it does not exist)"""
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".parquet"))
+
+    def _write_partitions(self, con, relation_sql, dataset_dir, partitions, appended=()):
+        """
+        Write a relation that carries the partition columns into the given partitions.
+        Each partition's files are swapped in place; partitions with no rows left are removed.
+        Partitions in `appended` only gain the relation's rows as extra files (nothing of theirs is
+        replaced); compact() later merges those small files.
+        """
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        staging_dir = f"{dataset_dir}.staging_{stamp}"
+        try:
+            con.execute(f"COPY ({self._store_sql(con, relation_sql)}) TO '{staging_dir}' "
+                        f"({self._copy_options()}, PARTITION_BY ({', '.join(PARTITION_COLUMNS)}))")
+            for year_month, facility_code in appended:
+                target = self._partition_dir(dataset_dir, year_month, facility_code)
+                os.makedirs(target, exist_ok=True)
+                staged_files = self._parquet_files(self._partition_dir(staging_dir, year_month, facility_code))
+                for i, staged in enumerate(staged_files):
+                    os.replace(staged, os.path.join(target, f"part-{stamp}-{i}.parquet"))
+            for year_month, facility_code in partitions:
+                target = self._partition_dir(dataset_dir, year_month, facility_code)
+                new_files = self._parquet_files(self._partition_dir(staging_dir, year_month, facility_code))
+                old_files = self._parquet_files(target)
+                os.makedirs(target, exist_ok=True)
+                kept = set()
+                for i, staged in enumerate(new_files):
+                    final = os.path.join(target, f"part-{i}.parquet")
+                    os.replace(staged, final)
+                    kept.add(final)
+                for old in old_files:
+                    if old not in kept:
+                        os.remove(old)
+                if not new_files:
+                    shutil.rmtree(target, ignore_errors=True)
+                    parent = os.path.dirname(target)
+                    if os.path.isdir(parent) and not os.listdir(parent):
+                        os.rmdir(parent)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _migrate_to_partitions(self, main_file, dataset_dir, date_column):
+        """One-off conversion of an existing single parquet file into the partitioned dataset"""
+        con = duckdb.connect()
+        try:
+            relation = self._partition_select(f"read_parquet('{main_file}')", date_column)
+            partitions = con.execute(f"SELECT DISTINCT year_month, Facility_CODE FROM ({relation})").fetchall()
+            self._write_partitions(con, relation, dataset_dir, partitions)
+            logger.info(f"Migrated {main_file} into {len(partitions)} partitions under {dataset_dir}")
+        finally:
+            con.close()
+
+    def _merge_batches_into_partitions(self, dataset_dir, date_column, replaced_days):
+        """
+        Merge daily batch files into the partitioned dataset.
+        Touched partitions are those receiving new rows plus those holding rows of a replaced day;
+        each is rewritten as its rows outside the replaced days + the incoming rows. Every other
+        partition is left alone, so refresh cost follows the size of the delta, not the history.
+        """
+        batch_files = self._batch_files(replaced_days)
+        days_sql = ", ".join(f"DATE '{d}'" for d in replaced_days)
+        months_sql = ", ".join(sorted({f"'{d[:7]}'" for d in replaced_days}))
+        dataset_glob = os.path.join(dataset_dir, "*", "*", "*.parquet")
+
+        con = duckdb.connect()
+        try:
+            if batch_files:
+                files_sql = ", ".join(f"'{bf}'" for bf in batch_files)
+                con.execute(f"CREATE TEMP VIEW incoming AS "
+                            f"{self._partition_select(f'read_parquet([{files_sql}], union_by_name=true)', date_column)}")
+                incoming = set(con.execute("SELECT DISTINCT year_month, Facility_CODE FROM incoming").fetchall())
+            else:
+                incoming = set()
+
+            # partitions holding rows of a replaced day are rewritten; the others only gain new files
+            rewritten = set()
+            if glob.glob(dataset_glob) and replaced_days:
+                rewritten = set(con.execute(
+                    f"SELECT DISTINCT year_month, Facility_CODE FROM read_parquet('{dataset_glob}', "
+                    f"hive_partitioning=true, hive_types={HIVE_TYPES_SQL}, union_by_name=true) "
+                    f"WHERE year_month IN ({months_sql}) AND CAST(\"{date_column}\" AS DATE) IN ({days_sql})"
+                ).fetchall())
+            appended = incoming - rewritten
+            touched = rewritten | incoming
+            if not touched:
+                logger.info("No partitions touched by this refresh.")
+                return
+
+            selects = []
+            existing_files = [f for ym, fc in rewritten
+                              for f in self._parquet_files(self._partition_dir(dataset_dir, ym, fc))]
+            if existing_files:
+                files_sql = ", ".join(f"'{f}'" for f in existing_files)
+                keep = f"WHERE {self._outside_days(date_column, days_sql)}" if replaced_days else ""
+                selects.append(f"SELECT * FROM read_parquet([{files_sql}], hive_partitioning=true, "
+                               f"hive_types={HIVE_TYPES_SQL}, union_by_name=true) {keep}")
+            if batch_files:
+                selects.append("SELECT * FROM incoming")
+
+            self._write_partitions(con, " UNION ALL BY NAME ".join(selects), dataset_dir,
+                                   sorted(rewritten, key=lambda p: (p[0] or "", p[1] or "")),
+                                   appended=sorted(appended, key=lambda p: (p[0] or "", p[1] or "")))
+            logger.info(f"🎉 Rewrote {len(rewritten)} and appended to {len(appended)} partitions "
+                        f"from {len(batch_files)} batch files")
+        finally:
+            con.close()
+
+    # Compaction
+    @staticmethod
+    @contextmanager
+    def store_lock(filename, blocking=True):
+        """
+        Exclusive lock on the store next to `filename` (x.parquet -> x.lock), held by refreshes
+        and compaction so they never rewrite the same files at once. Yields False when
+        `blocking` is off and another process holds it. Readers never take it.
+        """
+        with open(f"{os.path.splitext(filename)[0]}.lock", 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _fragmented(files, min_files, min_row_group_rows):
+        """True if a set of parquet files should be merged into one (too many files or row groups too small)"""
+        if len(files) >= min_files:
+            return True
+        metadata = [pq.ParquetFile(f).metadata for f in files]
+        row_groups = sum(m.num_row_groups for m in metadata)
+        rows = sum(m.num_rows for m in metadata)
+        return row_groups > 1 and rows / row_groups < min_row_group_rows
+
+    def compact(self, filename, min_files=2, min_row_group_rows=None):
+        """
+        Merge the small files the appending refresh path leaves behind. Every partition of the
+        partitioned store with at least `min_files` files, or whose row groups average fewer than
+        `min_row_group_rows` rows (default: a tenth of row_group_rows), is rewritten as one file in
+        the store layout; a fragmented single-file store is rewritten the same way. Run it under
+        store_lock(), with readers on a published snapshot (files are merged in place). Returns the
+        metrics of the run.
+        """
+        started = time.time()
+        min_row_group_rows = min_row_group_rows or max(self.row_group_rows // 10, 1)
+        store_path = self._store_path(filename)
+        metrics = {'compacted_at': datetime.now().isoformat(timespec='seconds'), 'store': store_path,
+                   'partitions_compacted': 0, 'files_before': 0, 'files_after': 0,
+                   'bytes_before': 0, 'bytes_after': 0}
+
+        if os.path.isdir(store_path):
+            groups = [os.path.dirname(d) for d in glob.glob(os.path.join(store_path, "*", "*", ""))]
+        elif os.path.isfile(store_path):
+            groups = [None]
+        else:
+            groups = []
+
+        con = duckdb.connect()
+        try:
+            for partition in groups:
+                files = self._parquet_files(partition) if partition else [store_path]
+                if not files:
+                    continue
+                size = sum(os.path.getsize(f) for f in files)
+                metrics['files_before'] += len(files)
+                metrics['bytes_before'] += size
+                if not self._fragmented(files, min_files, min_row_group_rows):
+                    metrics['files_after'] += len(files)
+                    metrics['bytes_after'] += size
+                    continue
+
+                files_sql = ", ".join(f"'{f}'" for f in files)
+                # partition values live in the directory names, so they are left out of the file
+                target = os.path.join(partition, "part-0.parquet") if partition else store_path
+                tmp_path = f"{target}.compact.tmp"
+                relation = f"SELECT * FROM read_parquet([{files_sql}], union_by_name=true)"
+                con.execute(f"COPY ({self._store_sql(con, relation)}) "
+                            f"TO '{tmp_path}' ({self._copy_options()})")
+                os.replace(tmp_path, target)
+                for old in files:
+                    if old != target:
+                        os.remove(old)
+                metrics['partitions_compacted'] += 1
+                metrics['files_after'] += 1
+                metrics['bytes_after'] += os.path.getsize(target)
+        finally:
+            con.close()
+
+        metrics['files_merged'] = metrics['files_before'] - metrics['files_after']
+        metrics['bytes_saved'] = metrics['bytes_before'] - metrics['bytes_after']
+        metrics['seconds'] = round(time.time() - started, 3)
+        logger.info(f"Compacted {metrics['partitions_compacted']} partitions of {store_path}: "
+                    f"{metrics['files_before']} -> {metrics['files_after']} files, "
+                    f"{metrics['bytes_saved']} bytes saved in {metrics['seconds']}s")
+        return metrics
+
+    # Star schema
+    @staticmethod
+    def star_dir(filename):
+        """
+        Directory of the star schemas published from a store (x.parquet -> x_star/): one write-once
+        <version>/ directory per publish and a CURRENT file naming the one readers use.
+        """
+        return f"{os.path.splitext(filename)[0]}_star"
+
+    def store_relation(self, filename):
+        """DuckDB FROM target of the main store (file or partitioned dataset) with its logical columns"""
+        if not self.partitioned:
+            return f"read_parquet('{filename}')"
+        dataset_glob = os.path.join(self.dataset_dir(filename), "*", "*", "*.parquet")
+        return (f"(SELECT * EXCLUDE (year_month) FROM read_parquet('{dataset_glob}', "
+                f"hive_partitioning=true, hive_types={HIVE_TYPES_SQL}, union_by_name=true))")
+
+    def publish_star_schema(self, filename):
+        """
+        Split the store into a narrow fact table and dimension tables under star_dir(filename):
+          fact.parquet            obs rows with dimension attributes removed and concept names as int keys
+          dim_person.parquet      person_id -> name, gender
+          dim_location.parquet    Facility_CODE -> Facility
+          dim_concept.parquet     concept_key -> name
+          manifest.json           logical column order and layout, read by star_view()
+        A dimension only takes the attributes that have one value per key (see STAR_DIMENSIONS).
+        The tables are written to a new <version>/ directory, then CURRENT is atomically pointed at it.
+        Returns the published version's directory.
+        """
+        if not os.path.exists(self._store_path(filename)):
+            logger.warning("No store to publish a star schema from.")
+            return None
+
+        star_dir = self.star_dir(filename)
+        version = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        staging_dir = os.path.join(star_dir, f".staging_{version}")
+        os.makedirs(staging_dir)
+        con = duckdb.connect()
+        try:
+            con.execute(f"CREATE TEMP VIEW wide AS SELECT * FROM {self.store_relation(filename)}")
+            columns = [row[0] for row in con.execute("DESCRIBE wide").fetchall()]
+
+            dimensions = {}
+            for name, (key, attributes) in STAR_DIMENSIONS.items():
+                attributes = [a for a in attributes if a in columns]
+                if key not in columns or not attributes:
+                    continue
+                # keys whose rows disagree on an attribute (a NULL counts as a value) keep it on the fact table
+                varying = con.execute("SELECT " + ", ".join(
+                    f'count(*) FILTER (WHERE n_{i} > 1)' for i in range(len(attributes))) + " FROM (SELECT "
+                    + ", ".join(f'count(DISTINCT "{a}") + (count("{a}") < count(*))::INTEGER AS n_{i}'
+                                for i, a in enumerate(attributes))
+                    + f" FROM wide WHERE \"{key}\" IS NOT NULL GROUP BY \"{key}\")").fetchone()
+                attributes = [a for a, keys in zip(attributes, varying) if not keys]
+                if not attributes:
+                    continue
+                values = ", ".join(f'any_value("{a}") AS "{a}"' for a in attributes)
+                con.execute(f"COPY (SELECT \"{key}\", {values} FROM wide WHERE \"{key}\" IS NOT NULL "
+                            f"GROUP BY \"{key}\" ORDER BY \"{key}\") "
+                            f"TO '{os.path.join(staging_dir, f'dim_{name}.parquet')}' (FORMAT PARQUET)")
+                dimensions[name] = {'key': key, 'columns': attributes}
+
+            concept_columns = [c for c in STAR_CONCEPT_COLUMNS if c in columns]
+            fact_select = "wide.*"
+            if concept_columns:
+                names = " UNION ".join(f'SELECT "{c}" AS name FROM wide' for c in concept_columns)
+                con.execute(f"CREATE TEMP TABLE dim_concept AS SELECT CAST(row_number() OVER (ORDER BY name) "
+                            f"AS INTEGER) AS concept_key, name FROM ({names}) WHERE name IS NOT NULL")
+                con.execute(f"COPY dim_concept TO '{os.path.join(staging_dir, 'dim_concept.parquet')}' "
+                            f"(FORMAT PARQUET)")
+            moved = [a for d in dimensions.values() for a in d['columns']] + concept_columns
+            if moved:
+                excluded = ", ".join(f'"{c}"' for c in moved)
+                fact_select = f"wide.* EXCLUDE ({excluded})"
+            joins = "".join(f' LEFT JOIN dim_concept k{i} ON k{i}.name = wide."{c}"'
+                            for i, c in enumerate(concept_columns))
+            keys = "".join(f', k{i}.concept_key AS "{c}_key"' for i, c in enumerate(concept_columns))
+            order_by = ", ".join(f'wide."{c}"' for c in SORT_COLUMNS if c in columns)
+            fact_sql = self._conform_sql(con, f"SELECT {fact_select}{keys} FROM wide{joins}"
+                                              + (f" ORDER BY {order_by}" if order_by else ""))
+            con.execute(f"COPY ({fact_sql}) TO '{os.path.join(staging_dir, 'fact.parquet')}' "
+                        f"({self._copy_options()})")
+
+            with open(os.path.join(staging_dir, 'manifest.json'), 'w') as f:
+                json.dump({'columns': columns, 'dimensions': dimensions, 'concept_columns': concept_columns,
+                           'published_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, f, indent=2)
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        finally:
+            con.close()
+
+        published_dir = os.path.join(star_dir, version)
+        os.replace(staging_dir, published_dir)
+        pointer = os.path.join(star_dir, "CURRENT")
+        with open(f"{pointer}.tmp", 'w') as f:
+            f.write(version)
+        os.replace(f"{pointer}.tmp", pointer)
+
+        # tables of the unversioned layout, then versions beyond STAR_RETENTION
+        for name in os.listdir(star_dir):
+            if os.path.isfile(os.path.join(star_dir, name)) and name.endswith(('.parquet', '.json')):
+                os.remove(os.path.join(star_dir, name))
+        versions = sorted(d for d in os.listdir(star_dir)
+                          if not d.startswith('.') and os.path.isdir(os.path.join(star_dir, d)))
+        for old in versions[:-STAR_RETENTION]:
+            shutil.rmtree(os.path.join(star_dir, old), ignore_errors=True)
+        logger.info(f"⭐ Star schema published to {published_dir}")
+        return published_dir
+
+    @staticmethod
+    def star_view(star_dir):
+        """
+        DuckDB FROM target joining the star tables back into the store's logical columns (same names
+        and order), or None if nothing has been published. Filters on fact columns push into the fact scan.
+        star_dir is a store's star_dir() (read through its CURRENT version) or one published version.
+        """
+        try:
+            with open(os.path.join(star_dir, "CURRENT"), 'r') as f:
+                star_dir = os.path.join(star_dir, f.read().strip())
+        except FileNotFoundError:
+            pass
+        manifest_file = os.path.join(star_dir, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+        sources = {c: f'f."{c}"' for c in manifest['columns']}
+        joins = []
+        for name, dimension in manifest['dimensions'].items():
+            for column in dimension['columns']:
+                sources[column] = f'd_{name}."{column}"'
+            joins.append(f"LEFT JOIN read_parquet('{os.path.join(star_dir, f'dim_{name}.parquet')}') d_{name} "
+                         f"ON d_{name}.\"{dimension['key']}\" = f.\"{dimension['key']}\"")
+        for i, column in enumerate(manifest['concept_columns']):
+            sources[column] = f'k{i}.name'
+            joins.append(f"LEFT JOIN read_parquet('{os.path.join(star_dir, 'dim_concept.parquet')}') k{i} "
+                         f"ON k{i}.concept_key = f.\"{column}_key\"")
+        select = ", ".join(f'{sources[c]} AS "{c}"' for c in manifest['columns'])
+        return (f"(SELECT {select} FROM read_parquet('{os.path.join(star_dir, 'fact.parquet')}') f "
+                f"{' '.join(joins)})")
+
+    # Visit tracking
+    @staticmethod
+    def visits_dir(filename):
+        """Directory of the per-person visit tables of a store (x.parquet -> x_visits/)"""
+        return f"{os.path.splitext(filename)[0]}_visits"
+
+    def refresh_visits(self, filename, date_column='Date', since=None):
+        """
+        Incrementally maintain the visit tables under visits_dir(filename):
+          visit_dates.parquet     distinct (person_id, visit_date) pairs
+          person_visits.parquet   person_id -> visit_days, new_revisit, first/last visit date
+        Only store rows dated on/after `since` are rescanned and only the persons seen on those days
+        (before or after the refresh) are re-aggregated. Without existing tables, or with since=None,
+        everything is rebuilt from the store.
+        """
+        if not os.path.exists(self._store_path(filename)):
+            return
+        visits_dir = self.visits_dir(filename)
+        dates_file = os.path.join(visits_dir, 'visit_dates.parquet')
+        persons_file = os.path.join(visits_dir, 'person_visits.parquet')
+        if not (os.path.exists(dates_file) and os.path.exists(persons_file)):
+            since = None
+        os.makedirs(visits_dir, exist_ok=True)
+
+        visit_date = f"CAST(\"{date_column}\" AS DATE)"
+        since_sql = "" if since is None else f"DATE '{pd.to_datetime(since).strftime('%Y-%m-%d')}'"
+        con = duckdb.connect()
+        try:
+            con.execute(f"CREATE TEMP TABLE recent AS SELECT DISTINCT CAST(person_id AS BIGINT) AS person_id, "
+                        f"{visit_date} AS visit_date FROM {self.store_relation(filename)} "
+                        f"WHERE person_id IS NOT NULL AND {visit_date} IS NOT NULL"
+                        + (f" AND {visit_date} >= {since_sql}" if since_sql else ""))
+            if since_sql:
+                con.execute(f"CREATE TEMP TABLE visit_dates AS SELECT person_id, visit_date "
+                            f"FROM read_parquet('{dates_file}') WHERE visit_date < {since_sql} "
+                            f"UNION ALL SELECT person_id, visit_date FROM recent")
+                con.execute(f"CREATE TEMP TABLE touched AS SELECT person_id FROM recent UNION "
+                            f"SELECT person_id FROM read_parquet('{dates_file}') WHERE visit_date >= {since_sql}")
+                unchanged = (f"SELECT * FROM read_parquet('{persons_file}') "
+                             f"WHERE person_id NOT IN (SELECT person_id FROM touched) UNION ALL BY NAME ")
+                scope = "WHERE person_id IN (SELECT person_id FROM touched) "
+            else:
+                con.execute("CREATE TEMP TABLE visit_dates AS SELECT * FROM recent")
+                unchanged, scope = "", ""
+            aggregated = (f"SELECT person_id, CAST(count(*) AS INTEGER) AS visit_days, "
+                          f"CASE WHEN count(*) = 1 THEN 'New' ELSE 'Revisit' END AS new_revisit, "
+                          f"min(visit_date) AS first_visit_date, max(visit_date) AS last_visit_date "
+                          f"FROM visit_dates {scope}GROUP BY person_id")
+
+            for target, relation in ((dates_file, "SELECT * FROM visit_dates ORDER BY person_id, visit_date"),
+                                     (persons_file, f"SELECT * FROM ({unchanged}{aggregated}) ORDER BY person_id")):
+                temp_file = f"{target}.tmp"
+                con.execute(f"COPY ({relation}) TO '{temp_file}' (FORMAT PARQUET)")
+                os.replace(temp_file, target)
+            persons = con.execute(f"SELECT count(*) FROM read_parquet('{persons_file}')").fetchone()[0]
+        finally:
+            con.close()
+        logger.info(f"Visit tables updated ({persons} persons, rescanned from {since or 'the start'})")
+
+    @staticmethod
+    def with_visits(relation_sql, visits_dir):
+        """Join the per-person visit columns onto a store relation (unchanged if no visit tables yet)"""
+        persons_file = os.path.join(visits_dir, 'person_visits.parquet')
+        if not os.path.exists(persons_file):
+            return relation_sql
+        columns = ", ".join(f'v."{c}"' for c in VISIT_COLUMNS)
+        # a QERY still selecting the SQL-side visit_days/new_revisit must not shadow the local ones
+        kept = "COLUMNS(c -> c NOT IN (" + ", ".join(f"'{c}'" for c in VISIT_COLUMNS) + "))"
+        return (f"(SELECT s.*, {columns} FROM (SELECT {kept} FROM {relation_sql}) s "
+                f"LEFT JOIN read_parquet('{persons_file}') v ON v.person_id = s.person_id)")
+
+    # Change data capture
+    def _load_cdc_state(self):
+        """Load the CDC high-water marks, or None before the first baseline load"""
+        if not os.path.exists(self.cdc_state_file):
+            return None
+        try:
+            with open(self.cdc_state_file, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Failed to load CDC state: {e}")
+            return None
+
+    def _save_cdc_state(self, watermarks):
+        """Atomically write the CDC high-water marks"""
+        state = dict(watermarks, updated_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        temp_file = f"{self.cdc_state_file}.tmp"
+        os.makedirs(os.path.dirname(self.cdc_state_file), exist_ok=True)
+        with open(temp_file, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(temp_file, self.cdc_state_file)
+        logger.info(f"CDC watermarks saved: {watermarks}")
+
+    def _watermarks_from_sql(self, con, relation_sql, available_columns):
+        """Max of every watermark column present in a DuckDB relation (ids as int, timestamps as text)"""
+        columns = [c for c in CDC_WATERMARKS if c in available_columns]
+        if not columns:
+            return {}
+        row = con.execute(f"SELECT {', '.join(f'max({c})' for c in columns)} FROM {relation_sql}").fetchone()
+        marks = {}
+        for column, value in zip(columns, row):
+            if value is None:
+                continue
+            marks[column] = int(value) if column in CDC_ID_WATERMARKS else str(pd.Timestamp(value))
+        return marks
+
+    def _store_watermarks(self, store_path):
+        """High-water marks of the rows currently in the store (used after a baseline load)"""
+        if os.path.isdir(store_path):
+            source = (f"read_parquet('{os.path.join(store_path, '*', '*', '*.parquet')}', "
+                      f"hive_partitioning=true, hive_types={HIVE_TYPES_SQL})")
+        else:
+            source = f"read_parquet('{store_path}')"
+        con = duckdb.connect()
+        try:
+            columns = [r[0] for r in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+            return self._watermarks_from_sql(con, source, columns)
+        finally:
+            con.close()
+
+    def _cdc_filter(self, watermarks):
+        """SQL predicate selecting rows changed since the high-water marks"""
+        conditions = []
+        for column, source_column in CDC_WATERMARKS.items():
+            mark = watermarks.get(column)
+            if mark is None:
+                continue
+            if column in CDC_ID_WATERMARKS:
+                conditions.append(f"{source_column} > {int(mark)}")
+            else:
+                since = pd.Timestamp(mark) - timedelta(minutes=self.cdc_lookback_minutes)
+                conditions.append(f"{source_column} >= '{since.strftime('%Y-%m-%d %H:%M:%S')}'")
+        if not conditions:
+            raise ValueError("CDC state has no usable watermarks; run a baseline load")
+        return f"AND ({' OR '.join(conditions)}) "
+
+    def _fetch_changes(self, query_template, filename, date_column):
+        """
+        Incremental refresh driven by the CDC watermarks: stream every row whose obs or
+        encounter changed since the last run into one batch, upsert it by obs_id and
+        drop voided obs, then advance the watermarks.
+        """
+        watermarks = self._load_cdc_state()
+        query = f"{query_template.format(date_filter=self._cdc_filter(watermarks))} ORDER BY encounter_id"
+        batch_path = os.path.join(self.state_dir, "batches",
+                                  f"cdc_{datetime.now().strftime('%Y%m%d_%H%M%S')}.parquet")
+
+        with self._open_tunnel() as tunnel:
+            conn = self._get_db_connection(tunnel)
+            try:
+                rows = self._stream_query_to_batch(conn, query, batch_path, "changes since last refresh")
+            finally:
+                conn.close()
+
+        if rows is None:
+            raise RuntimeError("CDC change batch failed validation; watermarks left unchanged")
+        if rows == 0:
+            logger.info("No changes since last refresh.")
+            return None
+
+        con = duckdb.connect()
+        try:
+            source = f"read_parquet('{batch_path}')"
+            columns = [r[0] for r in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+            delta_marks = self._watermarks_from_sql(con, source, columns)
+            changed_since = (con.execute(f"SELECT min(CAST(\"{date_column}\" AS DATE)) FROM {source}").fetchone()[0]
+                             if date_column in columns else None)
+        finally:
+            con.close()
+        missing = {'obs_id', 'encounter_id', 'obs_voided'} - set(columns)
+        if missing:
+            raise ValueError(f"CDC mode needs the query to select {sorted(missing)}")
+
+        with self._timed_phase('merge'):
+            self._apply_changes(filename, date_column, [batch_path])
+        self._write_timestamp()
+        if self.track_visits:
+            with self._timed_phase('visits'):
+                self.refresh_visits(filename, date_column, since=changed_since)
+
+        # watermarks only move forward, and only after the changes are safely in the store
+        for column, mark in delta_marks.items():
+            current = watermarks.get(column)
+            if current is None or (int(mark) > int(current) if column in CDC_ID_WATERMARKS
+                                   else pd.Timestamp(mark) > pd.Timestamp(current)):
+                watermarks[column] = mark
+        watermarks.pop('updated_at', None)
+        self._save_cdc_state(watermarks)
+
+        try:
+            self._cleanup_batches()
+        except Exception as e:
+            logger.warning(f"Batch cleanup encountered an error: {e}")
+        logger.info(f"Applied {rows} changed rows")
+        return None
+
+    @staticmethod
+    def _keep_unchanged_sql(source_sql):
+        """Rows of source_sql not superseded by the delta: same obs_id, or an obs-less row of a delta encounter"""
+        return (f"SELECT s.* FROM {source_sql} s "
+                f"WHERE NOT EXISTS (SELECT 1 FROM delta_obs k WHERE k.obs_id = s.obs_id) "
+                f"AND NOT (s.obs_id IS NULL AND EXISTS "
+                f"(SELECT 1 FROM delta_encounters k WHERE k.encounter_id = s.encounter_id))")
+
+    def _apply_changes(self, main_file, date_column, delta_files):
+        """
+        Upsert delta rows into the store keyed on obs_id: every stored row of a changed obs is
+        replaced by the delta rows of that obs, and voided obs are removed without replacement.
+        """
+        files_sql = ", ".join(f"'{f}'" for f in delta_files)
+        con = duckdb.connect()
+        try:
+            con.execute(f"CREATE TEMP VIEW delta AS SELECT * FROM read_parquet([{files_sql}], union_by_name=true)")
+            con.execute("CREATE TEMP TABLE delta_obs AS SELECT DISTINCT obs_id FROM delta WHERE obs_id IS NOT NULL")
+            con.execute("CREATE TEMP TABLE delta_encounters AS SELECT DISTINCT encounter_id FROM delta")
+            upserts = "SELECT * FROM delta WHERE coalesce(obs_voided, 0) = 0"
+            deleted = con.execute("SELECT count(DISTINCT obs_id) FROM delta WHERE obs_voided = 1").fetchone()[0]
+
+            if not self.partitioned:
+                temp_main = f"{main_file}.tmp"
+                existing = f"read_parquet('{main_file}')"
+                relation = self._store_sql(con, f"{self._keep_unchanged_sql(existing)} UNION ALL BY NAME {upserts}")
+                try:
+                    con.execute(f"COPY ({relation}) TO '{temp_main}' ({self._copy_options()})")
+                    os.replace(temp_main, main_file)
+                except Exception:
+                    if os.path.exists(temp_main):
+                        os.remove(temp_main)
+                    raise
+            else:
+                dataset_dir = self.dataset_dir(main_file)
+                dataset = (f"read_parquet('{os.path.join(dataset_dir, '*', '*', '*.parquet')}', "
+                           f"hive_partitioning=true, hive_types={HIVE_TYPES_SQL}, union_by_name=true)")
+                con.execute(f"CREATE TEMP VIEW incoming AS {self._partition_select(f'({upserts})', date_column)}")
+                incoming = set(con.execute("SELECT DISTINCT year_month, Facility_CODE FROM incoming").fetchall())
+                # partitions holding superseded rows are rewritten; the others only gain new files
+                superseded = set(con.execute(
+                    f"SELECT DISTINCT year_month, Facility_CODE FROM {dataset} s "
+                    f"WHERE EXISTS (SELECT 1 FROM delta_obs k WHERE k.obs_id = s.obs_id) "
+                    f"OR (s.obs_id IS NULL AND EXISTS "
+                    f"(SELECT 1 FROM delta_encounters k WHERE k.encounter_id = s.encounter_id))"
+                ).fetchall()) if glob.glob(os.path.join(dataset_dir, '*', '*', '*.parquet')) else set()
+                partitions = sorted(superseded, key=lambda p: (p[0] or "", p[1] or ""))
+                appended = sorted(incoming - superseded, key=lambda p: (p[0] or "", p[1] or ""))
+                existing_files = [f for ym, fc in partitions
+                                  for f in self._parquet_files(self._partition_dir(dataset_dir, ym, fc))]
+                selects = ["SELECT * FROM incoming"]
+                if existing_files:
+                    files_sql = ", ".join(f"'{f}'" for f in existing_files)
+                    existing = (f"read_parquet([{files_sql}], hive_partitioning=true, "
+                                f"hive_types={HIVE_TYPES_SQL}, union_by_name=true)")
+                    selects.insert(0, self._keep_unchanged_sql(existing))
+                self._write_partitions(con, " UNION ALL BY NAME ".join(selects), dataset_dir, partitions,
+                                       appended=appended)
+            logger.info(f"🎉 Changes applied ({deleted} voided obs removed)")
+        finally:
+            con.close()
+
     def _finalize_operation(self, final_df, filename):
         """Complete the operation with final checks and cleanup"""
         if not final_df.empty:
@@ -538,7 +2016,8 @@ class DataFetcher:
             try:
                 self._save_final_data(final_df, filename)
                 logger.info(f"Data update complete. Total records: {len(final_df)}")
-                self._clear_recovery_state()
+                self._clear_checkpoint()
+                self._cleanup_after_merge()
             except Exception as e:
                 logger.error(f"Failed final save: {e}")
                 # Try rebuild
@@ -547,7 +2026,8 @@ class DataFetcher:
                 if not rebuilt.empty:
                     logger.info("Rebuild succeeded during finalization.")
                     final_df = rebuilt
-                    self._clear_recovery_state()
+                    self._clear_checkpoint()
+                    self._cleanup_after_merge()
                 else:
                     logger.error("Finalization rebuild failed.")
         else:
@@ -562,7 +2042,10 @@ class DataFetcher:
 
         try:
             # Read only the date column metadata to verify structure
-            columns = pd.read_parquet(filepath, engine="pyarrow", columns=[date_column])
+            if os.path.isdir(filepath):
+                columns = self._read_dataset_column(filepath, date_column, limit=1)
+            else:
+                columns = pd.read_parquet(filepath, engine="pyarrow", columns=[date_column])
             # Ensure column exists & not empty
             if date_column not in columns.columns:
                 return False
@@ -583,10 +2066,25 @@ class DataFetcher:
                 pass
             return False
 
+    @staticmethod
+    def _read_dataset_column(dataset_dir, column, limit=None):
+        """Read a single column of the partitioned dataset"""
+        dataset_glob = os.path.join(dataset_dir, "*", "*", "*.parquet")
+        limit_sql = f"LIMIT {int(limit)}" if limit else ""
+        con = duckdb.connect()
+        try:
+            return con.execute(f"SELECT \"{column}\" FROM read_parquet('{dataset_glob}', hive_partitioning=true, "
+                               f"hive_types={HIVE_TYPES_SQL}) {limit_sql}").df()
+        finally:
+            con.close()
+
     def _get_last_extraction_date(self, file_path, date_column):
         """Safely get the last extraction date from existing Parquet"""
         try:
-            df = pd.read_parquet(file_path, columns=[date_column], engine="pyarrow")
+            if os.path.isdir(file_path):
+                df = self._read_dataset_column(file_path, date_column)
+            else:
+                df = pd.read_parquet(file_path, columns=[date_column], engine="pyarrow")
             if not df.empty and date_column in df:
                 last_date = pd.to_datetime(df[date_column]).max()
                 return last_date.strftime('%Y-%m-%d')
@@ -601,22 +2099,17 @@ class DataFetcher:
             # Merge with existing safely if exists
             if os.path.exists(filename):
                 try:
-                    existing_df = self.safe_read_parquet(filename)
-                    if not existing_df.empty:
-                        df = pd.concat([existing_df, df], ignore_index=True).drop_duplicates()
+                    df = self._merge_existing_file(filename, df)
                 except Exception as e:
                     logger.warning(f"Failed to merge with existing file: {e}")
 
             # Save to temp parquet
-            df.to_parquet(temp_file, index=False, engine="pyarrow")
+            self.write_parquet(df, temp_file)
 
             # Atomic rename
             os.replace(temp_file, filename)
 
-            # Save timestamp
-            timestamp_file = os.path.join(self.path, 'data', 'TimeStamp.csv')
-            os.makedirs(os.path.dirname(timestamp_file), exist_ok=True)
-            pd.DataFrame({'saving_time': [datetime.now().strftime("%d/%m/%Y, %H:%M:%S")]}).to_csv(timestamp_file, index=False)
+            self._write_timestamp()
 
         except Exception as e:
             if os.path.exists(temp_file):
@@ -625,6 +2118,23 @@ class DataFetcher:
                 except Exception:
                     pass
             raise
+
+    def _write_timestamp(self):
+        """Record the time of the last successful save (shown as 'Last updated' in the app)"""
+        timestamp_file = os.path.join(self.path, 'data', 'TimeStamp.csv')
+        os.makedirs(os.path.dirname(timestamp_file), exist_ok=True)
+        # shared by concurrently refreshing sources, so each writes its own temp file and swaps it in
+        temp_file = f"{timestamp_file}.{threading.get_ident()}.tmp"
+        pd.DataFrame({'saving_time': [datetime.now().strftime("%d/%m/%Y, %H:%M:%S")]}).to_csv(temp_file, index=False)
+        os.replace(temp_file, timestamp_file)
+
+    def _cleanup_after_merge(self):
+        """Remove the batch files once the main file holds their rows (a failed cleanup only logs)"""
+        try:
+            self._cleanup_batches()
+        except Exception as e:
+            logger.warning(f"Batch cleanup encountered an error: {e}")
+
     def _cleanup_batches(self):
         """
         Remove all batch parquet files that were saved during the run.
@@ -635,7 +2145,7 @@ class DataFetcher:
         - files containing '.bad_' or '.corrupt_' in filename
         """
         # Explicit expected path for safety
-        expected_batch_dir = os.path.join(self.path, "data", "batches")
+        expected_batch_dir = os.path.join(self.state_dir, "batches")
         batch_dir = expected_batch_dir  # keep naming consistent
 
         # Safety check: ensure we never try to clean any other path
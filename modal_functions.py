@@ -8,7 +8,8 @@ import datetime as dt
 import base64
 import io
 import uuid
-from data_storage import DataStorage
+from data_storage import DataStorage, BASE_DIR
+import projection
 from config import (actual_keys_in_data, 
                     DATA_FILE_NAME_, 
                     DATE_, PERSON_ID_, ENCOUNTER_ID_,
@@ -26,14 +27,8 @@ from config import (actual_keys_in_data,
                     DRUG_NAME_,
                     VALUE_NAME_)
 
-path = os.getcwd()
+path = BASE_DIR
 path_dcc_json = os.path.join(path, 'data', 'dcc_dropdown_json','dropdowns.json')
-with open(path_dcc_json) as r:
-    dcc_json = json.load(r)
-
-drop_down_programs = dcc_json['programs']
-drop_down_encounters = dcc_json['encounters']
-drop_down_concepts = dcc_json['concepts']
 
 # DATASET
 def validate_excel_file(contents):
@@ -274,7 +269,7 @@ def upload_prog_reports_json(contents):
     
 def load_reports_data():
     """Load reports from reports.json"""
-    file_path = os.path.join("data", "hmis_reports.json")
+    file_path = os.path.join(path, "data", "hmis_reports.json")
     
     if not os.path.exists(file_path):
         return {"reports": []}
@@ -285,7 +280,7 @@ def load_reports_data():
 
 def save_reports_data(data):
     """Save reports to reports.json"""
-    file_path = os.path.join("data", "hmis_reports.json")
+    file_path = os.path.join(path, "data", "hmis_reports.json")
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
     
     with open(file_path, "w") as f:
@@ -352,7 +347,7 @@ def update_or_create_report(report_name_df, is_update=False, existing_report=Non
 
 def load_excel_file(page_name):
     """Load Excel file for editing"""
-    file_path = os.path.join("data", "uploads", f"{page_name}.xlsx")
+    file_path = os.path.join(path, "data", "uploads", f"{page_name}.xlsx")
     if not os.path.exists(file_path):
         return None
     
@@ -361,7 +356,7 @@ def load_excel_file(page_name):
 
 def save_excel_file(page_name, sheet_data):
     """Save edited data back to Excel file"""
-    file_path = os.path.join("data", "uploads", f"{page_name}.xlsx")
+    file_path = os.path.join(path, "data", "uploads", f"{page_name}.xlsx")
     
     with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
         for sheet_name, df in sheet_data.items():
@@ -397,29 +392,15 @@ def archive_report(report_id):
 
 # Preview Data
 def load_preview_data():
-    """Load preview data from parquet file"""
+    """Load preview data: the last week of rows across facilities, with identifiers masked"""
     today = datetime.now()
-    start = today.replace(hour=0, minute=0, second=0, microsecond=0)
     end = today.replace(hour=23, minute=59, second=59, microsecond=0)
     
     try:
-        # Load first 1000 records
-        SQL = f"""
-            SELECT *
-            FROM 'data/{DATA_FILE_NAME_}'
-            WHERE Date BETWEEN
-            TIMESTAMP '{end - pd.Timedelta(days=7)}'
-            AND TIMESTAMP '{end.strftime('%Y-%m-%d %H:%M:%S')}'
-            """
-    
-        df = DataStorage.query_duckdb(SQL)
-        df[DATE_] = pd.to_datetime(df[DATE_], format='mixed')
-        df[GENDER_] = df[GENDER_].replace({"M":"Male","F":"Female"})
+        columns = projection.preview_columns(DataStorage.store_columns())
+        df = DataStorage.query_duckdb(*DataStorage.facility_query('range', None, end - pd.Timedelta(days=7), end,
+                                                                  columns=columns))
         df = df.drop_duplicates(subset=[CONCEPT_NAME_])
-        columns = [PERSON_ID_, ENCOUNTER_ID_, GENDER_, AGE_GROUP_, DATE_,
-                                PROGRAM_, ENCOUNTER_,
-                                OBS_VALUE_CODED_,CONCEPT_NAME_,VALUE_,VALUE_NAME_,DRUG_NAME_]
-        df = df[columns]
         df[PERSON_ID_] = 'person_xxx'
         df[ENCOUNTER_ID_] = 'enc_xxx'
         df[DATE_] = '1970-01-01'
@@ -517,6 +498,8 @@ def create_count_item(count_data=None, index=None):
         except TypeError:
             return [value]
     count_data = count_data or {}
+    # dropdown options come from the catalog built at each refresh
+    catalog = DataStorage.load_catalog(path_dcc_json)
     value1 =  ensure_list(count_data.get('filters', {}).get('value1', []))
     value2 = ensure_list(count_data.get('filters', {}).get('value2', []))
     value3 = ensure_list(count_data.get('filters', {}).get('value3', []))
@@ -579,7 +562,7 @@ def create_count_item(count_data=None, index=None):
                     multi=True,
                     options=[
                         {'label': item, 'value': item}
-                        for item in drop_down_programs
+                        for item in catalog['programs']
                     ],
                     className="form-input"
                 ),
@@ -600,7 +583,7 @@ def create_count_item(count_data=None, index=None):
                     multi=True,
                     options=[
                         {'label': item, 'value': item}
-                        for item in drop_down_encounters
+                        for item in catalog['encounters']
                     ],
                     placeholder="",
                     className="form-input"
@@ -622,7 +605,7 @@ def create_count_item(count_data=None, index=None):
                     multi=True,
                     options=[
                         {'label': item, 'value': item}
-                        for item in drop_down_concepts
+                        for item in catalog['concepts']
                     ],
                     className="form-input"
                 ),
@@ -4,6 +4,7 @@ import json
 import os
 import uuid
 import pandas as pd
+from data_storage import DataStorage, TEST_ADMIN, BASE_DIR
 from datetime import datetime
 import base64
 import io
@@ -17,7 +18,7 @@ dash.register_page(__name__, path="/reports_config", title="Admin Dashboard")
 
 
 # Load existing dashboards
-path = os.getcwd()
+path = BASE_DIR
 dashboards_json_path = os.path.join(path, 'data','visualizations', 'validated_dashboard.json')
 
 def load_dashboards_from_file():
@@ -828,17 +829,8 @@ layout = html.Div(
          Output('main-content', 'children')],
         [Input('url-params-store', 'data')])
 def validate_admin_access(urlparams):
-    user_data_path = os.path.join(path, 'data', 'users_data.csv')
-    if not os.path.exists(user_data_path):
-        user_data = pd.DataFrame(columns=['user_id', 'role'])
-    else:
-        user_data = pd.read_csv(os.path.join(path, 'data', 'users_data.csv'))
-        authorized_users = user_data[user_data['role'] == 'Superuser,Superuser']
-    test_admin = pd.DataFrame(columns=['user_id', 'role'], data=[['m3his@dhd', 'reports_admin']])
-    user_data = pd.concat([authorized_users, test_admin], ignore_index=True)
-
-    user_info = user_data[user_data['user_id'] == urlparams.get('uuid', [None])[0]]
-    if user_info.empty:
+    user_roles = DataStorage.user_roles(urlparams.get('uuid', [None])[0], os.path.join(path, 'data'))
+    if not {'Superuser,Superuser', TEST_ADMIN[1]} & set(user_roles):
         return dash.no_update, html.Div([
             html.H2("Access Denied"),
             html.P("You do not have permission to access this page. Please log in as an administrator.")], 
@@ -854,7 +846,7 @@ def validate_admin_access(urlparams):
 )
 def download_template(clicks):
     if clicks:
-        return dcc.send_file("data/report_template.xlsx")
+        return dcc.send_file(os.path.join(path, "data", "report_template.xlsx"))
 
 @callback(
     Output("reports-table-container", "children"),
@@ -1175,7 +1167,7 @@ def upload_file(n_clicks, contents):
     
     try:
         # Create uploads directory if it doesn't exist
-        upload_dir = os.path.join("data", "uploads")
+        upload_dir = os.path.join(path, "data", "uploads")
         os.makedirs(upload_dir, exist_ok=True)
         
         # Extract information from REPORT_NAME sheet
@@ -1504,7 +1496,7 @@ def download_xlsx_report(download_clicks,download_ids):
                 break
         if not current_report:
             return dash.no_update
-        return dcc.send_file(os.path.join("data","uploads",f"{current_report.get('page_name')}.xlsx"))
+        return dcc.send_file(os.path.join(path, "data", "uploads", f"{current_report.get('page_name')}.xlsx"))
     # return 'data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,' + encode_excel_for_download(current_report.get("page_name")), filename=f"{current_report.get('page_name')}.xlsx"
 
 
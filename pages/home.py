@@ -11,7 +11,8 @@ from flask import request
 from helpers import build_charts_section, build_metrics_section
 from datetime import datetime
 from datetime import datetime as dt
-from data_storage import DataStorage
+from data_storage import DataStorage, BASE_DIR
+import projection
 from config import DATA_FILE_NAME_
 
 # Importing parquet file path and from config
@@ -36,14 +37,14 @@ from config import (actual_keys_in_data,
 
 dash.register_page(__name__, path="/home")
 
-path = os.getcwd()
+path = BASE_DIR
 json_path = os.path.join(path, 'data', 'visualizations', 'validated_dashboard.json')
 
 # Load data once to get date range
 min_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
 max_date = datetime.now().replace(hour=23, minute=59, second=59, microsecond=0)
 
-path = os.getcwd()
+path = BASE_DIR
 last_refreshed = pd.read_csv(f'{path}/data/TimeStamp.csv')['saving_time'].to_list()[0]
 
 
@@ -52,8 +53,6 @@ def build_charts_from_json(filtered, data_opd, delta_days, dashboards_json):
     # Load JSON configuration
     config = dashboards_json
     
-    filtered = filtered.copy()
-    filtered['Residence'] = filtered[HOME_DISTRICT_] + ', TA-' + filtered[TA_] + ', ' + filtered[VILLAGE_]
     delta_days = 7 if delta_days <= 0 else delta_days
     
     # Build metrics from counts section
@@ -245,36 +244,18 @@ def update_dashboard(gen, interval, start_date, end_date, menu_clicks, urlparams
             return html.Div("Missing Parameters"), no_update, no_update, clicked_name
 
         # Load Data
-        SQL = f"""
-            SELECT *
-            FROM 'data/{DATA_FILE_NAME_}'
-            WHERE Date >= TIMESTAMP '{last_7_days}'
-            AND {FACILITY_CODE_} = '{location}'
-            """
         try:
-            data = DataStorage.query_duckdb(SQL)
+            columns = projection.dashboard_columns(DataStorage.store_columns(), json_path)
+            data = DataStorage.query_facility('facility_since', location, last_7_days, columns=columns)
         except Exception as e:
             return html.Div('Missing Data. ' \
             'Ensure that the config file has correct database credentials'
             ,style={'color':'red'}), [], '', ''  # Empty DataFrame with expected columns
 
-        data[DATE_] = pd.to_datetime(data[DATE_], format='mixed')
-        data[GENDER_] = data[GENDER_].replace({"M":"Male","F":"Female"})
-        data["DateValue"] = pd.to_datetime(data[DATE_]).dt.date
-        today = dt.today().date()
-        data["months"] = data["DateValue"].apply(lambda d: (today - d).days // 30)
-
+        # Date, Gender, DateValue, Residence and months come typed/derived from the store
         # get user
-        user_data_path = os.path.join(path, 'data', 'users_data.csv')
-        if not os.path.exists(user_data_path):
-            user_data = pd.DataFrame(columns=['user_id', 'role'])
-        else:
-            user_data = pd.read_csv(os.path.join(path, 'data', 'users_data.csv'))
-        test_admin = pd.DataFrame(columns=['user_id', 'role'], data=[['m3his@dhd', 'reports_admin']])
-        user_data = pd.concat([user_data, test_admin], ignore_index=True)
-
-        user_info = user_data[user_data['user_id'] == urlparams.get('uuid', [None])[0]]
-        if user_info.empty:
+        user_roles = DataStorage.user_roles(urlparams.get('uuid', [None])[0], os.path.join(path, 'data'))
+        if not user_roles:
             return html.Div("Unauthorized User. Please contact system administrator."), no_update,no_update, clicked_name
 
         # Apply Dropdown Filters
@@ -10,7 +10,8 @@ import os
 import traceback
 from helpers import build_single_chart
 from datetime import datetime, timedelta
-from data_storage import DataStorage
+from data_storage import DataStorage, BASE_DIR
+import projection
 from config import (actual_keys_in_data, 
                     DATA_FILE_NAME_, 
                     DATE_, PERSON_ID_, ENCOUNTER_ID_,
@@ -34,7 +35,7 @@ dash.register_page(__name__, path="/program_reports")
 from datetime import datetime, timedelta
 from dash import html, dcc
 
-path = os.getcwd()
+path = BASE_DIR
 path_program_reports = os.path.join(path, 'data','visualizations','validated_prog_reports.json')
 dropdowns_json_path = os.path.join(path, 'data', 'dcc_dropdown_json', 'dropdowns.json') 
 
@@ -189,18 +190,9 @@ def update_filters(selected_program):
      State('prog-hf-filter', 'value')] # These are read only when Input triggers
 )
 def generate_chart(n_clicks, urlparams, report_name, start_date, end_date, hf):
-    user_data_path = os.path.join(path, 'data', 'users_data.csv')
-    if not os.path.exists(user_data_path):
-        user_data = pd.DataFrame(columns=['user_id', 'role'])
-    else:
-        user_data = pd.read_csv(os.path.join(path, 'data', 'users_data.csv'))
-    test_admin = pd.DataFrame(columns=['user_id', 'role'], data=[['m3his@dhd', 'reports_admin']])
-    user_data = pd.concat([user_data, test_admin], ignore_index=True)
-
-    user_info = user_data[user_data['user_id'] == urlparams.get('uuid', [None])[0]]
-    if user_info.empty:
+    user_role = DataStorage.user_roles(urlparams.get('uuid', [None])[0], os.path.join(path, 'data'))
+    if not user_role:
         return html.Div("Unauthorized User. Please contact system administrator."), no_update,no_update
-    user_role = user_info['role'].to_list()
     if user_role:
         role = user_role[0]
     else:
@@ -222,21 +214,16 @@ def generate_chart(n_clicks, urlparams, report_name, start_date, end_date, hf):
             return html.Div("Missing Parameters"), no_update, no_update
 
 
-        SQL = f"""
-                SELECT * FROM 'data/{DATA_FILE_NAME_}'
-                WHERE Date BETWEEN '{start_dt}' AND '{end_dt}'
-                AND {FACILITY_CODE_} = '{location}'
-               """
         try:
-            data = DataStorage.query_duckdb(SQL)
+            columns = projection.program_report_columns(DataStorage.store_columns(), path_program_reports)
+            data = DataStorage.query_facility('facility_range', location, start_dt, end_dt, columns=columns)
         except Exception as e:
             return html.Div('Missing Data. ' \
             'Ensure that the config file has correct database credentials'
             ,style={'color':'red'}), [], ''  # Empty DataFrame with expected columns
         
-        data[DATE_] = pd.to_datetime(data[DATE_], format='mixed').dt.strftime('%Y-%m-%d')
-        data[GENDER_] = data[GENDER_].replace({"M":"Male","F":"Female"})
-        data["DateValue"] = pd.to_datetime(data[DATE_]).dt.date
+        # Gender and DateValue come derived from the store; this page works on text dates
+        data[DATE_] = data[DATE_].dt.strftime('%Y-%m-%d')
 
         # if data.empty:
         #     return html.Div("No data found for these dates."), [], []
@@ -246,8 +233,7 @@ def generate_chart(n_clicks, urlparams, report_name, start_date, end_date, hf):
         hf_options = facilities + (["*All health facilities"] if len(facilities) > 1 else [])
 
         # get list of programs for dropdowns.json
-        with open(dropdowns_json_path) as x:
-            dropdowns = json.load(x)
+        dropdowns = DataStorage.load_catalog(dropdowns_json_path)
 
         prog_options = dropdowns['programs'] + ["+ Create a Report"]
 
@@ -17,7 +17,8 @@ from reportlab.lib import colors
 from reportlab.lib.units import inch
 import io
 import base64
-from data_storage import DataStorage
+from data_storage import DataStorage, BASE_DIR
+import projection
 
 from config import (DATE_, FACILITY_, AGE_GROUP_, GENDER_, 
                     NEW_REVISIT_, HOME_DISTRICT_, TA_, VILLAGE_, 
@@ -289,7 +290,7 @@ def update_table(clicks,
     if not urlparams or not period_type or not year_filter or not month_filter or not report_filter:
         return html.Div("Missing Report Parameters"), 0, None
     
-    path = os.getcwd()
+    path = BASE_DIR
     reports_json = os.path.join(path, 'data', 'hmis_reports.json')
     with open(reports_json, "r") as f:
         json_data = json.load(f)
@@ -310,41 +311,26 @@ def update_table(clicks,
     else:
         location = None
     
-    SQL = f"""
-        SELECT *
-        FROM 'data/{DATA_FILE_NAME_}'
-        WHERE {FACILITY_CODE_} = '{location}'
-        """
-    
     try:
-        data = DataStorage.query_duckdb(SQL)
+        columns = projection.hmis_report_columns(DataStorage.store_columns(), reports_json,
+                                                 os.path.join(path, 'data', 'uploads'))
+        data = DataStorage.query_facility('facility', location, columns=columns)
     except Exception as e:
         return html.Div('Missing Data. ' \
             'Ensure that the config file has correct database credentials.'
             ,style={'color':'red'}), 0, None # Empty DataFrame with expected columns
     
-    data[GENDER_] = data[GENDER_].replace({"M":"Male","F":"Female"})
-    data["DateValue"] = pd.to_datetime(data[DATE_]).dt.date
-    today = dt.today().date()
-    data["months"] = data["DateValue"].apply(lambda d: (today - d).days // 30)
+    # Gender, DateValue and months come derived from the store
     # data_opd = data_opd.dropna(subset = ['obs_value_coded','concept_name', 'Value','ValueN', 'DrugName', 'Value_name'], how='all')
     # data_opd.to_csv('data/archive/hmis.csv')
 
     # validate user
-    user_data_path = os.path.join(path, 'data', 'users_data.csv')
-    if not os.path.exists(user_data_path):
-        user_data = pd.DataFrame(columns=['user_id', 'role'])
-    else:
-        user_data = pd.read_csv(os.path.join(path, 'data', 'users_data.csv'))
-    test_admin = pd.DataFrame(columns=['user_id', 'role'], data=[['m3his@dhd', 'reports_admin']])
-    user_data = pd.concat([user_data, test_admin], ignore_index=True)
-
     if urlparams.get('uuid', [None])[0]:
         print("User UUID from URL:", urlparams.get('uuid', [None])[0])
     else:
         return html.Div("Missing Dashboard Parameters. Reports wont load"), dash.no_update, dash.no_update
-    user_info = user_data[user_data['user_id'] == urlparams.get('uuid', [None])[0]]
-    if user_info.empty:
+    user_roles = DataStorage.user_roles(urlparams.get('uuid', [None])[0], os.path.join(path, 'data'))
+    if not user_roles:
         return html.Div("Unauthorized User. Please contact system administrator."), dash.no_update, dash.no_update
  #for cohort analysis this has to be moved forward to the return function
     original_data = data.copy()
@@ -356,7 +342,7 @@ def update_table(clicks,
                 (pd.to_datetime(data[DATE_]) <= pd.to_datetime(end_date))
             ]
             original_data = original_data[original_data[DATE_]<=pd.to_datetime(end_date)]
-            original_data["days_before"] = original_data["DateValue"].apply(lambda d: (start_date - d).days) #filter for relative days before filter
+            original_data["days_before"] = (pd.Timestamp(start_date) - original_data["DateValue"]).dt.days #filter for relative days before filter
 
             spec_path = f"data/uploads/{report['page_name']}.xlsx"
             if not os.path.exists(spec_path):
@@ -374,7 +360,7 @@ def update_table(clicks,
                 (pd.to_datetime(data[DATE_]) <= pd.to_datetime(end_date))
             ]
             original_data = original_data[original_data[DATE_]<=pd.to_datetime(end_date)]
-            original_data["days_before"] = original_data["DateValue"].apply(lambda d: (start_date - d).days)
+            original_data["days_before"] = (pd.Timestamp(start_date) - original_data["DateValue"]).dt.days
 
             spec_path = f"data/uploads/{report['page_name']}.xlsx"
             if not os.path.exists(spec_path):
@@ -400,7 +386,7 @@ def update_table(clicks,
                 (pd.to_datetime(data[DATE_]) <= pd.to_datetime(end_date))
             ]
             original_data = original_data[original_data[DATE_]<=pd.to_datetime(end_date)]
-            original_data["days_before"] = original_data["DateValue"].copy().apply(lambda d: (start_date - d).days)
+            original_data["days_before"] = (pd.Timestamp(start_date) - original_data["DateValue"]).dt.days
             
             spec_path = f"data/uploads/{report['page_name']}.xlsx"
             if not os.path.exists(spec_path):
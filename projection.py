@@ -0,0 +1,123 @@
+"""
+Column projection for page queries.
+
+Works out which store columns a family of report specs references (dashboard JSON, program
+report JSON, Excel HMIS report specs), so pages load those columns instead of SELECT *.
+Each family is planned as the union over all its specs: every report of a page then shares
+one cached frame per facility, and the refresh warm-up fills exactly the frames pages ask for.
+"""
+import json
+import os
+from functools import lru_cache
+
+import pandas as pd
+from config import (DATE_, PERSON_ID_, ENCOUNTER_ID_, FACILITY_, FACILITY_CODE_, AGE_GROUP_, GENDER_,
+                    PROGRAM_, ENCOUNTER_, OBS_VALUE_CODED_, CONCEPT_NAME_, VALUE_, VALUE_NAME_, DRUG_NAME_)
+
+# Columns the pages and chart helpers use themselves, whatever the specs say
+DASHBOARD_BASE = [DATE_, PERSON_ID_, ENCOUNTER_ID_, FACILITY_, FACILITY_CODE_, AGE_GROUP_]
+PROGRAM_REPORT_BASE = [DATE_, PERSON_ID_, ENCOUNTER_ID_, FACILITY_, FACILITY_CODE_]
+HMIS_REPORT_BASE = [DATE_, 'DateValue', PERSON_ID_, ENCOUNTER_ID_, FACILITY_, FACILITY_CODE_]
+# The configuration page's data preview, which report variable names are also checked against
+PREVIEW_BASE = [PERSON_ID_, ENCOUNTER_ID_, GENDER_, AGE_GROUP_, DATE_, PROGRAM_, ENCOUNTER_,
+                OBS_VALUE_CODED_, CONCEPT_NAME_, VALUE_, VALUE_NAME_, DRUG_NAME_]
+
+# FILTERS sheet columns of an Excel spec that name data columns (and their defaults in ReportTableBuilder)
+EXCEL_COLUMN_FIELDS = {'num_field': 'ValueN', 'unique_column': 'encounter_id'}
+
+
+def plan(available, references, base=()):
+    """The available store columns (in store order) that are referenced or always needed"""
+    wanted = set(references) | set(base)
+    return [c for c in available if c in wanted]
+
+
+def spec_references(spec):
+    """
+    Every string a JSON spec holds (values, list items, dict keys). Spec keys name columns
+    in many ways (variableN, filter_colN, x_col, group_colsN, groupN_filters keys, ...);
+    matching all strings against the store's columns catches each of them, and a
+    filter value that happens to equal a column name only costs one extra column.
+    """
+    found = set()
+    stack = [spec]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            found.add(item.strip())
+            found.update(part.strip() for part in item.split('|'))
+        elif isinstance(item, dict):
+            found.update(str(key).strip() for key in item)
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    return found
+
+
+def excel_spec_references(path):
+    """Columns named in the FILTERS sheet of an Excel report spec (variable1..9, num_field, unique_column)"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return frozenset()
+    return _read_excel_references(path, mtime)
+
+
+@lru_cache(maxsize=256)
+def _read_excel_references(path, mtime):
+    # imported here: reports_class pulls in the chart libraries, which the refresh job does not need
+    from reports_class import ReportTableBuilder
+    filters_df = pd.read_excel(path, sheet_name="FILTERS", engine="openpyxl").fillna("")
+    filters_df.columns = [str(c).strip() for c in filters_df.columns]
+    found = set(EXCEL_COLUMN_FIELDS.values())
+    for _, row in filters_df.iterrows():
+        for field, default in EXCEL_COLUMN_FIELDS.items():
+            found.add(str(row.get(field, default)).strip() or default)
+        for i in range(1, 10):
+            parsed = ReportTableBuilder._parse_col_value(str(row.get(f"variable{i}", "")).strip())
+            found.update(parsed if isinstance(parsed, list) else [parsed])
+    return frozenset(found)
+
+
+def json_spec_references(path):
+    """spec_references() of a JSON spec file, re-read only when the file changes"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return frozenset()
+    return _read_json_references(path, mtime)
+
+
+@lru_cache(maxsize=16)
+def _read_json_references(path, mtime):
+    with open(path) as f:
+        return frozenset(spec_references(json.load(f)))
+
+
+def dashboard_columns(available, path):
+    """Columns the home page dashboards need"""
+    return plan(available, json_spec_references(path), DASHBOARD_BASE)
+
+
+def program_report_columns(available, path):
+    """Columns the program reports need"""
+    return plan(available, json_spec_references(path), PROGRAM_REPORT_BASE)
+
+
+def hmis_report_columns(available, reports_json, uploads_dir):
+    """Columns the active (not archived) Excel HMIS reports need"""
+    try:
+        with open(reports_json) as f:
+            reports = json.load(f).get("reports", [])
+    except FileNotFoundError:
+        reports = []
+    references = set()
+    for report in reports:
+        if str(report.get("archived", "")).lower() == "false":
+            references |= excel_spec_references(os.path.join(uploads_dir, f"{report['page_name']}.xlsx"))
+    return plan(available, references, HMIS_REPORT_BASE)
+
+
+def preview_columns(available):
+    """Columns the configuration page's data preview shows"""
+    return plan(available, (), PREVIEW_BASE)
@@ -13,8 +13,15 @@ echo "Working directory set to: $BASE_DIR"
 echo "Activating virtual environment..."
 source "$BASE_DIR/venv/bin/activate"
 
+# Import the app once in the master before forking workers (GUNICORN_PRELOAD=true), so they
+# share its pages copy-on-write; each worker still opens its own DuckDB connection
+PRELOAD=()
+if [ "${GUNICORN_PRELOAD:-false}" = "true" ]; then
+    PRELOAD=(--preload)
+fi
+
 # Start Gunicorn
-exec python -m gunicorn \
+exec python -m gunicorn "${PRELOAD[@]}" \
     --workers 4 \
     --threads 2 \
     --worker-class gthread \
@@ -1,78 +1,137 @@
 # start_scheduler.py
 import subprocess
 import threading
-import schedule
+import logging
+import gc
 import time
 import os
 from datetime import datetime
+import data_storage
+
+LOG_DIR = "/app/logs"
+
+def next_interval(current, duration, base, maximum):
+    """
+    Seconds to wait before the next refresh. Backs off (doubling, up to maximum) when a refresh
+    took more than half the interval, and tightens (halving, down to base) when it took under a tenth.
+    """
+    if duration > current * 0.5:
+        return min(current * 2, maximum)
+    if duration < current * 0.1:
+        return max(current / 2, base)
+    return current
 
 def run_data_storage():
-    """Run the data_storage.py script and log output"""
+    """
+    Run one refresh in this process through data_storage.refresh() (imports are paid once).
+    Everything logged during the run (data_storage, db_services) also goes to data_update.log.
+    Returns (status, seconds) with status 'ok', 'skipped' (another refresh holds the store lock) or 'failed'.
+    """
+    log_file = os.path.join(LOG_DIR, "data_update.log")
+    started = time.perf_counter()
+    with open(log_file, "a") as f:
+        f.write(f"\n{'='*50}\n")
+        f.write(f"Starting data update at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"{'='*50}\n")
+    handler = logging.FileHandler(log_file)
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logging.getLogger().addHandler(handler)
+    try:
+        status = 'ok' if data_storage.refresh(blocking=False) else 'skipped'
+    except Exception as e:
+        status = 'failed'
+        logging.exception("Data update failed")
+        with open(os.path.join(LOG_DIR, "data_update_error.log"), "a") as f:
+            f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Error running data update: {str(e)}\n")
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+        # release the frames of the legacy path before the process idles until the next run
+        gc.collect()
+    seconds = time.perf_counter() - started
+
+    with open(log_file, "a") as f:
+        f.write(f"\nData update {status} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ({seconds:.0f}s)\n")
+    print(f"Data update {status} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ({seconds:.0f}s)")
+    return status, seconds
+
+def run_compaction():
+    """Merge small store files in this process (skips itself while a refresh runs)"""
     try:
-        log_file = "/app/logs/data_update.log"
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        with open(log_file, "a") as f:
-            f.write(f"\n{'='*50}\n")
-            f.write(f"Starting data update at {timestamp}\n")
-            f.write(f"{'='*50}\n")
-        
-        # Run data_storage.py and capture output
-        result = subprocess.run(
-            ["python", "/app/data_storage.py"],
-            capture_output=True,
-            text=True
-        )
-        
-        with open(log_file, "a") as f:
-            f.write(f"Exit code: {result.returncode}\n")
-            if result.stdout:
-                f.write(f"STDOUT:\n{result.stdout}\n")
-            if result.stderr:
-                f.write(f"STDERR:\n{result.stderr}\n")
-            f.write(f"\nData update completed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        
-        print(f"Data update completed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        
+        metrics = data_storage.DataStorage().compact()
+        with open(os.path.join(LOG_DIR, "compaction.log"), "a") as f:
+            f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {metrics if metrics else 'skipped'}\n")
     except Exception as e:
-        error_msg = f"Error running data_storage.py: {str(e)}"
-        print(error_msg)
-        with open("/app/logs/data_update_error.log", "a") as f:
-            f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {error_msg}\n")
+        logging.exception("Compaction failed")
+        with open(os.path.join(LOG_DIR, "data_update_error.log"), "a") as f:
+            f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Error running compaction: {str(e)}\n")
+
+def compaction_interval():
+    """
+    Seconds between background compactions: COMPACTION_INTERVAL minutes (0 disables). Compaction
+    needs SNAPSHOTS (DataStorage.compact skips itself without them), so without them it is off.
+    """
+    if not data_storage.SNAPSHOTS:
+        return 0
+    return int(os.getenv('COMPACTION_INTERVAL', '360')) * 60
 
 def run_scheduler():
-    """Run the scheduler in a separate thread"""
-    # Get update interval from environment variable (default 30 minutes)
-    interval = int(os.getenv('DATA_UPDATE_INTERVAL', '30'))
-    
-    print(f"Scheduler started. Data will be updated every {interval} minutes.")
-    
-    # Schedule the data update
-    schedule.every(interval).minutes.do(run_data_storage)
-    
-    # Run initial data load if specified
-    if os.getenv('INITIAL_DATA_LOAD', 'true').lower() == 'true':
-        print("Running initial data load...")
-        run_data_storage()
-    
+    """
+    Run refreshes back to back in this thread, so a slow refresh can never overlap the next
+    one; the store lock also skips a run while a refresh from another process (cron, manual) is going.
+    """
+    # Base update interval from environment variable (default 30 minutes), adapted to refresh duration
+    base = int(os.getenv('DATA_UPDATE_INTERVAL', '30')) * 60
+    maximum = max(int(os.getenv('DATA_UPDATE_MAX_INTERVAL', str(base // 60 * 8))) * 60, base)
+    # Compact small store files in the background (off without SNAPSHOTS)
+    compaction_every = compaction_interval()
+
+    print(f"Scheduler started. Data will be updated every {base // 60} minutes "
+          f"(backing off up to {maximum // 60} minutes when refreshes run long).")
+    print(f"Store compaction every {compaction_every // 60} minutes." if compaction_every
+          else "Store compaction off (it needs SNAPSHOTS = True in config.py).")
+
+    interval = base
+    next_refresh = time.time()
+    if os.getenv('INITIAL_DATA_LOAD', 'true').lower() != 'true':
+        next_refresh += interval
+    next_compaction = time.time() + compaction_every
+
     # Keep the scheduler running
     while True:
-        schedule.run_pending()
-        time.sleep(60)  # Check every minute
+        now = time.time()
+        if now >= next_refresh:
+            status, seconds = run_data_storage()
+            if status == 'ok':
+                interval = next_interval(interval, seconds, base, maximum)
+            elif status == 'failed':
+                # most failures are transient (DB, SSH): retry soon rather than backing off for hours
+                interval = base
+            # skipped: the other refresh is still going, try again after the same interval
+            next_refresh = time.time() + interval
+            print(f"Next data update in {interval / 60:.0f} minutes")
+        elif compaction_every > 0 and now >= next_compaction:
+            run_compaction()
+            next_compaction = time.time() + compaction_every
+        time.sleep(min(60, max(1, next_refresh - time.time())))
 
 def start_dash_app():
     """Start the Dash application"""
     print("Starting Dash application...")
-    
+
+    # GUNICORN_PRELOAD=true imports the app once before forking, the workers share its pages
+    preload = ["--preload"] if os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true' else []
     subprocess.run([
         "python", "-m", "gunicorn",
+        *preload,
         "--workers", "4",
         "--bind", "0.0.0.0:8050",
         "wsgi:server"
     ])
 
 if __name__ == "__main__":
-    os.makedirs("/app/logs", exist_ok=True)
+    os.makedirs(LOG_DIR, exist_ok=True)
     scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
     scheduler_thread.start()
-    start_dash_app()
\ No newline at end of file
+    start_dash_app()
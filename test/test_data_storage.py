@@ -0,0 +1,485 @@
+# test_data_storage.py
+import functools
+import logging
+import threading
+import pytest
+import pandas as pd
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from flask import Flask
+
+import data_storage
+import db_services
+import projection
+from benchmarks.openmrs_standin import connect, seed
+from data_storage import DataStorage
+from db_services import DataFetcher
+import start_scheduler
+from start_scheduler import next_interval
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_storage, 'BASE_DIR', str(tmp_path))  # default paths point into tmp_path/data
+    monkeypatch.setattr(data_storage, 'SNAPSHOTS', True)
+    monkeypatch.setattr(data_storage, 'SNAPSHOT_RETENTION', 2)
+    instance = DataStorage(data_dir=str(tmp_path / "data"), filename="store.parquet")
+    return instance
+
+
+@pytest.fixture
+def page_storage(tmp_path, monkeypatch):
+    """The default store under tmp_path/data without snapshots, where page queries read by default"""
+    monkeypatch.setattr(data_storage, 'BASE_DIR', str(tmp_path))
+    monkeypatch.setattr(data_storage, 'SNAPSHOTS', False)
+    return DataStorage(data_dir=str(tmp_path / "data"))
+
+
+def write_store(storage, rows):
+    """Replace the store file the way the fetcher does (new file swapped in)"""
+    pd.DataFrame({'Facility_CODE': ['7'] * rows, 'person_id': range(rows),
+                  'Date': [pd.Timestamp('2025-01-01').date()] * rows}).to_parquet(f"{storage.filepath}.tmp")
+    os.replace(f"{storage.filepath}.tmp", storage.filepath)
+
+
+class TestSnapshots:
+    """Test cases for versioned snapshots and per-request pinning"""
+
+    def test_publish_is_write_once_and_pruned(self, storage):
+        """Each publish gets its own directory, CURRENT moves, only the newest snapshots are kept"""
+        ids = []
+        for rows in (1, 2, 3):
+            write_store(storage, rows)
+            ids.append(storage.publish_snapshot())
+
+        assert DataStorage.current_snapshot(storage.data_dir) == ids[-1]
+        assert sorted(d for d in os.listdir(os.path.join(storage.data_dir, "snapshots"))
+                      if d != "CURRENT") == ids[1:]
+        snapshot_file = os.path.join(storage.data_dir, "snapshots", ids[1], "store.parquet")
+        assert len(pd.read_parquet(snapshot_file)) == 2
+
+    def test_request_stays_on_pinned_snapshot(self, storage):
+        """A refresh published mid-request is only seen by the next request"""
+        write_store(storage, 1)
+        first = storage.publish_snapshot()
+        app = Flask(__name__)
+
+        with app.test_request_context():
+            assert DataStorage.snapshot_id(storage.data_dir) == first
+            write_store(storage, 5)
+            second = storage.publish_snapshot()
+            source = DataStorage.parquet_source(storage.filepath)
+            assert first in source
+            assert DataStorage.query_duckdb(f"SELECT count(*) AS n FROM {source}")['n'][0] == 1
+
+        with app.test_request_context():
+            assert DataStorage.snapshot_id(storage.data_dir) == second
+
+    def test_compaction_publishes_a_snapshot_and_needs_snapshots(self, storage, monkeypatch):
+        """Pinned readers keep their rows through a compaction; without SNAPSHOTS it does not run"""
+        # one row group per row, as appended refreshes leave them
+        pd.DataFrame({'Facility_CODE': ['7'] * 3, 'person_id': range(3),
+                      'Date': [pd.Timestamp('2025-01-01').date()] * 3}).to_parquet(storage.filepath, row_group_size=1)
+        first = storage.publish_snapshot()
+        app = Flask(__name__)
+
+        with app.test_request_context():
+            assert DataStorage.snapshot_id(storage.data_dir) == first
+            metrics = storage.compact(min_files=2, min_row_group_rows=10)
+            source = DataStorage.parquet_source(storage.filepath)
+            assert DataStorage.query_duckdb(f"SELECT count(*) AS n FROM {source}", cache=False)['n'][0] == 3
+
+        assert metrics['partitions_compacted'] == 1
+        assert DataStorage.current_snapshot(storage.data_dir) != first
+
+        monkeypatch.setattr(data_storage, 'SNAPSHOTS', False)
+        before = os.stat(storage.filepath).st_ino
+        assert storage.compact(min_files=2, min_row_group_rows=10) is None
+        assert os.stat(storage.filepath).st_ino == before
+
+
+class TestParquetSource:
+    """Test cases for the query-time columns of parquet_source"""
+
+    def test_default_paths_ignore_working_directory(self, page_storage, tmp_path, monkeypatch):
+        """Page reads find the repository's data/ from any working directory"""
+        write_store(page_storage, 3)
+        elsewhere = tmp_path / "elsewhere"
+        elsewhere.mkdir()
+        monkeypatch.chdir(elsewhere)
+
+        assert DataStorage.data_exists()
+        assert len(DataStorage.query_facility('facility', '7')) == 3
+        assert DataStorage.user_roles('m3his@dhd') == ('reports_admin',)
+
+    def test_months_counts_whole_30_day_periods(self, storage, monkeypatch):
+        """months is computed in SQL from Date relative to today"""
+        monkeypatch.setattr(data_storage, 'SNAPSHOTS', False)
+        today = pd.Timestamp.today().normalize()
+        pd.DataFrame({'person_id': [1, 2, 3],
+                      'Date': [today.date(), (today - pd.Timedelta(days=29)).date(),
+                               (today - pd.Timedelta(days=61)).date()]}).to_parquet(storage.filepath)
+
+        data = DataStorage.query_duckdb(f"SELECT * FROM {DataStorage.parquet_source(storage.filepath)} "
+                                        f"ORDER BY person_id")
+
+        assert data['months'].tolist() == [0, 0, 2]
+
+    def test_rows_written_before_derived_columns_are_completed(self, storage, monkeypatch):
+        """Old rows read with Male/Female, DateValue and Residence, whether the columns are missing or NULL"""
+        monkeypatch.setattr(data_storage, 'SNAPSHOTS', False)
+        old = pd.DataFrame({'person_id': [1, 2], 'Gender': ['M', 'F'],
+                            'Date': [pd.Timestamp('2025-01-01'), pd.Timestamp('2025-01-02')],
+                            'Home_district': ['Zomba'] * 2, 'TA': ['Mwambo'] * 2, 'Village': ['Likangala'] * 2})
+        old.to_parquet(storage.filepath)
+        query = f"SELECT * FROM {DataStorage.parquet_source(storage.filepath)} ORDER BY person_id"
+
+        data = DataStorage.query_duckdb(query, cache=False)
+
+        assert data['Gender'].tolist() == ['Male', 'Female']
+        assert data['DateValue'].astype(str).tolist() == ['2025-01-01', '2025-01-02']
+        assert data['Residence'].tolist() == ['Zomba, TA-Mwambo, Likangala'] * 2
+
+        merged = os.path.join(storage.data_dir, "merged.parquet")
+        old.assign(DateValue=[pd.Timestamp('2025-01-01').date(), None]).to_parquet(merged)
+        data = DataStorage.query_duckdb(f"SELECT * FROM {DataStorage.parquet_source(merged)} ORDER BY person_id",
+                                        cache=False)
+        assert data['DateValue'].astype(str).tolist() == ['2025-01-01', '2025-01-02']
+
+
+class TestRefreshScheduling:
+    """Test cases for overlap locking and the adaptive refresh interval"""
+
+    def test_refresh_skipped_while_store_locked(self, storage):
+        """A non-blocking refresh returns False while another refresh holds the store lock"""
+        with DataFetcher.store_lock(storage.filepath) as acquired:
+            assert acquired
+            assert storage.fetch_and_save(blocking=False) is False
+
+    def test_interval_backs_off_and_tightens(self):
+        """Long refreshes double the interval up to the maximum, quick ones halve it back to the base"""
+        assert next_interval(1800, 1200, 1800, 7200) == 3600
+        assert next_interval(3600, 3000, 1800, 7200) == 7200
+        assert next_interval(7200, 5000, 1800, 7200) == 7200
+        assert next_interval(7200, 300, 1800, 7200) == 3600
+        assert next_interval(1800, 60, 1800, 7200) == 1800
+        assert next_interval(3600, 600, 1800, 7200) == 3600
+
+    def test_compaction_scheduled_only_with_snapshots(self, monkeypatch):
+        """The scheduler only compacts when SNAPSHOTS makes compaction safe"""
+        monkeypatch.setenv('COMPACTION_INTERVAL', '120')
+        monkeypatch.setattr(data_storage, 'SNAPSHOTS', False)
+        assert start_scheduler.compaction_interval() == 0
+        monkeypatch.setattr(data_storage, 'SNAPSHOTS', True)
+        assert start_scheduler.compaction_interval() == 7200
+
+    def test_refresh_logging_reaches_update_log(self, tmp_path, monkeypatch):
+        """Records logged by the refresh modules during a run are written to data_update.log"""
+        monkeypatch.setattr(start_scheduler, 'LOG_DIR', str(tmp_path))
+
+        def failing_refresh(blocking=True):
+            logging.getLogger('db_services').error("SSH tunnel closed")
+            raise RuntimeError("SSH tunnel closed")
+        monkeypatch.setattr(start_scheduler.data_storage, 'refresh', failing_refresh)
+
+        status, _ = start_scheduler.run_data_storage()
+        logging.getLogger('db_services').error("after the run")
+
+        assert status == 'failed'
+        log = (tmp_path / "data_update.log").read_text()
+        assert "db_services: SSH tunnel closed" in log and "after the run" not in log
+
+
+class TestQueryCache:
+    """Test cases for the versioned query cache and the post-refresh warm-up"""
+
+    def test_warm_up_prefills_and_refresh_invalidates(self, page_storage, monkeypatch):
+        """warm_up() caches the facility queries pages issue; a refresh event moves the cache key"""
+        monkeypatch.setattr(data_storage, '_query_cache', data_storage.QueryCache(64 * 1024 * 1024))
+
+        def refresh(rows):
+            pd.DataFrame({'Facility_CODE': ['7'] * rows, 'person_id': range(rows),
+                          'Date': [pd.Timestamp.today().date()] * rows}).to_parquet(f"{page_storage.filepath}.tmp")
+            os.replace(f"{page_storage.filepath}.tmp", page_storage.filepath)
+            page_storage.publish_refresh_event()
+
+        def report_frame():
+            # what the HMIS reports page loads: the projected facility frame
+            columns = projection.hmis_report_columns(DataStorage.store_columns(),
+                                                     os.path.join(page_storage.data_dir, "hmis_reports.json"),
+                                                     os.path.join(page_storage.data_dir, "uploads"))
+            return DataStorage.query_facility('facility', '7', columns=columns)
+
+        refresh(3)
+        DataStorage.warm_up(facilities=2)
+        # the store's column list plus the report and dashboard frames
+        assert DataStorage.cache_stats()['entries'] == 3
+
+        frame = report_frame()
+        assert len(frame) == 3 and 'months' not in frame.columns
+        assert DataStorage.cache_stats()['hits'] == 2
+
+        refresh(5)
+        assert len(report_frame()) == 5
+
+    def test_cache_bounded_by_memory_and_frames_private(self):
+        """Eviction is by frame size, whitespace-only SQL differences share an entry, edits stay local"""
+        frame = pd.DataFrame({'x': range(1000)})
+        size = int(frame.memory_usage(index=True, deep=True).sum())
+        cache = data_storage.QueryCache(max_bytes=2 * size)
+        runs = []
+
+        def run(n):
+            runs.append(n)
+            return pd.DataFrame({'x': range(1000)}) + n
+
+        first = cache.get(data_storage.QueryCache.key("SELECT 1\n  WHERE y = 'a  b'", (), 'v1'), lambda: run(1))
+        first.loc[0, 'x'] = -1
+        again = cache.get(data_storage.QueryCache.key("SELECT 1 WHERE y = 'a  b'", (), 'v1'), lambda: run(1))
+        assert runs == [1] and again.loc[0, 'x'] == 1
+        assert cache.key("SELECT 'a b'", (), 'v1') != cache.key("SELECT 'a  b'", (), 'v1')
+
+        cache.get(cache.key("SELECT 2", (), 'v1'), lambda: run(2))
+        cache.get(cache.key("SELECT 3", (), 'v2'), lambda: run(3))
+        assert cache.stats()['entries'] == 2 and cache.stats()['evictions'] == 1
+        assert cache.stats()['bytes'] <= cache.max_bytes
+
+        assert cache.invalidate('v2') == 1
+        assert cache.stats()['entries'] == 1 and cache.stats()['hits'] == 1 and cache.stats()['misses'] == 3
+
+    def test_facility_patterns_bind_values_on_per_thread_connections(self, storage, monkeypatch):
+        """Facility and dates are bound parameters; each thread reuses its own cursor on one database"""
+        monkeypatch.setattr(data_storage, 'SNAPSHOTS', False)
+        day = pd.Timestamp('2025-01-10')
+        pd.DataFrame({'Facility_CODE': ['7'] * 5 + ['8'],
+                      'Date': [(day + pd.Timedelta(days=i)).date() for i in range(5)] + [day.date()]}).to_parquet(
+            storage.filepath)
+        monkeypatch.setattr(DataStorage, 'parquet_source', staticmethod(lambda path=None: f"'{storage.filepath}'"))
+
+        assert len(DataStorage.query_facility('facility_since', '7', day + pd.Timedelta(days=3))) == 2
+        assert len(DataStorage.query_facility('facility_range', '7', day, day + pd.Timedelta(days=1))) == 2
+        assert len(DataStorage.query_facility('facility_until', '7', end=day)) == 1
+        assert DataStorage.query_facility('facility', "7' OR '1'='1").empty
+
+        con = DataStorage.connection()
+        assert DataStorage.connection() is con
+        other = []
+        thread = threading.Thread(target=lambda: other.append(DataStorage.connection()))
+        thread.start()
+        thread.join()
+        assert other[0] is not con
+
+
+    def test_preview_reads_last_week_of_all_facilities_projected(self, page_storage):
+        """The configuration preview binds its date range and selects only the preview columns"""
+        import modal_functions
+        today = pd.Timestamp.today().normalize()
+        pd.DataFrame({'Facility_CODE': ['7', '9', '9'], 'person_id': [1, 2, 3], 'given_name': ['a', 'b', 'c'],
+                      'concept_name': ['Weight', 'Height', 'Pulse'],
+                      'Date': [today.date(), (today - pd.Timedelta(days=2)).date(),
+                               (today - pd.Timedelta(days=30)).date()]}).to_parquet(page_storage.filepath)
+
+        sql, params = DataStorage.facility_query('range', None, today - pd.Timedelta(days=7), today)
+        assert set(params) == {'start', 'end'} and str(today.year) not in sql
+
+        df, error = modal_functions.load_preview_data()
+        assert error is None
+        assert sorted(df['concept_name']) == ['Height', 'Weight']
+        assert 'given_name' not in df.columns and 'Facility_CODE' not in df.columns
+        assert set(df['person_id']) == {'person_xxx'}
+
+
+class TestArrowSnapshot:
+    """Test cases for the memory-mapped Arrow snapshot shared by the workers"""
+
+    def test_facility_slices_match_duckdb(self, page_storage, monkeypatch):
+        """Facility and date ranges sliced from the mapped file return the rows the DuckDB filters do"""
+        today = pd.Timestamp.today().normalize()
+        dates = [(today - pd.Timedelta(days=d)).date() for d in range(40)] + [None]
+        pd.DataFrame({'Facility_CODE': [str(code) for code in range(3)] * 41, 'person_id': range(123),
+                      'Date': dates * 3}).to_parquet(page_storage.filepath)
+        arrow_id = page_storage.publish_arrow_snapshot()
+        assert os.path.exists(os.path.join(page_storage.data_dir, "arrow", f"{arrow_id}.arrow"))
+
+        start, end = today - pd.Timedelta(days=30), today - pd.Timedelta(days=7)
+        for pattern, bounds in (('facility', {}), ('facility_since', {'start': start}),
+                                ('facility_range', {'start': start, 'end': end}),
+                                ('facility_until', {'end': end})):
+            for columns in (None, ['person_id', 'Date']):
+                monkeypatch.setattr(data_storage, 'ARROW_SNAPSHOT', False)
+                expected = DataStorage.query_facility(pattern, 1, columns=columns, **bounds)
+                monkeypatch.setattr(data_storage, 'ARROW_SNAPSHOT', True)
+                sliced = DataStorage.query_facility(pattern, 1, columns=columns, **bounds)
+
+                assert list(sliced.columns) == list(expected.columns)
+                assert sorted(sliced['person_id']) == sorted(expected['person_id'])
+                if columns is None:
+                    assert (sliced.sort_values('person_id')['months'].fillna(-1).tolist()
+                            == expected.sort_values('person_id')['months'].fillna(-1).tolist())
+        assert DataStorage.query_facility('facility', 'unknown').empty
+
+
+class TestServingDatabase:
+    """Test cases for the read-only DuckDB serving database"""
+
+    def test_pages_read_clustered_serving_database_with_cohort_indexes(self, page_storage, monkeypatch):
+        """Page queries read the published database, which is clustered by facility/date and indexed"""
+        today = pd.Timestamp.today().normalize()
+        pd.DataFrame({'Facility_CODE': ['9', '7'] * 20, 'person_id': range(40), 'encounter_id': range(100, 140),
+                      'Date': [(today - pd.Timedelta(days=d)).date() for d in range(40)]}).to_parquet(page_storage.filepath)
+        start = today - pd.Timedelta(days=10)
+        expected = DataStorage.query_facility('facility_since', '7', start=start)
+
+        serving_id = page_storage.publish_serving_db()
+        monkeypatch.setattr(data_storage, 'SERVING_DB', True)
+        page_storage.publish_refresh_event()
+
+        assert f"serving_{serving_id}" in DataStorage.parquet_source()
+        served = DataStorage.query_facility('facility_since', '7', start=start)
+        assert sorted(served['person_id']) == sorted(expected['person_id']) and len(served) == 5
+        assert served.drop(columns='months').columns.tolist() == expected.drop(columns='months').columns.tolist()
+        indexes = DataStorage.query_duckdb(f"SELECT index_name FROM duckdb_indexes() "
+                                           f"WHERE database_name = 'serving_{serving_id}'", cache=False)
+        assert set(indexes['index_name']) == {'obs_person_id', 'obs_encounter_id'}
+        codes = DataStorage.query_duckdb(f"SELECT Facility_CODE FROM serving_{serving_id}.obs", cache=False)
+        assert codes['Facility_CODE'].tolist() == ['7'] * 20 + ['9'] * 20
+
+        second = page_storage.publish_serving_db()
+        assert f"serving_{second}" in DataStorage.parquet_source()
+
+    def test_fresh_worker_opens_serving_database(self, page_storage, monkeypatch):
+        """The first page query of a worker without a DuckDB database yet attaches the serving database"""
+        pd.DataFrame({'Facility_CODE': ['7', '9'], 'person_id': [1, 2],
+                      'Date': [pd.Timestamp('2025-01-01').date()] * 2}).to_parquet(page_storage.filepath)
+        page_storage.publish_serving_db()
+        monkeypatch.setattr(data_storage, 'SERVING_DB', True)
+        page_storage.publish_refresh_event()
+        # as in a freshly forked worker: no database opened, nothing attached
+        monkeypatch.setattr(data_storage, '_duckdb_database', None)
+        monkeypatch.setattr(data_storage, '_serving_attached', {})
+        monkeypatch.setattr(data_storage, '_duckdb_local', threading.local())
+
+        served = []
+        worker = threading.Thread(target=lambda: served.append(DataStorage.query_facility('facility', '7')), daemon=True)
+        worker.start()
+        worker.join(timeout=30)
+        assert not worker.is_alive(), "page query hung opening the serving database"
+        assert served[0]['person_id'].tolist() == [1]
+
+    def test_serving_database_detached_once_no_request_reads_it(self, page_storage, monkeypatch):
+        """An older serving database stays attached while a request pinned to it is still running"""
+        pd.DataFrame({'Facility_CODE': ['7'], 'person_id': [1],
+                      'Date': [pd.Timestamp('2025-01-01').date()]}).to_parquet(page_storage.filepath)
+        monkeypatch.setattr(data_storage, 'SERVING_DB', True)
+        monkeypatch.setattr(data_storage, '_serving_attached', {})
+        app = Flask(__name__)
+        app.teardown_request(DataStorage.release_serving)
+
+        first = page_storage.publish_serving_db()
+        with app.test_request_context():
+            pinned = DataStorage.parquet_source()
+            assert f"serving_{first}" in pinned
+            for _ in range(3):
+                page_storage.publish_serving_db()
+                # a concurrent request of another thread: its own app context, so its own flask.g
+                with app.app_context(), app.test_request_context():
+                    DataStorage.parquet_source()
+            assert f"serving_{first}" in data_storage._serving_attached
+            assert DataStorage.query_duckdb(f"SELECT count(*) AS n FROM {pinned}", cache=False)['n'][0] == 1
+        assert f"serving_{first}" not in data_storage._serving_attached
+        assert len(data_storage._serving_attached) == 2
+
+
+class TestCatalog:
+    """Test cases for the dropdowns.json catalog build"""
+
+    def test_catalog_lists_counts_and_nested_values(self, storage, monkeypatch):
+        """One aggregate scan yields the dropdown lists, frequencies and per-program/per-concept values"""
+        monkeypatch.setattr(data_storage, 'SNAPSHOTS', False)
+        pd.DataFrame({
+            'Program': ['OPD', 'OPD', 'ANC', None],
+            'Encounter': ['VITALS', 'DIAGNOSIS', 'VITALS', 'VITALS'],
+            'concept_name': ['Weight', 'Diagnosis', 'Weight', 'Height'],
+            'obs_value_coded': [None, 'Malaria', None, None],
+            'Date': [pd.Timestamp('2025-01-01').date()] * 4,
+        }).to_parquet(storage.filepath)
+
+        storage.save_dcc_dropdown_json()
+        catalog = DataStorage.load_catalog(storage.dropdown_filepath)
+
+        assert catalog['programs'] == ['ANC', 'OPD']
+        assert catalog['encounters'] == ['DIAGNOSIS', 'VITALS']
+        assert catalog['counts']['encounters'] == {'DIAGNOSIS': 1, 'VITALS': 3}
+        assert catalog['counts']['concepts'] == {'Diagnosis': 1, 'Height': 1, 'Weight': 2}
+        assert catalog['program_concepts'] == {'ANC': ['Weight'], 'OPD': ['Diagnosis', 'Weight']}
+        assert catalog['coded_values'] == {'Diagnosis': ['Malaria']}
+        assert DataStorage.load_catalog(storage.dropdown_filepath) is catalog
+
+
+class TestUserDirectory:
+    """Test cases for the uuid -> roles directory the pages authorize with"""
+
+    def test_roles_indexed_and_reloaded_on_change(self, storage):
+        """Roles are grouped per uuid, parquet wins over csv and the directory is only rebuilt for a new file"""
+        pd.DataFrame({'user_id': ['u1', 'u1', 'u2'],
+                      'role': ['Clinician', 'Superuser,Superuser', 'Lab']}).to_parquet(
+            os.path.join(storage.data_dir, 'users_data.parquet'))
+        pd.DataFrame({'user_id': ['u3'], 'role': ['Clinician']}).to_csv(
+            os.path.join(storage.data_dir, 'users_data.csv'), index=False)
+
+        directory = DataStorage.user_directory(storage.data_dir)
+        assert DataStorage.user_roles('u1', storage.data_dir) == ('Clinician', 'Superuser,Superuser')
+        assert DataStorage.user_roles('u3', storage.data_dir) == ()
+        assert DataStorage.user_roles('m3his@dhd', storage.data_dir) == ('reports_admin',)
+        assert DataStorage.user_directory(storage.data_dir) is directory
+
+        os.remove(os.path.join(storage.data_dir, 'users_data.parquet'))
+        assert DataStorage.user_roles('u3', storage.data_dir) == ('Clinician',)
+
+
+class TestMultiSource:
+    """Test cases for refreshing several source databases into one dataset"""
+
+    def test_sources_refresh_into_own_stores_read_as_one(self, storage, tmp_path, monkeypatch):
+        """Each source gets its own store and recovery state; pages read them stacked, tagged by source"""
+        today = pd.Timestamp.now().normalize()
+        start = (today - pd.Timedelta(days=2)).date().isoformat()
+        monkeypatch.setattr(db_services, "START_DATE", start)
+        # leave the repository's data/TimeStamp.csv alone
+        monkeypatch.setattr(DataFetcher, "_write_timestamp", lambda self: None)
+        sources = []
+        for number, (name, rows) in enumerate((('north', 300), ('south', 200))):
+            db_path = str(tmp_path / f"{name}.sqlite")
+            seed(db_path, rows, start, today.date().isoformat(), seed=number)
+            sources.append({'name': name, 'connection_factory': functools.partial(connect, db_path)})
+        monkeypatch.setattr(data_storage, 'DATA_SOURCES', sources)
+
+        assert storage.fetch_and_save()
+
+        for name in ('north', 'south'):
+            state_dir = os.path.dirname(DataStorage.source_filepath(storage.filepath, name))
+            assert DataFetcher.run_reports(os.path.join(state_dir, "run_reports.jsonl"))[-1]['status'] == 'ok'
+        counts = DataStorage.query_duckdb(
+            f"SELECT {data_storage.SOURCE_COLUMN} AS source, count(*) AS n "
+            f"FROM {DataStorage.parquet_source(storage.filepath)} GROUP BY ALL ORDER BY source", cache=False)
+        assert dict(zip(counts['source'], counts['n'])) == {'north': 300, 'south': 200}
+
+        sources[1]['connection_factory'] = functools.partial(connect, str(tmp_path / "missing" / "south.sqlite"))
+        with pytest.raises(RuntimeError, match="south"):
+            storage.fetch_and_save()
+        assert DataStorage.data_exists(storage.filepath)
+
+    def test_misconfigured_sources_rejected_before_fetching(self, storage, monkeypatch):
+        """A source without a route fails the refresh up front with the entries named, nothing is fetched"""
+        fetched = []
+        monkeypatch.setattr(DataStorage, '_fetch_into', lambda self, fetcher, filepath: fetched.append(filepath))
+        monkeypatch.setattr(data_storage, 'DATA_SOURCES', [
+            {'name': 'north', 'connection_factory': lambda: None},
+            {'name': 'south', 'db_config': {'host': 'localhost'}},
+            {'name': 'east', 'db_config': {'host': 'localhost'}, 'ssh_config': {'ssh_host': 'h', 'ssh_user': 'u'}},
+        ])
+
+        with pytest.raises(ValueError, match=r"south has no ssh_config .*east has no ssh_config\['remote_bind_address'\]"):
+            storage.fetch_and_save()
+        assert fetched == []
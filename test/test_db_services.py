@@ -0,0 +1,735 @@
+# test_db_services.py
+import pytest
+import pandas as pd
+import re
+import datetime
+import functools
+import decimal
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import pyarrow.parquet as pq
+import duckdb
+from pymysql.constants import FIELD_TYPE
+
+import db_services
+from db_services import DataFetcher
+from benchmarks.openmrs_standin import connect, seed
+from config import QERY
+
+QUERY_TEMPLATE = "SELECT * FROM obs_view WHERE 1=1 {date_filter}"
+
+DESCRIPTION = [
+    ('person_id', FIELD_TYPE.LONG),
+    ('encounter_id', FIELD_TYPE.LONG),
+    ('Age', FIELD_TYPE.NEWDECIMAL),
+    ('Date', FIELD_TYPE.DATE),
+    ('concept_name', FIELD_TYPE.VAR_STRING),
+    ('ValueN', FIELD_TYPE.DOUBLE),
+    ('Facility_CODE', FIELD_TYPE.LONG),
+]
+
+
+def make_rows(day, count, start_encounter=1):
+    return [
+        (i, start_encounter + i, decimal.Decimal(20 + i % 50), day, f"concept {i % 7}",
+         None if i % 3 else float(i), 10 + i % 2)
+        for i in range(count)
+    ]
+
+
+class FakeCursor:
+    """Minimal DB-API cursor returning the rows registered for the queried day"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = [(name, type_code, None, None, None, None, True)
+                            for name, type_code in DESCRIPTION]
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query):
+        self.connection.queries.append(query)
+        day = re.search(r"= '(\d{4}-\d{2}-\d{2})'", query).group(1)
+        self._rows = list(self.connection.rows_by_day.get(day, []))
+
+    def fetchmany(self, size):
+        self.connection.fetch_sizes.append(size)
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+
+class FakeConnection:
+    def __init__(self, rows_by_day):
+        self.rows_by_day = rows_by_day
+        self.queries = []
+        self.fetch_sizes = []
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fetcher(tmp_path, monkeypatch):
+    instance = DataFetcher(use_localhost=True, streaming=True, arrow_batch_rows=4,
+                           batch_retry_delay=0, state_dir=str(tmp_path / "data"))
+    instance.path = str(tmp_path)
+    return instance
+
+
+class TestStreamingExtraction:
+    """Test cases for the streaming (server-side cursor -> Arrow) extraction mode"""
+
+    def test_stream_single_day_writes_fixed_size_batches(self, fetcher):
+        """A day is written in arrow_batch_rows sized batches and validated from the footer"""
+        day = datetime.date(2025, 1, 2)
+        conn = FakeConnection({'2025-01-02': make_rows(day, 10)})
+
+        rows = fetcher._stream_single_day(conn, QUERY_TEMPLATE, pd.Timestamp(day))
+
+        assert rows == 10
+        assert set(conn.fetch_sizes) == {4}
+        batch = pq.read_table(fetcher._batch_file_path(pd.Timestamp(day)))
+        assert batch.num_rows == 10
+        assert str(batch.schema.field('Age').type) == 'int32'
+        assert str(batch.schema.field('Date').type) == 'date32[day]'
+
+    def test_stream_single_day_empty_day(self, fetcher):
+        """An empty day writes no batch file"""
+        day = pd.Timestamp('2025-01-03')
+        rows = fetcher._stream_single_day(FakeConnection({}), QUERY_TEMPLATE, day)
+
+        assert rows == 0
+        assert not os.path.exists(fetcher._batch_file_path(day))
+
+    def test_streamed_days_replace_existing_rows(self, fetcher):
+        """Re-extracted days replace their rows in the main parquet instead of duplicating them"""
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        old_day = datetime.date(2025, 1, 1)
+        kept = pd.DataFrame(make_rows(old_day, 3), columns=[c for c, _ in DESCRIPTION])
+        kept['Age'] = kept['Age'].astype(float)
+        stale = kept.assign(Date=datetime.date(2025, 1, 2))
+        pd.concat([kept, stale]).to_parquet(main_file, index=False)
+
+        conn = FakeConnection({'2025-01-02': make_rows(datetime.date(2025, 1, 2), 5)})
+        fetcher._stream_daily_batches(conn, QUERY_TEMPLATE, main_file, 'Date', '2025-01-02')
+
+        result = pd.read_parquet(main_file)
+        counts = pd.to_datetime(result['Date']).dt.date.value_counts()
+        assert counts[old_day] == 3
+        assert counts[datetime.date(2025, 1, 2)] == 5
+        assert not os.path.exists(fetcher.checkpoint_file)
+
+
+class TestParallelBackfill:
+    """Test cases for the parallel multi-day backfill mode"""
+
+    def test_day_ranges_skip_completed_days(self, fetcher):
+        """Days are split into contiguous ranges and completed days are not re-extracted"""
+        fetcher.days_per_task = 3
+        start = datetime.date.today() - datetime.timedelta(days=6)
+        skip = [(start + datetime.timedelta(days=1)).strftime('%Y-%m-%d')]
+
+        ranges = fetcher._day_ranges(start, skip_days=skip)
+
+        assert [len(r) for r in ranges] == [3, 3]
+        assert skip[0] not in [d.strftime('%Y-%m-%d') for r in ranges for d in r]
+
+    def test_parallel_backfill_uses_bounded_connections(self, fetcher, monkeypatch):
+        """Workers share at most parallel_workers connections and produce the same main parquet"""
+        fetcher.parallel_workers = 2
+        fetcher.days_per_task = 2
+        start = datetime.date.today() - datetime.timedelta(days=7)
+        rows_by_day = {
+            (start + datetime.timedelta(days=i)).strftime('%Y-%m-%d'):
+                make_rows(start + datetime.timedelta(days=i), i + 1, start_encounter=100 * i)
+            for i in range(8)
+        }
+        opened = []
+
+        def fake_connection(tunnel=None):
+            conn = FakeConnection(rows_by_day)
+            opened.append(conn)
+            return conn
+
+        monkeypatch.setattr(fetcher, '_get_db_connection', fake_connection)
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+
+        fetcher._parallel_daily_batches(None, QUERY_TEMPLATE, main_file, 'Date', 5000, start)
+
+        assert 1 <= len(opened) <= 2
+        assert sum(len(c.queries) for c in opened) == 8
+        assert len(pd.read_parquet(main_file)) == sum(range(1, 9))
+        assert not os.listdir(os.path.join(fetcher.path, "data", "batches"))
+
+    def test_failed_day_keeps_stored_rows(self, fetcher, monkeypatch):
+        """A day whose SQL fails is neither replaced nor checkpointed; its stored rows survive the merge"""
+        fetcher.streaming = False
+        fetcher.parallel_workers = 2
+        day = datetime.date.today() - datetime.timedelta(days=1)
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        stored = pd.DataFrame(make_rows(day, 3), columns=[c for c, _ in DESCRIPTION])
+        stored['Age'] = stored['Age'].astype(float)
+        stored.to_parquet(main_file, index=False)
+        saved = []
+        monkeypatch.setattr(fetcher, '_get_db_connection', lambda tunnel=None: FakeConnection({}))
+        monkeypatch.setattr(fetcher, '_save_checkpoint', lambda manifest: saved.append(dict(manifest['days'])))
+
+        def read_sql(query, conn):
+            if day.isoformat() in query:
+                raise RuntimeError("connection reset")
+            return pd.DataFrame(columns=[c for c, _ in DESCRIPTION])
+        monkeypatch.setattr(db_services.pd, 'read_sql', read_sql)
+
+        fetcher._parallel_daily_batches(None, QUERY_TEMPLATE, main_file, 'Date', 5000, day)
+
+        assert len(pd.read_parquet(main_file)) == 3
+        assert all(day.isoformat() not in days for days in saved)
+
+    def test_stale_batch_of_failed_day_is_not_merged(self, fetcher, monkeypatch):
+        """A batch an earlier run left for a day whose re-extraction now fails is not appended to its stored rows"""
+        fetcher.streaming = False
+        fetcher.parallel_workers = 1
+        day = datetime.date.today() - datetime.timedelta(days=1)
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        stored = pd.DataFrame(make_rows(day, 3), columns=[c for c, _ in DESCRIPTION])
+        stored['Age'] = stored['Age'].astype(float)
+        stored.to_parquet(main_file, index=False)
+        fetcher._save_daily_batch(stored, pd.Timestamp(day))
+        monkeypatch.setattr(fetcher, '_get_db_connection', lambda tunnel=None: FakeConnection({}))
+
+        def read_sql(query, conn):
+            if day.isoformat() in query:
+                raise RuntimeError("connection reset")
+            return pd.DataFrame(columns=[c for c, _ in DESCRIPTION])
+        monkeypatch.setattr(db_services.pd, 'read_sql', read_sql)
+
+        # today extracts (empty), so the merge runs with the failed day's old batch still on disk
+        fetcher._parallel_daily_batches(None, QUERY_TEMPLATE, main_file, 'Date', 5000, day)
+
+        assert len(pd.read_parquet(main_file)) == 3
+
+
+class TestPartitionedStore:
+    """Test cases for the hive-partitioned (year_month/Facility_CODE) store"""
+
+    def test_refresh_rewrites_only_touched_partitions(self, fetcher):
+        """A refresh replaces the re-extracted day and leaves other partitions untouched"""
+        fetcher.partitioned = True
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        dataset = fetcher.dataset_dir(main_file)
+        january = datetime.date(2025, 1, 15)
+        february = datetime.date(2025, 2, 1)
+
+        fetcher._save_daily_batch(pd.DataFrame(make_rows(january, 6), columns=[c for c, _ in DESCRIPTION]),
+                                  pd.Timestamp(january))
+        fetcher._save_daily_batch(pd.DataFrame(make_rows(february, 4), columns=[c for c, _ in DESCRIPTION]),
+                                  pd.Timestamp(february))
+        fetcher._merge_batches_into_main(main_file, 'Date', ['2025-01-15', '2025-02-01'])
+        fetcher._cleanup_batches()
+
+        untouched = fetcher._parquet_files(fetcher._partition_dir(dataset, '2025-01', '10'))[0]
+        untouched_mtime = os.stat(untouched).st_mtime_ns
+
+        # February is re-extracted with fewer rows and only facility 10
+        fetcher._save_daily_batch(pd.DataFrame(make_rows(february, 1), columns=[c for c, _ in DESCRIPTION]),
+                                  pd.Timestamp(february))
+        fetcher._merge_batches_into_main(main_file, 'Date', ['2025-02-01'])
+
+        assert os.stat(untouched).st_mtime_ns == untouched_mtime
+        assert not os.path.exists(fetcher._partition_dir(dataset, '2025-02', '11'))
+        result = fetcher._read_dataset_column(dataset, 'Date')
+        counts = pd.to_datetime(result['Date']).dt.date.value_counts()
+        assert counts[january] == 6
+        assert counts[february] == 1
+        assert fetcher._get_last_extraction_date(dataset, 'Date') == '2025-02-01'
+
+
+
+    @pytest.mark.parametrize("partitioned", [False, True])
+    def test_rows_without_date_survive_merge(self, fetcher, partitioned):
+        """Stored rows with a NULL date are kept when other days are replaced"""
+        fetcher.partitioned = partitioned
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        february = datetime.date(2025, 2, 1)
+        columns = [c for c, _ in DESCRIPTION]
+        rows = pd.DataFrame(make_rows(february, 4), columns=columns)
+        rows['Age'] = rows['Age'].astype(float)
+        rows.loc[0, 'Date'] = None
+        if partitioned:
+            fetcher._save_daily_batch(rows, pd.Timestamp(february))
+            fetcher._merge_batches_into_main(main_file, 'Date', ['2025-02-01'])
+            fetcher._cleanup_batches()
+        else:
+            rows.to_parquet(main_file, index=False)
+
+        fetcher._save_daily_batch(pd.DataFrame(make_rows(february, 2), columns=columns), pd.Timestamp(february))
+        fetcher._merge_batches_into_main(main_file, 'Date', ['2025-02-01'])
+
+        result = (fetcher._read_dataset_column(fetcher.dataset_dir(main_file), 'Date') if partitioned
+                  else pd.read_parquet(main_file))
+        assert result['Date'].isna().sum() == 1
+        assert result['Date'].notna().sum() == 2
+
+
+class TestConnectionFactory:
+    """Test cases for fetch_data over a pluggable connection (the SQLite OpenMRS stand-in)"""
+
+    def test_fetch_data_from_standin(self, fetcher, tmp_path, monkeypatch):
+        """QERY runs unchanged against the stand-in and every obs row reaches the store"""
+        start = (pd.Timestamp.now().normalize() - pd.Timedelta(days=3)).date().isoformat()
+        monkeypatch.setattr(db_services, "START_DATE", start)
+        db_path = str(tmp_path / "standin.sqlite")
+        seed(db_path, 400, start, pd.Timestamp.now().date().isoformat())
+        fetcher.connection_factory = functools.partial(connect, db_path)
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+
+        fetcher.fetch_data(QERY, filename=main_file, date_column='Date')
+
+        result = pd.read_parquet(main_file)
+        assert len(result) == 400
+        assert result['obs_id'].is_unique
+        assert str(pq.read_schema(main_file).field('Date').type) == 'date32[day]'
+
+        report = DataFetcher.run_reports(fetcher.run_report_file)[-1]
+        assert report['status'] == 'ok'
+        assert report['totals']['rows'] == 400
+        assert sum(day['rows'] for day in report['days'].values()) == 400
+        assert all(day['bytes'] > 0 for day in report['days'].values() if day['rows'])
+        assert 'merge' in report['phases']
+
+
+class TestCompaction:
+    """Test cases for appending refreshes and the compaction of the files they leave"""
+
+    def test_new_days_append_files_then_compact(self, fetcher):
+        """Days new to a partition are appended as files; compact() merges them without losing rows"""
+        fetcher.partitioned = True
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        dataset = fetcher.dataset_dir(main_file)
+        partition = fetcher._partition_dir(dataset, '2025-01', '10')
+        columns = [c for c, _ in DESCRIPTION]
+
+        for day in (datetime.date(2025, 1, 1), datetime.date(2025, 1, 2), datetime.date(2025, 1, 3)):
+            fetcher._save_daily_batch(pd.DataFrame(make_rows(day, 4), columns=columns), pd.Timestamp(day))
+            fetcher._merge_batches_into_main(main_file, 'Date', [day.isoformat()])
+            fetcher._cleanup_batches()
+        first_file = fetcher._parquet_files(partition)[0]
+        assert len(fetcher._parquet_files(partition)) == 3
+
+        with fetcher.store_lock(main_file) as acquired:
+            assert acquired
+            with fetcher.store_lock(main_file, blocking=False) as second:
+                assert not second
+            metrics = fetcher.compact(main_file, min_files=2)
+
+        assert fetcher._parquet_files(partition) == [os.path.join(partition, "part-0.parquet")]
+        assert not os.path.exists(first_file)
+        assert metrics['partitions_compacted'] == 2
+        assert metrics['files_merged'] == 4
+        result = fetcher._read_dataset_column(dataset, 'Date')
+        assert len(result) == 12
+        assert fetcher.compact(main_file, min_files=2)['partitions_compacted'] == 0
+
+def make_obs_frame(obs_ids, day, voided=0, value=1.0):
+    return pd.DataFrame({
+        'obs_id': obs_ids,
+        'encounter_id': [obs_id // 2 for obs_id in obs_ids],
+        'Date': [day] * len(obs_ids),
+        'Facility_CODE': [10] * len(obs_ids),
+        'ValueN': [value] * len(obs_ids),
+        'obs_voided': [voided] * len(obs_ids),
+        'obs_date_created': [pd.Timestamp(day)] * len(obs_ids),
+    })
+
+
+class TestChangeDataCapture:
+    """Test cases for the watermark-based change data capture mode"""
+
+    def test_cdc_filter_uses_watermarks(self, fetcher):
+        """Id marks advance strictly, timestamp marks re-read the lookback window"""
+        fetcher.cdc_lookback_minutes = 10
+        predicate = fetcher._cdc_filter({'obs_id': 42, 'obs_date_created': '2025-01-02 10:00:00'})
+
+        assert "o.obs_id > 42" in predicate
+        assert "o.date_created >= '2025-01-02 09:50:00'" in predicate
+        assert " OR " in predicate
+
+    @pytest.mark.parametrize("partitioned", [False, True])
+    def test_apply_changes_upserts_and_deletes(self, fetcher, partitioned):
+        """Changed obs are replaced, voided obs removed, new obs appended"""
+        fetcher.partitioned = partitioned
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        day = datetime.date(2025, 1, 2)
+        make_obs_frame([1, 2, 3, 4], day).to_parquet(main_file, index=False)
+        if partitioned:
+            fetcher._migrate_to_partitions(main_file, fetcher.dataset_dir(main_file), 'Date')
+
+        delta_file = os.path.join(fetcher.path, "data", "batches", "cdc_test.parquet")
+        pd.concat([
+            make_obs_frame([2], day, value=5.0),
+            make_obs_frame([3], day, voided=1),
+            make_obs_frame([10], datetime.date(2025, 2, 1)),
+        ]).to_parquet(delta_file, index=False)
+
+        fetcher._apply_changes(main_file, 'Date', [delta_file])
+
+        if partitioned:
+            dataset_glob = os.path.join(fetcher.dataset_dir(main_file), '*', '*', '*.parquet')
+            result = duckdb.query(f"SELECT obs_id, ValueN FROM read_parquet('{dataset_glob}')").df()
+        else:
+            result = pd.read_parquet(main_file)
+        assert sorted(result['obs_id']) == [1, 2, 4, 10]
+        assert result.loc[result['obs_id'] == 2, 'ValueN'].tolist() == [5.0]
+        marks = fetcher._store_watermarks(fetcher._store_path(main_file))
+        assert marks['obs_id'] == 10
+
+    def test_cdc_baseline_on_legacy_path_finalizes(self, fetcher, tmp_path, monkeypatch):
+        """The in-memory baseline clears its checkpoint and writes the timestamp and the watermarks"""
+        start = (pd.Timestamp.now().normalize() - pd.Timedelta(days=2)).date().isoformat()
+        monkeypatch.setattr(db_services, "START_DATE", start)
+        db_path = str(tmp_path / "standin.sqlite")
+        seed(db_path, 100, start, pd.Timestamp.now().date().isoformat())
+        fetcher.connection_factory = functools.partial(connect, db_path)
+        fetcher.streaming = False
+        fetcher.cdc = True
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+
+        fetcher.fetch_data(QERY, filename=main_file, date_column='Date')
+
+        assert len(pd.read_parquet(main_file)) == 100
+        assert not os.path.exists(fetcher.checkpoint_file)
+        assert os.path.exists(os.path.join(fetcher.path, "data", "TimeStamp.csv"))
+        assert fetcher._load_cdc_state() is not None
+
+
+class TestKeyedMerge:
+    """Test cases for the row_key upsert/dedup engine"""
+
+    def test_row_key_ignores_int_float_representation(self, fetcher):
+        """The same row read back with float ids (NULLs present) keeps its key"""
+        as_int = pd.DataFrame({'encounter_id': [1, 2], 'concept_name': ['a', 'b'], 'ValueN': [1.0, None]})
+        as_float = as_int.astype({'encounter_id': 'float64'})
+
+        assert (fetcher._row_keys(as_int) == fetcher._row_keys(as_float)).all()
+
+    def test_keys_survive_concat_with_unkeyed_frame(self, fetcher):
+        """A key column turned float64 by a concat is recomputed exactly, not cast back from rounded floats"""
+        keyed = fetcher._with_row_key(pd.DataFrame({'encounter_id': range(50), 'concept_name': 'a'}))
+        unkeyed = pd.DataFrame({'encounter_id': [50], 'concept_name': ['a']})
+        mixed = pd.concat([keyed, unkeyed], ignore_index=True)
+        assert mixed['row_key'].dtype == 'float64'
+
+        result = fetcher._with_row_key(mixed)
+
+        assert result['row_key'].dtype == 'uint64'
+        assert (result['row_key'].to_numpy()[:50] == keyed['row_key'].to_numpy()).all()
+        assert result['row_key'].is_unique
+
+    def test_keyed_merge_upserts_delta(self, fetcher):
+        """Rows with an existing key are replaced once, new keys appended"""
+        existing = pd.DataFrame({'encounter_id': [1, 2, 3], 'concept_name': ['a', 'b', 'c'],
+                                 'Facility': ['x', 'x', 'x']})
+        incoming = pd.DataFrame({'encounter_id': [3, 3, 4], 'concept_name': ['c', 'c', 'd'],
+                                 'Facility': ['y', 'y', 'y']})
+
+        merged = fetcher._keyed_merge(existing, incoming)
+
+        assert sorted(merged['encounter_id']) == [1, 2, 3, 4]
+        assert merged.loc[merged['encounter_id'] == 3, 'Facility'].tolist() == ['y']
+        assert merged['row_key'].is_unique
+
+    def test_merge_existing_file_reads_keys_only_when_covered(self, fetcher, monkeypatch):
+        """When the frame already holds every stored row the file itself is not re-read"""
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        stored = fetcher._with_row_key(pd.DataFrame({'encounter_id': [1, 2], 'concept_name': ['a', 'b']}))
+        stored.to_parquet(main_file, index=False)
+        monkeypatch.setattr(fetcher, 'safe_read_parquet', lambda path: pytest.fail("full read"))
+
+        merged = fetcher._merge_existing_file(main_file, pd.concat([stored, stored.head(1)]))
+
+        assert len(merged) == 2
+
+
+class TestStorageSchema:
+    """Test cases for the DATA_SCHEMA types applied on write"""
+
+    def test_write_parquet_applies_declared_types(self, fetcher, tmp_path):
+        """Ids are narrowed, low-cardinality text is dictionary-encoded and read back as category"""
+        path = str(tmp_path / "typed.parquet")
+        df = pd.DataFrame({'encounter_id': [1.0, 2.0, None], 'Age': [30.0, 41.0, 5.0],
+                           'Gender': ['M', 'F', 'M'], 'Value': ['a', 'b', 'c']})
+
+        fetcher.write_parquet(df, path)
+
+        schema = pq.read_schema(path)
+        assert str(schema.field('encounter_id').type) == 'int64'
+        assert str(schema.field('Age').type) == 'int32'
+        assert str(schema.field('Gender').type) == 'dictionary<values=string, indices=int32, ordered=0>'
+        assert 'dictionary' not in str(schema.field('Value').type)
+        assert pd.read_parquet(path)['Gender'].dtype == 'category'
+
+    def test_duckdb_merge_keeps_declared_types(self, fetcher, tmp_path):
+        """Rows rewritten through DuckDB come out with the declared column types"""
+        main_file = str(tmp_path / "main.parquet")
+        pd.DataFrame({'encounter_id': [1.0], 'Age': [20.5], 'Date': [datetime.date(2025, 1, 1)],
+                      'concept_name': ['x']}).to_parquet(main_file, index=False)
+
+        fetcher._merge_batches_into_main(main_file, 'Date', ['2025-02-01'])
+
+        schema = pq.read_schema(main_file)
+        assert str(schema.field('encounter_id').type) == 'int64'
+        assert str(schema.field('Age').type) == 'int32'
+        assert str(schema.field('Date').type) == 'date32[day]'
+
+    def test_duckdb_merge_keeps_column_that_cannot_be_cast(self, fetcher, tmp_path):
+        """A column with values the declared type cannot hold keeps its type and values, as on the pandas path"""
+        main_file = str(tmp_path / "main.parquet")
+        pd.DataFrame({'encounter_id': [1.0, 2.0], 'Age': ['20', 'unknown'],
+                      'Date': [datetime.date(2025, 1, 1)] * 2}).to_parquet(main_file, index=False)
+
+        fetcher._merge_batches_into_main(main_file, 'Date', ['2025-02-01'])
+
+        schema = pq.read_schema(main_file)
+        assert str(schema.field('encounter_id').type) == 'int64'
+        assert str(schema.field('Age').type) == 'string'
+        assert sorted(pd.read_parquet(main_file)['Age']) == ['20', 'unknown']
+
+
+class TestSortedLayout:
+    """Test cases for the sorted, zstd-compressed storage layout"""
+
+    def test_merge_writes_sorted_zstd_row_groups(self, fetcher, tmp_path):
+        """Merged rows are ordered by facility/date/encounter and zstd-compressed"""
+        fetcher.sorted_layout = True
+        main_file = str(tmp_path / "main.parquet")
+        pd.DataFrame({'encounter_id': [5, 1, 4, 2, 3, 6],
+                      'Date': [datetime.date(2025, 1, d) for d in (2, 1, 1, 2, 1, 1)],
+                      'Facility_CODE': [2, 1, 2, 1, 1, 2]}).to_parquet(main_file, index=False)
+
+        fetcher._merge_batches_into_main(main_file, 'Date', ['2025-02-01'])
+
+        result = pd.read_parquet(main_file)
+        assert result['encounter_id'].tolist() == [1, 3, 2, 4, 6, 5]
+        assert pq.ParquetFile(main_file).metadata.row_group(0).column(0).compression == 'ZSTD'
+
+
+class TestCheckpointManifest:
+    """Test cases for the JSON checkpoint manifest used to resume interrupted runs"""
+
+    def test_entry_records_checksum_and_last_encounter(self, fetcher):
+        """A checkpointed day carries its batch checksum and last encounter_id, never the rows"""
+        day = pd.Timestamp('2025-01-03')
+        fetcher._stream_single_day(FakeConnection({'2025-01-03': make_rows(day.date(), 6, 40)}),
+                                   QUERY_TEMPLATE, day)
+
+        entry = fetcher._checkpoint_entry(day, 6)
+
+        assert entry['batch'] == '2025-01-03.parquet'
+        assert entry['last_encounter_id'] == 45
+        assert entry['sha256'] == fetcher._file_checksum(fetcher._batch_file_path(day))
+
+    def test_resume_skips_verified_days_only(self, fetcher):
+        """Verified days are not re-queried; a day whose batch no longer matches is re-extracted"""
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        start = datetime.date.today() - datetime.timedelta(days=2)
+        days = [start + datetime.timedelta(days=i) for i in range(3)]
+        rows_by_day = {d.strftime('%Y-%m-%d'): make_rows(d, 3, 10 * i) for i, d in enumerate(days)}
+        manifest = fetcher._load_checkpoint(main_file)
+        for d in days[:2]:
+            fetcher._stream_single_day(FakeConnection(rows_by_day), QUERY_TEMPLATE, pd.Timestamp(d))
+            manifest['days'][d.strftime('%Y-%m-%d')] = fetcher._checkpoint_entry(pd.Timestamp(d), 3)
+        fetcher._save_checkpoint(manifest)
+        with open(fetcher._batch_file_path(pd.Timestamp(days[1])), 'ab') as f:
+            f.write(b'x')
+
+        conn = FakeConnection(rows_by_day)
+        fetcher._stream_daily_batches(conn, QUERY_TEMPLATE, main_file, 'Date', start)
+
+        queried = [re.search(r"= '(\d{4}-\d{2}-\d{2})'", q).group(1) for q in conn.queries]
+        assert queried == [days[1].strftime('%Y-%m-%d'), days[2].strftime('%Y-%m-%d')]
+        assert len(pd.read_parquet(main_file)) == 9
+        assert not os.path.exists(fetcher.checkpoint_file)
+
+    def test_batches_kept_until_final_save(self, fetcher, monkeypatch):
+        """On the in-memory path every checkpointed day keeps its batch file until the final save"""
+        fetcher.streaming = False
+        main_file = os.path.join(fetcher.path, "data", "main.parquet")
+        start = datetime.date.today() - datetime.timedelta(days=1)
+        days = [start, datetime.date.today()]
+
+        def read_sql(query, conn):
+            day = datetime.date.fromisoformat(re.search(r"= '(\d{4}-\d{2}-\d{2})'", query).group(1))
+            rows = make_rows(day, 2, 10 * days.index(day)) if "encounter_id > 0 " in query else []
+            return pd.DataFrame(rows, columns=[c for c, _ in DESCRIPTION])
+        monkeypatch.setattr(db_services.pd, 'read_sql', read_sql)
+
+        final_df = fetcher._process_daily_batches(None, QUERY_TEMPLATE, main_file, 'Date', 5000, start)
+
+        # a crash here leaves every checkpointed day replayable from its batch
+        manifest = fetcher._load_checkpoint(main_file)
+        assert sorted(manifest['days']) == [d.isoformat() for d in days]
+        assert all(os.path.exists(fetcher._batch_file_path(pd.Timestamp(d))) for d in days)
+
+        fetcher._finalize_operation(final_df, main_file)
+
+        assert not os.listdir(os.path.join(fetcher.state_dir, "batches"))
+        assert not os.path.exists(fetcher.checkpoint_file)
+        assert len(pd.read_parquet(main_file)) == 4
+
+    def test_manifest_of_other_file_is_ignored(self, fetcher):
+        """A manifest written for another main file never skips days"""
+        manifest = fetcher._load_checkpoint("other.parquet")
+        manifest['days']['2025-01-01'] = {'status': 'extracted', 'rows': 0, 'batch': None}
+        fetcher._save_checkpoint(manifest)
+
+        assert fetcher._load_checkpoint("main.parquet")['days'] == {}
+
+
+class TestStarSchema:
+    """Test cases for the star-schema serving tables and their view"""
+
+    def test_view_returns_the_store_columns(self, fetcher, tmp_path):
+        """Fact + dimensions joined by star_view give back the stored rows and column order"""
+        main_file = str(tmp_path / "main.parquet")
+        wide = pd.DataFrame({
+            'person_id': [1, 1, 2, 3], 'encounter_id': [10, 10, 11, 12],
+            'given_name': ['Ann', 'Ann', 'Bo', None], 'Gender': ['F', 'F', 'M', 'M'],
+            'Date': [datetime.date(2025, 1, d) for d in (1, 1, 2, 3)],
+            'Facility': ['North', 'North', 'South', 'North'], 'Facility_CODE': [7, 7, 8, 7],
+            'concept_name': ['Weight', 'Diagnosis', 'Weight', None],
+            'obs_value_coded': [None, 'Malaria', None, None], 'ValueN': [60.0, None, 72.5, None],
+        })
+        wide.to_parquet(main_file, index=False)
+
+        star_dir = fetcher.publish_star_schema(main_file)
+
+        fact_columns = pq.read_schema(os.path.join(star_dir, 'fact.parquet')).names
+        assert 'given_name' not in fact_columns and 'concept_name_key' in fact_columns
+        view = duckdb.query(f"SELECT * FROM {DataFetcher.star_view(star_dir)} "
+                            f"ORDER BY encounter_id, concept_name").df()
+        expected = wide.sort_values(['encounter_id', 'concept_name']).reset_index(drop=True)
+        assert view.columns.tolist() == wide.columns.tolist()
+        assert view['given_name'].tolist() == expected['given_name'].tolist()
+        assert view['obs_value_coded'].tolist() == expected['obs_value_coded'].tolist()
+        assert view['Facility'].tolist() == expected['Facility'].tolist()
+        facility = duckdb.query(f"SELECT count(*) FROM {DataFetcher.star_view(star_dir)} "
+                                f"WHERE Facility_CODE = 7").fetchone()[0]
+        assert facility == 3
+
+    def test_attributes_that_vary_stay_on_the_fact_table(self, fetcher, tmp_path):
+        """History keeps its own values; a republish swaps CURRENT and keeps the previous version"""
+        main_file = str(tmp_path / "main.parquet")
+        wide = pd.DataFrame({
+            'person_id': [1, 1, 2], 'encounter_id': [10, 11, 12],
+            'given_name': ['Ann', 'Ann', 'Bo'], 'family_name': ['Lee', 'Moyo', 'Phiri'],
+            'District': ['Zomba', 'Blantyre', 'Zomba'], 'Facility': ['North', 'North', 'South'],
+            'Facility_CODE': [7, 7, 8], 'Date': [datetime.date(2025, 1, d) for d in (1, 2, 3)],
+        })
+        wide.to_parquet(main_file, index=False)
+
+        first = fetcher.publish_star_schema(main_file)
+        second = fetcher.publish_star_schema(main_file)
+
+        fact_columns = pq.read_schema(os.path.join(second, 'fact.parquet')).names
+        assert {'family_name', 'District'} <= set(fact_columns)
+        assert 'given_name' not in fact_columns and 'Facility' not in fact_columns
+        view = duckdb.query(f"SELECT * FROM {DataFetcher.star_view(DataFetcher.star_dir(main_file))} "
+                            f"ORDER BY encounter_id").df()
+        assert view['family_name'].tolist() == ['Lee', 'Moyo', 'Phiri']
+        assert view['District'].tolist() == ['Zomba', 'Blantyre', 'Zomba']
+        with open(os.path.join(DataFetcher.star_dir(main_file), 'CURRENT')) as f:
+            assert f.read() == os.path.basename(second)
+        assert os.path.isdir(first)
+
+
+class TestVisitTracking:
+    """Test cases for the locally maintained per-person visit tables"""
+
+    @staticmethod
+    def visits(fetcher, main_file):
+        path = os.path.join(fetcher.visits_dir(main_file), 'person_visits.parquet')
+        return pd.read_parquet(path).set_index('person_id').sort_index()
+
+    def test_incremental_refresh_matches_full_rebuild(self, fetcher, tmp_path):
+        """Re-aggregating only the persons seen since a date gives the same table as a rebuild"""
+        main_file = str(tmp_path / "main.parquet")
+        day = lambda d: datetime.date(2025, 1, d)
+        pd.DataFrame({'person_id': [1, 1, 1, 2, 3], 'encounter_id': [1, 1, 2, 3, 4],
+                      'Date': [day(1), day(1), day(3), day(3), day(2)]}).to_parquet(main_file, index=False)
+        fetcher.refresh_visits(main_file)
+        assert self.visits(fetcher, main_file)['visit_days'].tolist() == [2, 1, 1]
+
+        # day 3 re-extracted: person 2's visit was voided, person 3 came back, person 4 is new
+        pd.DataFrame({'person_id': [1, 1, 3, 1, 3, 4], 'encounter_id': [1, 1, 4, 5, 6, 7],
+                      'Date': [day(1), day(1), day(2), day(3), day(3), day(4)]}).to_parquet(main_file, index=False)
+        fetcher.refresh_visits(main_file, since='2025-01-03')
+        incremental = self.visits(fetcher, main_file)
+        fetcher.refresh_visits(main_file)
+
+        pd.testing.assert_frame_equal(incremental, self.visits(fetcher, main_file))
+        assert incremental['visit_days'].to_dict() == {1: 2, 3: 2, 4: 1}
+        assert incremental.loc[4, 'new_revisit'] == 'New'
+
+    def test_with_visits_joins_columns_onto_rows(self, fetcher, tmp_path):
+        """Rows read through with_visits carry the local visit_days and new_revisit, not the SQL-side ones"""
+        main_file = str(tmp_path / "main.parquet")
+        pd.DataFrame({'person_id': [1, 1, 2], 'Date': [datetime.date(2025, 1, d) for d in (1, 2, 2)],
+                      'visit_days': [99, 99, 99], 'new_revisit': ['stale'] * 3}).to_parquet(main_file, index=False)
+        fetcher.refresh_visits(main_file)
+
+        rows = duckdb.query(f"SELECT * FROM {DataFetcher.with_visits(repr(main_file), fetcher.visits_dir(main_file))} "
+                            f"ORDER BY person_id, Date").df()
+
+        assert rows.columns.tolist() == ['person_id', 'Date', 'visit_days', 'new_revisit']
+        assert rows['visit_days'].tolist() == [2, 2, 1]
+        assert rows['new_revisit'].tolist() == ['Revisit', 'Revisit', 'New']
+
+
+class TestConfigDefaults:
+    """Test cases for running with a config.py that predates newer settings"""
+
+    def test_missing_settings_get_documented_defaults(self, monkeypatch):
+        """Settings an older config.py lacks are filled in; the ones it defines are kept"""
+        import importlib
+        import config
+        import config_defaults
+        monkeypatch.delattr(config, 'SNAPSHOTS')
+        monkeypatch.setattr(config, 'WARM_FACILITIES', 3)
+
+        importlib.reload(config_defaults)
+
+        assert config.SNAPSHOTS is False
+        assert config.WARM_FACILITIES == 3
+
+
+class TestDerivedColumns:
+    """Test cases for columns derived once on store writes"""
+
+    DERIVED = {
+        'Gender': ("CASE \"Gender\" WHEN 'M' THEN 'Male' WHEN 'F' THEN 'Female' ELSE \"Gender\" END", ['Gender']),
+        'Residence': ("\"TA\" || ', ' || \"Village\"", ['TA', 'Village']),
+    }
+
+    def test_derived_on_write_and_idempotent_on_merge(self, fetcher, tmp_path):
+        """Batches get the derived columns and re-merging already derived rows leaves them unchanged"""
+        fetcher.derived_columns = self.DERIVED
+        main_file = str(tmp_path / "main.parquet")
+        frame = pd.DataFrame({'encounter_id': [1, 2], 'Date': [datetime.date(2025, 1, 1)] * 2,
+                              'Gender': ['M', 'F'], 'TA': ['Kasungu', None], 'Village': ['Chigoli', 'Mtunthama']})
+        fetcher.write_parquet(frame, main_file)
+
+        fetcher._merge_batches_into_main(main_file, 'Date', ['2025-02-01'])
+
+        result = pd.read_parquet(main_file)
+        assert result['Gender'].tolist() == ['Male', 'Female']
+        assert result['Residence'].tolist()[0] == 'Kasungu, Chigoli'
+        assert pd.isna(result['Residence'].tolist()[1])
@@ -0,0 +1,57 @@
+# test_projection.py
+import json
+import pytest
+import pandas as pd
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import projection
+
+STORE_COLUMNS = ['person_id', 'given_name', 'family_name', 'Gender', 'Age_Group', 'Date', 'DateValue',
+                 'Facility', 'Facility_CODE', 'User', 'District', 'Program', 'Encounter', 'concept_name',
+                 'obs_value_coded', 'Value', 'ValueN', 'DrugName', 'encounter_id']
+
+
+class TestProjection:
+    """Test cases for deriving the columns report specs reference"""
+
+    def test_json_spec_columns_include_filters_axes_and_linelist_keys(self, tmp_path):
+        """Filter variables, chart axes, unique columns and line-list group keys are all picked up"""
+        spec = [{"report_name": "General", "visualization_types": {
+            "counts": [{"filters": {"measure": "count", "unique": "person_id",
+                                    "variable1": "Program", "value1": "OPD Program"}}],
+            "charts": {"sections": [{"items": [
+                {"type": "Column", "filters": {"x_col": "Encounter", "y_col": "encounter_id",
+                                               "filter_col1": "concept_name", "filter_val1": "Weight | Height"}},
+                {"type": "LineList", "filters": {"group_cols1": ["DrugName"],
+                                                 "group1_filters": {"obs_value_coded": "Yes"}}}]}]}}}]
+        path = tmp_path / "dashboards.json"
+        path.write_text(json.dumps(spec))
+
+        columns = projection.dashboard_columns(STORE_COLUMNS, str(path))
+
+        assert set(columns) == {'person_id', 'Program', 'Encounter', 'encounter_id', 'concept_name', 'DrugName',
+                                'obs_value_coded', 'Date', 'Facility', 'Facility_CODE', 'Age_Group'}
+        assert columns == [c for c in STORE_COLUMNS if c in columns]
+
+    def test_excel_spec_columns_of_active_reports(self, tmp_path):
+        """FILTERS variables (single, [list] or a|b), num_field and unique_column of non-archived reports"""
+        uploads = tmp_path / "uploads"
+        uploads.mkdir()
+        for name, variable in (("active", "[Program, Encounter]"), ("archived", "User")):
+            with pd.ExcelWriter(uploads / f"{name}.xlsx") as writer:
+                pd.DataFrame({'filter_name': ['f1'], 'measure': ['sum'], 'num_field': ['ValueN'],
+                              'unique_column': ['person_id'], 'variable1': [variable],
+                              'value1': ['x'], 'variable2': ['Gender|Age_Group'],
+                              'value2': ['y']}).to_excel(writer, sheet_name="FILTERS", index=False)
+        reports_json = tmp_path / "hmis_reports.json"
+        reports_json.write_text(json.dumps({"reports": [{"page_name": "active", "archived": "False"},
+                                                        {"page_name": "archived", "archived": "True"},
+                                                        {"page_name": "missing", "archived": "False"}]}))
+
+        columns = projection.hmis_report_columns(STORE_COLUMNS, str(reports_json), str(uploads))
+
+        assert 'User' not in columns and 'given_name' not in columns
+        assert {'Program', 'Encounter', 'Gender', 'Age_Group', 'ValueN', 'person_id', 'encounter_id',
+                'DateValue'} <= set(columns)